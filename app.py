@@ -1,20 +1,36 @@
-from flask import Flask, request, jsonify, send_file, render_template, session
+from flask import Flask, request, jsonify, send_file, render_template, session, Response
 from flask import send_from_directory, abort
 from werkzeug.utils import safe_join, secure_filename
 import os
 import re
 import glob # Import glob
-import subprocess # Import subprocess
-from Bio.PDB import PDBParser
-import numpy as np
 import time
 import json
 import webbrowser
 import threading
+from receptor_cache import receptor_cache
+from selection import residue_index, SelectionError
+from pockets import detect_pockets
+import gridbox
+import logstream
+import progress
+from scheduler import JobScheduler, ACTIVE_STATES, QUEUED, RUNNING, DONE
+from result_cache import ResultCache
+from ingest import LigandIngest, IngestError, IngestBusy
+from ligand_prep import LigandPrep, missing_dependencies
+import ligand_index
+from results_index import ResultsIndex, consensus_top
+import export
+from interactions import fingerprint_poses, fingerprint_layout
+from pose_clusters import dedupe_results, DEFAULT_CUTOFF
+from unidock_multi import engine_search_mode
+from receptor_views import receptor_payload, LEVELS
+import metrics
+from sessions import load_secret_key, SqliteSessionInterface
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
-app.secret_key = os.urandom(24)  # Change this to a secure random value
-running_processes = {}
+# Request counts, latency and bytes for every route, served by /metrics
+metrics.install(app)
 
 @app.route('/')
 def home():
@@ -40,6 +56,32 @@ app.config['PROJECT'] = PROJECT
 os.makedirs(WORKSPACE, exist_ok=True)
 os.makedirs(PROJECT, exist_ok=True)
 
+# Secret key and sessions live in the workspace so every server worker
+# (see serve.py) sees the same active project
+app.secret_key = load_secret_key(WORKSPACE)
+app.session_interface = SqliteSessionInterface(os.path.join(WORKSPACE, 'sessions.db'))
+
+# Docking jobs are queued in a database under the workspace and survive restarts
+scheduler = JobScheduler(os.path.join(WORKSPACE, 'jobs.db'))
+# Ligand preparation workers (ligand_prep.py) import the main module again,
+# as __mp_main__; they must not dispatch jobs
+if __name__ != '__mp_main__':
+    scheduler.start()
+
+# Docking results shared by all projects, keyed by input content
+RESULT_CACHE_DIR = os.path.join(WORKSPACE, 'cache', 'results')
+# Ligands prepared from SMILES/SDF, shared by all projects
+PREP_CACHE_DIR = os.path.join(WORKSPACE, 'cache', 'ligands')
+
+UPLOAD_BYTES = metrics.counter('unidock_upload_bytes_total', 'Bytes of uploaded structure files saved.', ('kind',))
+UPLOAD_FILES = metrics.counter('unidock_upload_files_total', 'Uploaded structure files saved.', ('kind',))
+RUNS = metrics.gauge('unidock_runs', 'Docking jobs queued or running.', ('state',))
+RUNS.set_function(lambda: {(state,): scheduler.counts().get(state, 0) for state in ACTIVE_STATES})
+LIGANDS_PER_SECOND = metrics.gauge('unidock_ligands_per_second', 'Current docking throughput over all running jobs.')
+LIGANDS_PER_SECOND.set_function(lambda: sum(
+    progress.get_tracker(job['project_path'], job['id']).update()['ligands_per_second']
+    for job in scheduler.list_jobs(states=[RUNNING])))
+
 # os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # if not os.path.exists(WORKSPACE):
@@ -80,7 +122,10 @@ def upload_rec():
     os.makedirs(upload_folder, exist_ok=True)
 
     filepath = os.path.join(upload_folder, file.filename)
-    file.save(filepath)
+    with metrics.stage('upload_save'):
+        file.save(filepath)
+    UPLOAD_FILES.inc(kind='receptor')
+    UPLOAD_BYTES.inc(os.path.getsize(filepath), kind='receptor')
 
     return jsonify({'message': 'File uploaded successfully!', 'filepath': filepath})
 
@@ -96,7 +141,6 @@ def upload_lig():
     if not files or all(file.filename == '' for file in files):
         return jsonify({'error': 'No files uploaded.'}), 400
 
-    allowed_extensions = {'.pdbqt'}
     upload_folder = os.path.join(project_path, 'ligand')
     os.makedirs(upload_folder, exist_ok=True)
 
@@ -108,12 +152,20 @@ def upload_lig():
             continue
 
         ext = os.path.splitext(filename)[1].lower()
-        if ext not in allowed_extensions:
-            return jsonify({'error': f'Invalid file type for {filename}. Allowed: .pdbqt'}), 400
+        if ext not in ligand_index.DOCKING_EXTENSIONS:
+            allowed = ', '.join(ligand_index.DOCKING_EXTENSIONS)
+            return jsonify({'error': f'Invalid file type for {filename}. Allowed: {allowed}'}), 400
 
         filepath = os.path.join(upload_folder, filename)
-        file.save(filepath)
+        with metrics.stage('upload_save'):
+            file.save(filepath)
         saved_files.append(filepath)
+        UPLOAD_FILES.inc(kind='ligand')
+        UPLOAD_BYTES.inc(os.path.getsize(filepath), kind='ligand')
+
+    # Keep the library index in step with the folder
+    with metrics.stage('ligand_index'):
+        ligand_index.add_files(upload_folder, saved_files)
 
     return jsonify({
         'message': f'{len(saved_files)} file(s) uploaded successfully!',
@@ -121,6 +173,146 @@ def upload_lig():
         'filenames': [os.path.basename(f) for f in saved_files]
     })
 
+# Route for bulk ligand libraries: the raw request body is an archive or a
+# multi-molecule file, named by ?filename= (or the X-Filename header)
+@app.route('/lig_upload/bulk', methods=['POST'])
+def upload_lig_bulk():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    filename = request.args.get('filename') or request.headers.get('X-Filename', '')
+    if not filename:
+        return jsonify({'error': 'No file name given.'}), 400
+
+    try:
+        # The body is read straight from the socket, never parsed as a form
+        summary = LigandIngest(os.path.join(project_path, 'ligand')).run(request.stream, filename)
+    except IngestBusy as e:
+        return jsonify({'error': str(e)}), 409
+    except IngestError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if summary['written'] == 0:
+        return jsonify({'error': 'No valid molecules found in the upload.', **summary}), 400
+
+    message = f"{summary['written']} ligand(s) ingested into {len(summary['shards'])} shard(s)."
+    if summary['invalid']:
+        message += f" {summary['invalid']} invalid molecule(s) were skipped."
+    if summary['formats'].get('sdf'):
+        message += ' SDF molecules must be converted to PDBQT before docking (see /lig_upload/prepare).'
+    summary['message'] = message
+    return jsonify(summary)
+
+# Route for SMILES/SDF libraries prepared into PDBQT on the server: the raw
+# request body is a .smi or .sdf file (optionally .gz), named like a bulk upload
+@app.route('/lig_upload/prepare', methods=['POST'])
+def upload_lig_prepare():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    missing = missing_dependencies()
+    if missing:
+        return jsonify({'error': f'Ligand preparation needs {" and ".join(missing)} '
+                                 f'(pip install {" ".join(missing)}).'}), 501
+
+    filename = request.args.get('filename') or request.headers.get('X-Filename', '')
+    if not filename:
+        return jsonify({'error': 'No file name given.'}), 400
+
+    try:
+        with metrics.stage('ligand_prep'):
+            summary = LigandPrep(os.path.join(project_path, 'ligand'), PREP_CACHE_DIR).run(request.stream, filename)
+    except IngestBusy as e:
+        return jsonify({'error': str(e)}), 409
+    except IngestError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if summary['written'] == 0:
+        return jsonify({'error': 'No molecule could be prepared.', **summary}), 400
+
+    message = f"{summary['written']} ligand(s) prepared, {summary['cached']} of them from the cache."
+    if summary['invalid']:
+        message += f" {summary['invalid']} molecule(s) failed; see the errors."
+    summary['message'] = message
+    return jsonify(summary)
+
+# Library overview from the ligand index; ?refresh=1 first re-syncs the index
+# with the ligand folder (after files were added, changed or removed by hand)
+@app.route('/ligands/index', methods=['GET'])
+def ligand_library():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    ligand_dir = os.path.join(project_path, 'ligand')
+    result = {}
+    if request.args.get('refresh'):
+        added, updated, removed = ligand_index.refresh(ligand_dir)
+        result.update({'added': added, 'updated': updated, 'removed': removed})
+    result.update(ligand_index.load(ligand_dir).summary())
+
+    selection_path = os.path.join(project_path, 'params', 'ligand_selection.txt')
+    if os.path.exists(selection_path):
+        with open(selection_path, 'r') as f:
+            result['selected'] = sum(1 for line in f if line.strip())
+    return jsonify(result)
+
+# Pick the subset of the library used by the next docking run
+@app.route('/ligands/select', methods=['POST'])
+def select_ligands():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    data = request.get_json(silent=True) or {}
+    params_dir = os.path.join(project_path, 'params')
+    selection_path = os.path.join(params_dir, 'ligand_selection.txt')
+    if data.get('clear'):
+        if os.path.exists(selection_path):
+            os.remove(selection_path)
+        return jsonify({'message': 'Selection cleared; the whole library will be docked.'})
+
+    filters = {}
+    try:
+        for key in ('min_torsions', 'max_torsions', 'min_heavy', 'max_heavy', 'sample', 'seed'):
+            if data.get(key) not in (None, ''):
+                filters[key] = int(data[key])
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Numeric filters must be integers.'}), 400
+    for key in ('sample', 'seed'):
+        if filters.get(key, 0) < 0:
+            return jsonify({'error': f'{key} must not be negative.'}), 400
+    for key in ('elements', 'exclude_elements'):
+        if data.get(key):
+            if not isinstance(data[key], list) or not all(isinstance(e, str) for e in data[key]):
+                return jsonify({'error': f'{key} must be a list of element symbols, e.g. ["N", "Cl"].'}), 400
+            unknown = [e for e in data[key] if e not in ligand_index.ELEMENT_BITS]
+            if unknown:
+                return jsonify({'error': f'Unknown element(s): {", ".join(unknown)}'}), 400
+            filters[key] = data[key]
+
+    started = time.time()
+    index = ligand_index.load(os.path.join(project_path, 'ligand'))
+    if len(index) == 0:
+        return jsonify({'error': 'The ligand library index is empty. Upload ligands first.'}), 400
+    rows = index.select(**filters)
+    elapsed_ms = (time.time() - started) * 1000
+
+    os.makedirs(params_dir, exist_ok=True)
+    with open(selection_path, 'w') as f:
+        for i in rows:
+            f.write(index.path(int(i)) + '\n')
+
+    return jsonify({
+        'message': f'{len(rows)} of {len(index)} ligand(s) selected for docking.',
+        'selected': int(len(rows)),
+        'library': len(index),
+        'query_ms': round(elapsed_ms, 2),
+        'preview': index.paths(rows[:10]),
+    })
+
 
 @app.route('/grid', methods=['POST'])
 def generate_grid():
@@ -130,48 +322,47 @@ def generate_grid():
         data = request.json
         filepath = data.get('filepath')  # Path to the uploaded file
         mode = data.get('mode')  # Docking mode: "blind" or "targeted"
-        residues = data.get('residues', [])  # Targeted residues as a list
+        residues = data.get('residues', [])  # Targeted residue selectors, e.g. "A:100-140"
+        sizing = data.get('sizing', 'buffer')  # "buffer" (fixed 5 A) or "ligand" (fit uploaded ligands)
 
         # Check if file exists
         if not filepath or not os.path.exists(filepath):
             return jsonify({'error': 'File not found. Please upload a valid file.'}), 400
 
-        # Parse the PDB file
-        parser = PDBParser()
-        structure = parser.get_structure('protein', filepath)
+        # Parsed atom arrays are cached by path, size and mtime
+        with metrics.stage('parse'):
+            receptor = receptor_cache.get(filepath)
 
-        coords = []
         if mode == 'blind':
             # Collect all atom coordinates for blind docking
-            for atom in structure.get_atoms():
-                coords.append(atom.coord)
+            coords = receptor.coords
         elif mode == 'targeted':
             if not residues:
                 return jsonify({'error': 'No residues specified for targeted docking.'}), 400
-            # Extract coordinates of specific residues
-            for residue in residues:
-                residue = residue.strip()
-                chain_id, res_id = residue.split(':')
-                chain_id = chain_id.strip()
-                res_id = res_id.strip()
-                for chain in structure.get_chains():
-                    if chain.id == chain_id:
-                        for res in chain.get_residues():
-                            if res.id[1] == int(res_id):  # Match residue number
-                                for atom in res:
-                                    coords.append(atom.coord)
+            # Selectors resolve to an atom mask through the residue index
+            try:
+                with metrics.stage('select'):
+                    mask = residue_index(receptor).select(residues)
+            except SelectionError as e:
+                return jsonify({'error': str(e)}), 400
+            coords = receptor.coords[mask]
         else:
             return jsonify({'error': 'Invalid mode selected.'}), 400
 
-        if not coords:
+        if len(coords) == 0:
             return jsonify({'error': 'No atoms found for the specified residues.'}), 400
 
-        coords = np.array(coords)
-        min_coords = coords.min(axis=0) - 5  # Add buffer
-        max_coords = coords.max(axis=0) + 5  # Add buffer
-
-        center = (min_coords + max_coords) / 2
-        size = max_coords - min_coords
+        if sizing not in ('ligand', 'buffer'):
+            return jsonify({'error': 'Invalid sizing selected.'}), 400
+        with metrics.stage('box'):
+            if sizing == 'ligand':
+                # Smallest box around the site that fits the largest uploaded ligand
+                ligand_extent = gridbox.library_extent(os.path.join(project_path, 'ligand'))
+                if ligand_extent is None:
+                    return jsonify({'error': 'Upload ligands before sizing the grid from them.'}), 400
+                center, size = gridbox.ligand_fit_box(coords, ligand_extent)
+            else:
+                center, size = gridbox.buffer_box(coords)
 
         # Create configuration file for grid box
         config = f"""
@@ -187,30 +378,59 @@ size_z = {size[2]}
         timestamp = int(time.time())
         config_filename = f'config_{mode}_{timestamp}.txt'
         config_path = os.path.join(project_path, config_filename)
-        with open(config_path, 'w') as f:
+        with metrics.stage('config_write'), open(config_path, 'w') as f:
             f.write(config)
 
         # Extract grid dimensions to send to the client
-        grid_dimensions = {
-        'center_x': float(center[0]),
-        'center_y': float(center[1]),
-        'center_z': float(center[2]),
-        'size_x': float(size[0]),
-        'size_y': float(size[1]),
-        'size_z': float(size[2]),
-        }
+        grid_dimensions = gridbox.grid_dimensions(center, size)
 
         # Return the filename to the client for reference or download
         return jsonify({
             'message': 'Grid configuration generated!',
             'config_file': config_filename,
             'config_path': config_path,
-            'grid_dimensions': grid_dimensions
+            'grid_dimensions': grid_dimensions,
+            'search_recommendation': gridbox.recommend_search(grid_dimensions)
         })
     except Exception as e:
         app.logger.error(f"Error during grid generation: {e}")
         return jsonify({'error': 'An error occurred during grid generation.'}), 500
 
+@app.route('/pockets', methods=['POST'])
+def find_pockets():
+    try:
+        data = request.json or {}
+        filepath = data.get('filepath')
+        top_k = int(data.get('top_k', 5))
+        spacing = float(data.get('spacing', 1.0))
+        padding = float(data.get('padding', 4.0))
+
+        if not filepath or not os.path.exists(filepath):
+            return jsonify({'error': 'File not found. Please upload a valid file.'}), 400
+        if top_k < 1 or not 0.4 <= spacing <= 2.0 or padding < 0:
+            return jsonify({'error': 'Invalid pocket detection parameters.'}), 400
+
+        receptor = receptor_cache.get(filepath)
+
+        # Detection depends only on the structure, so results are kept with it
+        cache_key = ('pockets', spacing, padding)
+        pockets = receptor.derived.get(cache_key)
+        if pockets is None:
+            pockets = receptor.derived[cache_key] = detect_pockets(receptor, spacing=spacing, padding=padding, top_k=0)
+
+        if not pockets:
+            return jsonify({'error': 'No pockets found in this structure.'}), 404
+
+        return jsonify({
+            'message': f'{min(top_k, len(pockets))} of {len(pockets)} pocket(s) returned.',
+            'pockets': pockets[:top_k]
+        })
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid pocket detection parameters.'}), 400
+    except Exception as e:
+        app.logger.error(f"Error during pocket detection: {e}")
+        return jsonify({'error': 'An error occurred during pocket detection.'}), 500
+
 @app.route('/save_grid', methods=['POST'])
 def save_adjusted_grid():
     project_path = session.get('project_path')
@@ -235,8 +455,21 @@ def save_adjusted_grid():
     with open(save_path, 'w') as f:
         json.dump(grid, f, indent=4)
 
+    # Each receptor also keeps its own box for ensemble runs
+    receptor_grid_path = os.path.join(upload_folder, receptor_grid_name(filepath))
+    with open(receptor_grid_path, 'w') as f:
+        json.dump(grid, f, indent=4)
+
     return jsonify({'message': 'Grid saved successfully!', 'grid_file': filename, 'save_path': save_path})
 
+
+def receptor_grid_name(receptor_path):
+    return f'grid_{receptor_name(receptor_path)}.json'
+
+
+def receptor_name(receptor_path):
+    return secure_filename(os.path.splitext(os.path.basename(receptor_path))[0]) or 'receptor'
+
 @app.route('/upload-params', methods=['POST'])
 def upload_params():
     project_path = session.get('project_path')
@@ -257,12 +490,33 @@ def upload_params():
         upload_folder = os.path.join(project_path, 'params')
         os.makedirs(upload_folder, exist_ok=True)
 
+        # "Auto" picks search mode and num_modes from the saved box volume
+        if data['search_mode'] == 'Auto':
+            try:
+                with open(os.path.join(upload_folder, 'grid.json'), 'r') as f:
+                    grid = json.load(f)
+            except FileNotFoundError:
+                return jsonify({'error': 'Save the grid before choosing the Auto search mode.'}), 400
+            recommendation = gridbox.recommend_search(grid)
+            data['search_mode'] = recommendation['search_mode']
+            data['num_modes'] = str(recommendation['num_modes'])
+            data['auto_tuned'] = recommendation
+        try:
+            engine_search_mode(data['search_mode'])
+        except ValueError:
+            return jsonify({'error': 'search_mode must be one of Fast, Balanced, Detail or Auto.'}), 400
+
         file_path = os.path.join(upload_folder, 'param.json')
 
         with open(file_path, 'w') as f:
             json.dump(data, f, indent=4)
 
-        return jsonify({'message': 'Parameters saved as JSON successfully.'}), 200
+        message = 'Parameters saved as JSON successfully.'
+        if data.get('auto_tuned'):
+            tuned = data['auto_tuned']
+            message += (f" Auto-tuned to {tuned['search_mode']} search with {tuned['num_modes']} modes"
+                        f" (box {tuned['box_volume']:.0f} A^3, relative cost {tuned['relative_cost']}).")
+        return jsonify({'message': message, 'params': data}), 200
     except Exception as e:
         return jsonify({'error': f'Internal server error: {str(e)}'}), 500
 
@@ -273,8 +527,49 @@ def run_docking():
         return jsonify({'error': 'No active project found.'}), 400
 
     # Prevent multiple simultaneous runs for the same project
-    if project_path in running_processes and running_processes[project_path].poll() is None:
-        return jsonify({'error': 'A docking process is already running for this project.'}), 409
+    latest_job = scheduler.latest_for_project(project_path)
+    if latest_job and latest_job['state'] in ACTIVE_STATES:
+        return jsonify({'error': 'A docking process is already queued or running for this project.'}), 409
+
+    options = request.get_json(silent=True) or {}
+    run_type = options.get('run_type', 'single')
+    if run_type not in ('single', 'ensemble', 'funnel'):
+        return jsonify({'error': 'Invalid run type.'}), 400
+    # Checked before anything is written, like every other option
+    try:
+        priority = int(options.get('priority', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'priority must be an integer.'}), 400
+
+    funnel = None
+    if run_type == 'funnel':
+        # Cheap search over the whole library, then a detailed re-dock of the best
+        try:
+            funnel = {
+                'search_mode': options.get('funnel_search_mode', 'Detail'),
+                'num_modes': int(options.get('funnel_num_modes', 9)),
+            }
+            if options.get('funnel_top'):
+                funnel['top'] = int(options['funnel_top'])
+            else:
+                funnel['fraction'] = float(options.get('funnel_fraction', 0.1))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Funnel settings must be numbers.'}), 400
+        if funnel.get('top', 1) < 1 or not 0 < funnel.get('fraction', 1) <= 1 or funnel['num_modes'] < 1:
+            return jsonify({'error': 'Funnel top must be at least 1 and fraction within (0, 1].'}), 400
+        try:
+            engine_search_mode(funnel['search_mode'])
+        except ValueError:
+            return jsonify({'error': 'funnel_search_mode must be one of Fast, Balanced, Detail.'}), 400
+
+    dedupe_rmsd = options.get('dedupe_rmsd')
+    if dedupe_rmsd is not None:
+        try:
+            dedupe_rmsd = float(dedupe_rmsd)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'dedupe_rmsd must be a number.'}), 400
+        if dedupe_rmsd <= 0:
+            return jsonify({'error': 'dedupe_rmsd must be positive.'}), 400
 
     try:
         # --- Step 1: Define paths and create results directory ---
@@ -287,10 +582,12 @@ def run_docking():
         grid_config_path = os.path.join(params_dir, 'grid.json')
         docking_params_path = os.path.join(params_dir, 'param.json')
         
-        receptor_files = glob.glob(os.path.join(receptor_dir, '*.pdb'))
+        receptor_files = sorted(glob.glob(os.path.join(receptor_dir, '*.pdb')))
         if not receptor_files:
             return jsonify({'error': 'Receptor PDB file not found.'}), 404
         receptor_file = receptor_files[0]
+        if run_type == 'ensemble' and len(receptor_files) < 2:
+            return jsonify({'error': 'Ensemble docking needs at least two receptor PDB files.'}), 400
         
         # --- Step 2: Load and consolidate configurations ---
         with open(grid_config_path, 'r') as f: grid_config = json.load(f)
@@ -301,28 +598,57 @@ def run_docking():
             "ligand_dir": os.path.abspath(ligand_dir),
             "results_dir": os.path.abspath(results_dir),
             **grid_config,
-            **docking_params
+            **docking_params,
+            # Skip ligands already docked with these settings by an earlier run
+            "resume": bool(options.get('resume', True)),
+            # Reuse results of identical receptor/ligand/box/parameter inputs
+            "cache_dir": os.path.abspath(RESULT_CACHE_DIR) if options.get('use_cache', True) else None
         }
+        if run_type == 'ensemble':
+            # Every receptor is docked in its own box (grid_<name>.json), or
+            # in the shared box when none was saved for it
+            receptors = []
+            for path in receptor_files:
+                receptor_grid = grid_config
+                receptor_grid_path = os.path.join(params_dir, receptor_grid_name(path))
+                if os.path.exists(receptor_grid_path):
+                    with open(receptor_grid_path, 'r') as f:
+                        receptor_grid = json.load(f)
+                receptors.append({'name': receptor_name(path), 'receptor': os.path.abspath(path), **receptor_grid})
+            master_config['receptors'] = receptors
+        elif run_type == 'funnel':
+            master_config['funnel'] = funnel
+        if dedupe_rmsd:
+            # Keep one pose per RMSD cluster once docking finishes
+            master_config['dedupe_rmsd'] = dedupe_rmsd
+        if options.get('shard_results'):
+            # Pack results into compressed shards instead of a file per ligand
+            master_config['shard_results'] = True
+
+        # Dock only the ligands picked through /ligands/select, if any
+        selection_path = os.path.join(params_dir, 'ligand_selection.txt')
+        if os.path.exists(selection_path):
+            master_config['ligand_list'] = os.path.abspath(selection_path)
 
         master_config_path = os.path.join(project_path, 'config.json')
-        with open(master_config_path, 'w') as f:
+        with metrics.stage('config_write'), open(master_config_path, 'w') as f:
             json.dump(master_config, f, indent=4)
         
         # --- Step 3: Execute script and capture logs ---
         script_path = os.path.join(os.path.dirname(__file__), 'unidock_multi.py')
         command = ['python', '-u', script_path, master_config_path]
         
-        # Define a log file to capture both stdout and stderr
+        # Define a log file to capture both stdout and stderr; it is emptied
+        # now so a queued job does not show the previous run's log
         log_file_path = os.path.join(results_dir, 'docking_run.log')
-        log_file = open(log_file_path, 'w')
-        
-        # Popen runs the command in a new process and redirects output.
-        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
-        
-        # Store the process object to track its status later
-        running_processes[project_path] = process
+        open(log_file_path, 'w').close()
+
+        # The scheduler starts the job once a worker slot is free
+        with metrics.stage('submit'):
+            job_id = scheduler.submit(project_path, command, log_file_path, priority=priority)
+        progress.start_tracking(project_path, job_id)
 
-        return jsonify({'message': 'Docking process started successfully!'}), 200
+        return jsonify({'message': 'Docking job submitted successfully!', 'job_id': job_id}), 200
 
     except FileNotFoundError as e:
         return jsonify({'error': f'A required configuration file is missing: {e.filename}'}), 500
@@ -339,45 +665,337 @@ def run_status():
     if not project_path:
         return jsonify({'error': 'No active project found.'}), 400
 
-    if project_path not in running_processes:
-        return jsonify({'status': 'not_found', 'message': 'No active run found for this project.'})
+    # Clients pass the byte offset they have read up to and get only new log text
+    offset = request.args.get('offset', 0, type=int)
 
-    process = running_processes[project_path]
-    return_code = process.poll()
+    status = _job_status(project_path)
+    if status['status'] == 'not_found':
+        return jsonify(status)
 
     results_dir = os.path.join(project_path, 'results')
     log_file_path = os.path.join(results_dir, 'docking_run.log')
-    log_content = ""
-    try:
-        with open(log_file_path, 'r') as f:
-            log_content = f.read()
-    except FileNotFoundError:
-        log_content = "Log file has not been created yet..."
+    with metrics.stage('log_read'):
+        log_content, offset, log_size, reset = logstream.read_chunk(log_file_path, offset)
+    status.update({'log': log_content, 'offset': offset, 'log_size': log_size, 'reset': reset})
 
-    if return_code is None:
-        return jsonify({
-            'status': 'running',
-            'log': log_content
+    return jsonify(status)
+
+
+@app.route('/run-stream', methods=['GET'])
+def run_stream():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    if scheduler.latest_for_project(project_path) is None:
+        return jsonify({'status': 'not_found', 'message': 'No active run found for this project.'})
+
+    # EventSource sends the last event id (our offset) when it reconnects
+    offset = request.headers.get('Last-Event-ID', type=int)
+    if offset is None:
+        offset = request.args.get('offset', 0, type=int)
+
+    log_file_path = os.path.join(project_path, 'results', 'docking_run.log')
+    events = logstream.stream_log(log_file_path, offset, lambda: _job_status(project_path))
+    return Response(events, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+def _job_status(project_path):
+    job = scheduler.latest_for_project(project_path)
+    if job is None:
+        return {'status': 'not_found', 'message': 'No active run found for this project.'}
+
+    status = {'job_id': job['id']}
+    if job['state'] == QUEUED:
+        position = scheduler.queue_position(job)
+        status.update({'status': 'queued', 'message': f'Waiting for a free worker (position {position} in queue).',
+                       'queue_position': position})
+        return status
+
+    # Ligand counters, throughput and ETA parsed incrementally from the log
+    with metrics.stage('progress'):
+        status['progress'] = progress.get_tracker(project_path, job['id']).update(finished=job['state'] != RUNNING)
+    status['resources'] = job['resources']
+    if job['started']:
+        status['elapsed_seconds'] = round((job['finished'] or time.time()) - job['started'], 1)
+    if job['state'] == RUNNING:
+        status['status'] = 'running'
+    elif job['state'] == DONE:
+        status.update({
+            'status': 'completed',
+            'message': 'Docking run finished successfully!',
+            'results_path': os.path.abspath(os.path.join(project_path, 'results'))
         })
     else:
-        del running_processes[project_path]
-        
-        if return_code == 0:
-            # --- NEW: Add the absolute results path to the success response ---
-            results_path = os.path.abspath(results_dir)
-            return jsonify({
-                'status': 'completed', 
-                'message': 'Docking run finished successfully!',
-                'log': log_content,
-                'results_path': results_path  # <-- ADD THIS LINE
-            })
-        else:
-            return jsonify({
-                'status': 'error', 
-                'message': f'Docking run failed with exit code {return_code}.',
-                'log': log_content
-            })
+        status.update({
+            'status': 'error',
+            'message': job['error'] or f'Docking run failed with exit code {job["return_code"]}.'
+        })
+    return status
+
+
+# Jobs of the active project; other projects' jobs are neither listed nor cancellable
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    states = [state for state in request.args.get('state', '').split(',') if state]
+    jobs = scheduler.list_jobs(states=states, limit=request.args.get('limit', 100, type=int),
+                               project_path=project_path)
+    return jsonify({'jobs': jobs, 'counts': scheduler.counts(project_path), 'slots': scheduler.slots})
+
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    job = scheduler.get(job_id)
+    if job is None or job['project_path'] != project_path:
+        return jsonify({'error': 'Job not found.'}), 404
+    if not scheduler.cancel(job_id):
+        return jsonify({'error': 'Job has already finished.'}), 409
+    return jsonify({'message': f'Job {job_id} cancelled.'})
+
+
+def _results_dir(project_path):
+    """
+    Results folder a request refers to: results/<receptor> for ?receptor= of
+    an ensemble run, results/stage1 for ?stage=1 of a funnel run, otherwise
+    results/.  None if it does not exist.
+    """
+    results_dir = os.path.join(project_path, 'results')
+    scope = request.args.get('receptor') or ('stage1' if request.args.get('stage') == '1' else None)
+    if scope:
+        results_dir = os.path.join(results_dir, secure_filename(scope))
+    return results_dir if os.path.isdir(results_dir) else None
+
+
+def _results_index(project_path, results_dir):
+    """
+    Results index of a folder, synced with it.  While the project's run is
+    active its driver indexes every batch itself, so the folder is not
+    scanned; otherwise syncing is cheap unless the folder changed.
+    """
+    index = ResultsIndex(results_dir)
+    job = scheduler.latest_for_project(project_path)
+    if job is None or job['state'] != RUNNING:
+        index.sync()
+    return index
+
+
+def _receptor_path(project_path):
+    """Receptor file a request refers to (?receptor=<name>, else the run's receptor)."""
+    receptor_files = sorted(glob.glob(os.path.join(project_path, 'receptor', '*.pdb')))
+    wanted = request.args.get('receptor')
+    if wanted:
+        receptor_files = [path for path in receptor_files if receptor_name(path) == wanted]
+    return receptor_files[0] if receptor_files else None
+
+
+# Best hits of the active project's run, served from the results index
+@app.route('/results', methods=['GET'])
+def list_results():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    results_dir = _results_dir(project_path)
+    if results_dir is None:
+        return jsonify({'error': 'No docking results yet.'}), 404
+
+    index = _results_index(project_path, results_dir)
+
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 1000)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    rank = request.args.get('rank', 1, type=int)
+    total, hits = index.top(limit=limit, offset=offset, rank=rank,
+                            max_score=request.args.get('max_score', type=float))
+    result = {'total': total, 'offset': offset, 'limit': limit, 'rank': rank, 'hits': hits, **index.counts()}
+
+    bins = request.args.get('histogram', type=int)
+    if bins:
+        result['histogram'] = index.histogram(bins=min(max(bins, 1), 200), rank=rank)
+    return jsonify(result)
+
+
+# One docked pose as a MODEL block, read by its byte range in the result file:
+# ?ligand=<name>&rank=N[&receptor=<name>|&stage=1]
+@app.route('/results/pose', methods=['GET'])
+def result_pose():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
 
+    results_dir = _results_dir(project_path)
+    if results_dir is None:
+        return jsonify({'error': 'No docking results yet.'}), 404
+    ligand = request.args.get('ligand')
+    if not ligand:
+        return jsonify({'error': 'No ligand given.'}), 400
+
+    pose = ResultsIndex(results_dir).pose(ligand, request.args.get('rank', 1, type=int))
+    if pose is None:
+        return jsonify({'error': 'Pose not found.'}), 404
+    try:
+        text = export.model_block(export.read_pose(results_dir, pose), pose)
+    except OSError:
+        return jsonify({'error': 'Result file not found.'}), 404
+    response = Response(text, mimetype='chemical/x-pdbqt')
+    response.headers['X-Score'] = str(pose['score'])
+    return response
+
+
+# A page of the ranked hit list with each hit's pose, for stepping through
+# results in the viewer: ?offset=&limit=&rank=[&receptor=<name>|&stage=1]
+@app.route('/results/poses', methods=['GET'])
+def result_poses():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    results_dir = _results_dir(project_path)
+    if results_dir is None:
+        return jsonify({'error': 'No docking results yet.'}), 404
+
+    index = _results_index(project_path, results_dir)
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    total, hits = index.top(limit=limit, offset=offset, rank=request.args.get('rank', 1, type=int))
+    for hit in hits:
+        try:
+            hit['pose'] = export.model_block(export.read_pose(results_dir, hit), hit)
+        except OSError:
+            hit['pose'] = None
+
+    receptor_path = _receptor_path(project_path)
+    return jsonify({'total': total, 'offset': offset, 'limit': limit, 'hits': hits,
+                    'receptor': os.path.abspath(receptor_path) if receptor_path else None})
+
+
+# Interaction counts, contact residues and fingerprints of the top poses;
+# poses analysed before are served from results.db
+@app.route('/results/interactions', methods=['GET'])
+def result_interactions():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    results_dir = _results_dir(project_path)
+    if results_dir is None:
+        return jsonify({'error': 'No docking results yet.'}), 404
+    receptor_path = _receptor_path(project_path)
+    if receptor_path is None:
+        return jsonify({'error': 'Receptor PDB file not found.'}), 404
+
+    index = _results_index(project_path, results_dir)
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 5000)
+    _, poses = index.top(limit=limit, offset=max(request.args.get('offset', 0, type=int), 0),
+                         rank=request.args.get('rank', 1, type=int))
+
+    started = time.time()
+    hits = fingerprint_poses(receptor_path, results_dir, poses)
+    result = {'hits': hits, 'elapsed_seconds': round(time.time() - started, 3)}
+    if request.args.get('layout'):
+        result['layout'] = fingerprint_layout(receptor_path)
+    return jsonify(result)
+
+
+# Cluster each ligand's poses by heavy-atom RMSD and drop near-duplicates;
+# a dry run unless "rewrite" is set.  Reports the space and parse time saved.
+@app.route('/results/dedupe', methods=['POST'])
+def dedupe_poses():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    results_dir = _results_dir(project_path)
+    if results_dir is None:
+        return jsonify({'error': 'No docking results yet.'}), 404
+    latest_job = scheduler.latest_for_project(project_path)
+    if latest_job and latest_job['state'] in ACTIVE_STATES:
+        return jsonify({'error': 'Docking is still queued or running for this project.'}), 409
+
+    options = request.get_json(silent=True) or {}
+    try:
+        cutoff = float(options.get('cutoff', DEFAULT_CUTOFF))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'cutoff must be a number.'}), 400
+    if cutoff <= 0:
+        return jsonify({'error': 'cutoff must be positive.'}), 400
+
+    started = time.time()
+    report = dedupe_results(results_dir, cutoff, rewrite=bool(options.get('rewrite')))
+    report['elapsed_seconds'] = round(time.time() - started, 3)
+    return jsonify(report)
+
+
+# Ensemble consensus: best and mean best-pose score of each ligand over all receptors
+@app.route('/results/consensus', methods=['GET'])
+def consensus_results():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    results_dir = os.path.join(project_path, 'results')
+    if not os.path.isdir(results_dir):
+        return jsonify({'error': 'No docking results yet.'}), 404
+
+    order = request.args.get('order', 'best')
+    if order not in ('best', 'mean'):
+        return jsonify({'error': 'order must be "best" or "mean".'}), 400
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 1000)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    total, hits = consensus_top(results_dir, limit=limit, offset=offset, order=order)
+    return jsonify({'total': total, 'offset': offset, 'limit': limit, 'order': order, 'hits': hits})
+
+
+# Top hits as one streamed CSV, PDBQT or SDF file (optionally gzipped):
+# ?format=csv|pdbqt|sdf&limit=N&max_score=S&rank=1|all&gzip=1[&receptor=<name>|&stage=1]
+@app.route('/results/export', methods=['GET'])
+def export_results():
+    project_path = session.get('project_path')
+    if not project_path:
+        return jsonify({'error': 'No active project found.'}), 400
+
+    results_dir = _results_dir(project_path)
+    if results_dir is None:
+        return jsonify({'error': 'No docking results yet.'}), 404
+
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in export.FORMATS:
+        return jsonify({'error': 'Invalid format. Allowed: csv, pdbqt, sdf'}), 400
+    rank = request.args.get('rank', '1')
+    if rank != 'all' and not rank.isdigit():
+        return jsonify({'error': 'rank must be a pose number or "all".'}), 400
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+
+    index = _results_index(project_path, results_dir)
+    poses = index.iter_poses(rank=None if rank == 'all' else int(rank),
+                             max_score=request.args.get('max_score', type=float),
+                             limit=request.args.get('limit', type=int))
+
+    mimetype, extension = export.FORMATS[export_format]
+    filename = f'{os.path.basename(project_path)}_hits.{extension}' + ('.gz' if compress else '')
+    # A generator body is sent with chunked encoding as it is produced
+    return Response(export.export_chunks(results_dir, poses, export_format, compress),
+                    mimetype='application/gzip' if compress else mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    cache = ResultCache(RESULT_CACHE_DIR)
+    try:
+        return jsonify(cache.stats())
+    finally:
+        cache.close()
 
 
 # @app.route('/download/<filename>', methods=['GET'])
@@ -405,12 +1023,40 @@ def run_status():
 #         app.logger.error(f"Error during file download: {e}")
 #         return jsonify({'error': 'An error occurred during file download.'}), 500
 
+# Receptor PDB for the viewer: ?detail=full|backbone|ca, gzipped when the
+# client accepts it, with ETag/Last-Modified so unchanged files are not resent
 @app.route('/get_pdb', methods=['GET'])
 def get_pdb():
     filepath = request.args.get('filepath')
     if not filepath or not os.path.exists(filepath):
         return jsonify({'error': 'File not found.'}), 404
-    return send_file(filepath, mimetype='chemical/x-pdb')
+    level = request.args.get('detail', 'full')
+    if level not in LEVELS:
+        return jsonify({'error': f'detail must be one of: {", ".join(LEVELS)}.'}), 400
+
+    try:
+        payload = receptor_payload(filepath, level)
+    except ValueError as e:
+        return jsonify({'error': f'Could not read receptor: {str(e)}'}), 400
+
+    gzipped = request.accept_encodings['gzip'] > 0
+    response = Response(payload.gzipped if gzipped else payload.data, mimetype='chemical/x-pdb')
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if payload.atoms is not None:
+        response.headers['X-Atom-Count'] = str(payload.atoms)
+    # The two encodings are different representations, so their ETags differ
+    response.set_etag(payload.etag + ('-gz' if gzipped else ''))
+    response.last_modified = payload.last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+# Counters, latency histograms and gauges in the Prometheus text format
+# Summed over all server workers (see metrics.py)
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 @app.route('/get-project-path')
 def get_project_path():
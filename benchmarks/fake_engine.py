@@ -0,0 +1,80 @@
+"""
+Stand-in docking engine for benchmarks.
+
+Accepts the arguments unidock_multi.py passes to Uni-Dock (--ligand_index,
+--dir, --num_modes, ...), waits a configurable time per ligand instead of
+docking and writes `<ligand>_out.pdbqt` with `num_modes` scored models, so the
+driver, result cache, results index and progress tracking all run for real.
+
+    python benchmarks/fake_engine.py [--latency S] [--jitter F] [--startup S]
+                                     [--fail-rate P] [--modes N] [--seed N]
+                                     <Uni-Dock arguments>
+
+Options may also be set through FAKE_ENGINE_LATENCY, FAKE_ENGINE_JITTER,
+FAKE_ENGINE_STARTUP, FAKE_ENGINE_FAIL_RATE and FAKE_ENGINE_MODES.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+
+def parse_args(argv):
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description='Fake Uni-Dock for orchestration benchmarks.')
+    parser.add_argument('--latency', type=float, default=float(env('FAKE_ENGINE_LATENCY', 0.0)),
+                        help='seconds spent per ligand')
+    parser.add_argument('--jitter', type=float, default=float(env('FAKE_ENGINE_JITTER', 0.0)),
+                        help='relative random variation of the latency')
+    parser.add_argument('--startup', type=float, default=float(env('FAKE_ENGINE_STARTUP', 0.0)),
+                        help='seconds spent once per call (engine start-up)')
+    parser.add_argument('--fail-rate', type=float, default=float(env('FAKE_ENGINE_FAIL_RATE', 0.0)),
+                        help='share of ligands that produce no output')
+    parser.add_argument('--modes', type=int, default=int(env('FAKE_ENGINE_MODES', 0)),
+                        help='poses written per ligand (default: --num_modes)')
+    parser.add_argument('--seed', type=int, default=None)
+    # The Uni-Dock arguments the driver passes
+    parser.add_argument('--ligand_index', required=True)
+    parser.add_argument('--dir', required=True)
+    parser.add_argument('--num_modes', type=int, default=9)
+    # Rejected like the real engine rejects them, so a wrong name fails the benchmark
+    parser.add_argument('--search_mode', choices=('fast', 'balance', 'detail'), default='fast')
+    parser.add_argument('--scoring', choices=('vina', 'vinardo', 'ad4'), default='vina')
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def write_result(path, body, modes, rng):
+    score = -6.0 - rng.random() * 6.0
+    with open(path, 'w') as f:
+        for mode in range(1, modes + 1):
+            f.write(f'MODEL {mode}\nREMARK VINA RESULT: {score + 0.4 * (mode - 1):9.3f}      0.000      0.000\n')
+            f.write(body)
+            f.write('ENDMDL\n')
+
+
+def main(argv):
+    args = parse_args(argv[1:])
+    rng = random.Random(args.seed)
+    time.sleep(args.startup)
+
+    with open(args.ligand_index, 'r') as f:
+        ligands = [line.strip() for line in f if line.strip()]
+    modes = args.modes or args.num_modes
+    for path in ligands:
+        time.sleep(max(args.latency * (1 + args.jitter * (2 * rng.random() - 1)), 0.0))
+        if rng.random() < args.fail_rate:
+            continue
+        try:
+            with open(path, 'r') as f:
+                body = f.read()
+        except OSError:
+            continue
+        stem = os.path.splitext(os.path.basename(path))[0]
+        write_result(os.path.join(args.dir, f'{stem}_out.pdbqt'), body, modes, rng)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,310 @@
+"""
+Orchestration benchmarks.
+
+    python benchmarks/run.py [--scenario smoke|small|medium|large] [--output FILE]
+                             [--baseline FILE] [--tolerance 0.25] [--workdir DIR]
+
+A scenario generates a synthetic receptor and ligand library (synthetic.py),
+starts the app in a scratch workspace and drives it through the Flask test
+client the way the browser does: create a project, upload the receptor,
+generate the grid (cold, then warm), upload the ligands, save parameters, run
+a docking job against fake_engine.py while polling /run-status, and page
+through /results.  It records per-endpoint latency, upload throughput, the
+orchestration overhead of the run (wall time minus the time the fake engine
+spends per ligand and per call), ligand throughput and peak RSS, and writes
+them to a JSON file.
+
+Every metric is checked against the scenario's limits in thresholds.json and,
+with --baseline (the JSON of an earlier run), against that run: a metric may
+not get worse by more than --tolerance.  The exit status is 1 when a check
+fails.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import synthetic
+
+SCENARIOS = {
+    'smoke': {'receptor_atoms': 1000, 'ligands': 10, 'latency': 0.001, 'startup': 0.05},
+    'small': {'receptor_atoms': 10000, 'ligands': 1000, 'latency': 0.001, 'startup': 0.2},
+    'medium': {'receptor_atoms': 50000, 'ligands': 20000, 'latency': 0.0005, 'startup': 0.5},
+    'large': {'receptor_atoms': 200000, 'ligands': 1000000, 'latency': 0.0001, 'startup': 1.0},
+}
+
+# Libraries larger than this go through /lig_upload/bulk as one file
+MULTIPART_MAX_LIGANDS = 2000
+MULTIPART_BATCH = 200
+REPEATS = 20
+POLL_INTERVAL = 0.2
+RUN_TIMEOUT = 24 * 3600
+
+# Metrics compared with a baseline run; larger is better only for throughput
+COMPARED = (
+    'grid_cold_ms', 'grid_warm_p95_ms', 'grid_targeted_p95_ms', 'run_status_p95_ms', 'results_cold_ms',
+    'results_p95_ms', 'overhead_per_ligand_ms', 'peak_rss_server_mb', 'peak_rss_children_mb',
+    'lig_upload_mb_per_s', 'ligands_per_second',
+)
+HIGHER_IS_BETTER = {'lig_upload_mb_per_s', 'ligands_per_second'}
+# Changes smaller than this (by unit suffix) are timer noise, whatever the ratio
+NOISE_FLOOR = {'_ms': 5.0, '_mb': 10.0}
+
+THRESHOLDS_PATH = os.path.join(BENCH_DIR, 'thresholds.json')
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+class Timings:
+    """Latency samples per endpoint, in milliseconds."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def call(self, name, function, *args, **kwargs):
+        started = time.perf_counter()
+        response = function(*args, **kwargs)
+        self.samples.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{name} failed with {response.status_code}: {response.get_data(as_text=True)[:500]}')
+        return response
+
+    def summary(self):
+        return {
+            name: {'count': len(values), 'p50': round(percentile(values, 50), 3),
+                   'p95': round(percentile(values, 95), 3), 'max': round(max(values), 3)}
+            for name, values in self.samples.items()
+        }
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def upload_ligands(client, timings, library_dir, library_file, count):
+    started = time.perf_counter()
+    if count <= MULTIPART_MAX_LIGANDS:
+        paths = sorted(os.path.join(library_dir, name) for name in os.listdir(library_dir))
+        for start in range(0, len(paths), MULTIPART_BATCH):
+            files = [(open(p, 'rb'), os.path.basename(p)) for p in paths[start:start + MULTIPART_BATCH]]
+            try:
+                timings.call('lig_upload', client.post, '/lig_upload', data={'files[]': files},
+                             content_type='multipart/form-data')
+            finally:
+                for f, _ in files:
+                    f.close()
+        size = sum(os.path.getsize(p) for p in paths)
+    else:
+        size = os.path.getsize(library_file)
+        with open(library_file, 'rb') as f:
+            timings.call('lig_upload_bulk', client.post, '/lig_upload/bulk?filename=library.pdbqt',
+                         input_stream=f, content_length=size, content_type='application/octet-stream')
+    elapsed = time.perf_counter() - started
+    return round(size / (1024 * 1024) / elapsed, 2) if elapsed else None
+
+
+def run_scenario(name, workdir):
+    spec = SCENARIOS[name]
+    inputs = os.path.join(workdir, 'inputs')
+    os.makedirs(inputs, exist_ok=True)
+
+    generated = time.perf_counter()
+    receptor_path = synthetic.write_receptor(os.path.join(inputs, 'receptor.pdb'), spec['receptor_atoms'])
+    center = synthetic.receptor_center(spec['receptor_atoms'])
+    library_dir = library_file = None
+    if spec['ligands'] <= MULTIPART_MAX_LIGANDS:
+        library_dir = os.path.join(inputs, 'ligands')
+        synthetic.write_library(library_dir, spec['ligands'], center)
+    else:
+        library_file = synthetic.write_library_file(os.path.join(inputs, 'library.pdbqt'), spec['ligands'], center)
+    generate_seconds = time.perf_counter() - generated
+
+    # The app keeps its workspace relative to the working directory
+    os.environ['UNIDOCK_ENGINE'] = (f'{sys.executable} {os.path.join(BENCH_DIR, "fake_engine.py")} '
+                                    f'--latency {spec["latency"]} --startup {spec["startup"]} --seed 0')
+    os.chdir(workdir)
+    import app as unidock_app
+
+    client = unidock_app.app.test_client()
+    timings = Timings()
+    timings.call('create_project', client.post, '/create-project', json={'project_name': f'bench_{name}'})
+
+    with open(receptor_path, 'rb') as f:
+        response = timings.call('rec_upload', client.post, '/rec_upload', data={'file': (f, 'receptor.pdb')},
+                                content_type='multipart/form-data')
+    uploaded_receptor = response.get_json()['filepath']
+
+    grid = None
+    for repeat in range(REPEATS + 1):
+        # The first call parses the receptor; later ones hit the cache
+        response = timings.call('grid_cold' if repeat == 0 else 'grid_warm', client.post, '/grid',
+                                json={'filepath': uploaded_receptor, 'mode': 'blind'})
+        grid = response.get_json()['grid_dimensions']
+    for _ in range(REPEATS):
+        timings.call('grid_targeted', client.post, '/grid',
+                     json={'filepath': uploaded_receptor, 'mode': 'targeted', 'residues': ['A:10-40']})
+    timings.call('save_grid', client.post, '/save_grid', json={'filepath': uploaded_receptor, 'grid': grid})
+
+    upload_rate = upload_ligands(client, timings, library_dir, library_file, spec['ligands'])
+    timings.call('upload_params', client.post, '/upload-params',
+                 data={'search_mode': 'Fast', 'scoring_method': 'vina', 'num_modes': '9'})
+
+    run_started = time.perf_counter()
+    timings.call('run_docking', client.post, '/run-docking', json={'use_cache': False, 'resume': False})
+    status, log_offset = {}, 0
+    while time.perf_counter() - run_started < RUN_TIMEOUT:
+        # Poll like the browser: only the log text after the last offset
+        status = timings.call('run_status', client.get, f'/run-status?offset={log_offset}').get_json()
+        log_offset = status.get('offset', log_offset)
+        if status.get('status') in ('completed', 'error'):
+            break
+        time.sleep(POLL_INTERVAL)
+    run_wall = time.perf_counter() - run_started
+    # Child resource usage only counts once the job wrapper has been reaped
+    reap_deadline = time.time() + 30
+    while unidock_app.scheduler._wrappers and time.time() < reap_deadline:
+        unidock_app.scheduler.dispatch()
+        time.sleep(0.05)
+
+    for page in range(REPEATS + 1):
+        # The first page syncs the results index with the folder
+        timings.call('results_cold' if page == 0 else 'results', client.get, f'/results?limit=50&offset={page * 50}')
+    timings.call('metrics', client.get, '/metrics')
+
+    # Time the fake engine spends by design: per ligand, plus start-up per batch call
+    log_path = os.path.join(workdir, 'workspace', 'projects', f'bench_{name}', 'results', 'docking_run.log')
+    with open(log_path, 'r', errors='replace') as f:
+        calls = len(re.findall(r'^Batch \d+/\d+ finished', f.read(), re.MULTILINE))
+    progress = status.get('progress') or {}
+    docked = progress.get('ligands_completed', 0)
+    engine_seconds = spec['ligands'] * spec['latency'] + calls * spec['startup']
+    overhead = run_wall - engine_seconds
+
+    latency = timings.summary()
+    results = {
+        'status': status.get('status'),
+        'ligands_docked': docked,
+        'engine_calls': calls,
+        'generate_seconds': round(generate_seconds, 2),
+        'rec_upload_ms': latency['rec_upload']['p50'],
+        'grid_cold_ms': latency['grid_cold']['max'],
+        'grid_warm_p95_ms': latency['grid_warm']['p95'],
+        'grid_targeted_p95_ms': latency['grid_targeted']['p95'],
+        'lig_upload_mb_per_s': upload_rate,
+        'run_docking_ms': latency['run_docking']['p50'],
+        'run_status_p95_ms': latency['run_status']['p95'],
+        'results_cold_ms': latency['results_cold']['max'],
+        'results_p95_ms': latency['results']['p95'],
+        'run_wall_seconds': round(run_wall, 2),
+        'engine_seconds': round(engine_seconds, 2),
+        'orchestration_overhead_seconds': round(overhead, 2),
+        'overhead_per_ligand_ms': round(overhead / max(spec['ligands'], 1) * 1000, 3),
+        'ligands_per_second': round(docked / run_wall, 2) if run_wall else None,
+        'peak_rss_server_mb': peak_rss_mb(resource.RUSAGE_SELF),
+        'peak_rss_children_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+    return {'scenario': name, 'spec': spec, 'results': results, 'latency_ms': latency}
+
+
+def check(report, thresholds, baseline=None, tolerance=0.25):
+    """Failed checks: limits from thresholds.json, then regressions against a baseline run."""
+    failures = []
+    results = report['results']
+    for metric, limit in thresholds.get(report['scenario'], {}).items():
+        value = results.get(metric)
+        if value is None:
+            continue
+        if 'max' in limit and value > limit['max']:
+            failures.append(f'{metric} = {value} exceeds the limit {limit["max"]}')
+        if 'min' in limit and value < limit['min']:
+            failures.append(f'{metric} = {value} is below the limit {limit["min"]}')
+
+    if baseline and baseline.get('scenario') == report['scenario']:
+        for metric in COMPARED:
+            before, value = baseline['results'].get(metric), results.get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(before, (int, float)) or before <= 0:
+                continue
+            floor = next((f for suffix, f in NOISE_FLOOR.items() if metric.endswith(suffix)), 0.0)
+            if abs(value - before) <= floor:
+                continue
+            if metric in HIGHER_IS_BETTER and value < before * (1 - tolerance):
+                failures.append(f'{metric} dropped from {before} to {value}')
+            elif metric not in HIGHER_IS_BETTER and value > before * (1 + tolerance):
+                failures.append(f'{metric} grew from {before} to {value}')
+    if results.get('status') != 'completed':
+        failures.append(f'docking run ended as {results.get("status")}')
+    return failures
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the docking orchestration with synthetic inputs.')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='smoke')
+    parser.add_argument('--output', help='JSON file for the results (default: benchmark_<scenario>.json)')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression (default 0.25)')
+    parser.add_argument('--workdir', help='scratch directory (default: a temporary one, removed afterwards)')
+    args = parser.parse_args(argv[1:])
+
+    output = os.path.abspath(args.output or f'benchmark_{args.scenario}.json')
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='unidock_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    try:
+        report = run_scenario(args.scenario, workdir)
+    except BaseException:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+        raise
+    finally:
+        os.chdir(cwd)
+
+    report.update(revision=git_revision(), python=platform.python_version(), platform=platform.platform(),
+                  timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    with open(THRESHOLDS_PATH, 'r') as f:
+        thresholds = json.load(f)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    report['failures'] = check(report, thresholds, baseline, args.tolerance)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for metric, value in report['results'].items():
+        print(f'{metric:32} {value}')
+    for failure in report['failures']:
+        print(f'FAIL {failure}')
+    print(f'Results written to {output}')
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if report['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
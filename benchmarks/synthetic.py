@@ -0,0 +1,195 @@
+"""
+Synthetic inputs for the benchmarks: PDB receptors and PDBQT ligand libraries.
+
+    python benchmarks/synthetic.py receptor <out.pdb> <atoms>
+    python benchmarks/synthetic.py library <out_dir> <count>
+
+Receptors are chains of real residue types along a random walk folded into a
+cube of protein-like density, so parsing, residue selection, box sizing and
+pocket detection see realistic input.  Ligands are valid PDBQT with a ROOT,
+one BRANCH per torsion and polar hydrogens; sizes and torsion counts vary
+across the library the way a screening deck does.  Everything is seeded.
+"""
+import os
+import sys
+
+import numpy as np
+
+# Heavy atoms of each residue after the backbone N, CA, C, O
+SIDE_CHAINS = {
+    'GLY': (),
+    'ALA': ('CB',),
+    'SER': ('CB', 'OG'),
+    'CYS': ('CB', 'SG'),
+    'VAL': ('CB', 'CG1', 'CG2'),
+    'THR': ('CB', 'OG1', 'CG2'),
+    'LEU': ('CB', 'CG', 'CD1', 'CD2'),
+    'ILE': ('CB', 'CG1', 'CG2', 'CD1'),
+    'ASP': ('CB', 'CG', 'OD1', 'OD2'),
+    'ASN': ('CB', 'CG', 'OD1', 'ND2'),
+    'GLU': ('CB', 'CG', 'CD', 'OE1', 'OE2'),
+    'LYS': ('CB', 'CG', 'CD', 'CE', 'NZ'),
+    'MET': ('CB', 'CG', 'SD', 'CE'),
+    'PHE': ('CB', 'CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ'),
+    'ARG': ('CB', 'CG', 'CD', 'NE', 'CZ', 'NH1', 'NH2'),
+    'HIS': ('CB', 'CG', 'ND1', 'CD2', 'CE1', 'NE2'),
+}
+RESIDUES = tuple(SIDE_CHAINS)
+BACKBONE = ('N', 'CA', 'C', 'O')
+CHAIN_IDS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+MAX_CHAIN_RESIDUES = 9999
+
+# Roughly 1.4 heavy atoms per 20 A^3 in a folded protein
+ATOM_VOLUME = 14.0
+CA_STEP = 3.8
+
+LIGAND_TYPES = ('C', 'C', 'C', 'A', 'A', 'N', 'NA', 'OA', 'OA', 'S', 'F', 'Cl')
+
+
+def _atom_line(serial, name, resname, chain, resseq, x, y, z, element):
+    name = name if len(name) == 4 else f' {name:<3}'
+    return (f'ATOM  {serial % 100000:5d} {name:<4} {resname:>3} {chain}{resseq:4d}    '
+            f'{x:8.3f}{y:8.3f}{z:8.3f}  1.00 20.00          {element:>2}')
+
+
+def receptor_lines(atoms, seed=0):
+    """PDB lines of a synthetic protein with about `atoms` heavy atoms."""
+    rng = np.random.default_rng(seed)
+    mean_size = np.mean([len(BACKBONE) + len(SIDE_CHAINS[r]) for r in RESIDUES])
+    n_residues = max(int(atoms / mean_size), 1)
+    residues = rng.choice(len(RESIDUES), n_residues)
+
+    # CA trace: a random walk with CA_STEP steps, reflected into the cube
+    side = (atoms * ATOM_VOLUME) ** (1 / 3)
+    steps = rng.normal(size=(n_residues, 3))
+    steps *= CA_STEP / np.linalg.norm(steps, axis=1, keepdims=True)
+    trace = np.cumsum(steps, axis=0) + side / 2
+    trace = np.abs(np.mod(trace, 2 * side) - side)
+
+    lines, serial = [], 1
+    for i, residue in enumerate(residues.tolist()):
+        resname = RESIDUES[residue]
+        chain = CHAIN_IDS[(i // MAX_CHAIN_RESIDUES) % len(CHAIN_IDS)]
+        resseq = i % MAX_CHAIN_RESIDUES + 1
+        names = BACKBONE + SIDE_CHAINS[resname]
+        # Atoms scatter around the CA within about a residue's radius
+        coords = trace[i] + rng.normal(0.0, 1.5, (len(names), 3))
+        coords[1] = trace[i]
+        for name, (x, y, z) in zip(names, coords.tolist()):
+            lines.append(_atom_line(serial, name, resname, chain, resseq, x, y, z, name[0]))
+            serial += 1
+    lines.append('END')
+    return lines
+
+
+def write_receptor(path, atoms, seed=0):
+    with open(path, 'w') as f:
+        f.write('\n'.join(receptor_lines(atoms, seed)) + '\n')
+    return path
+
+
+def receptor_center(atoms):
+    side = (atoms * ATOM_VOLUME) ** (1 / 3)
+    return (side / 2, side / 2, side / 2)
+
+
+def _atom_name(element, i):
+    name = f'{element}{i + 1}'[:4]
+    return name if len(name) == 4 else f' {name}'
+
+
+def ligand_text(name, heavy, torsions, center=(0.0, 0.0, 0.0), seed=0, rng=None):
+    """One PDBQT ligand with `heavy` heavy atoms and `torsions` rotatable bonds."""
+    rng = rng if rng is not None else np.random.default_rng(seed)
+    torsions = min(torsions, heavy - 1)
+    coords = (np.asarray(center) + np.cumsum(rng.normal(0.0, 0.9, (heavy, 3)), axis=0) * 0.6).tolist()
+    charges = rng.normal(0.0, 0.2, heavy).tolist()
+    types = [LIGAND_TYPES[i] for i in rng.integers(0, len(LIGAND_TYPES), heavy).tolist()]
+    root_size = heavy - torsions
+
+    # Serial number of each heavy atom; polar hydrogens follow their heavy atom
+    records, serials, serial = [], [], 0
+    for i in range(heavy):
+        ad_type = types[i]
+        x, y, z = coords[i]
+        element = ad_type[0] if ad_type in ('A', 'NA', 'OA') else ad_type
+        serial += 1
+        serials.append(serial)
+        atom_lines = [f'ATOM  {serial:5d} {_atom_name(element, i):<4} UNL     1    '
+                      f'{x:8.3f}{y:8.3f}{z:8.3f}  0.00  0.00    {charges[i]:+6.3f} {ad_type:<2}']
+        if ad_type in ('OA', 'N'):
+            serial += 1
+            atom_lines.append(f'ATOM  {serial:5d} {_atom_name("H", i):<4} UNL     1    '
+                              f'{x + 0.97:8.3f}{y:8.3f}{z:8.3f}  0.00  0.00    +0.200 HD')
+        records.append(atom_lines)
+
+    lines = [f'REMARK  Name = {name}', f'REMARK  {torsions} active torsions:', 'ROOT']
+    for i in range(root_size):
+        lines.extend(records[i])
+    lines.append('ENDROOT')
+    # One atom per torsion, each branch nested in the previous one
+    bonds = [(serials[i - 1], serials[i]) for i in range(root_size, heavy)]
+    for i, (parent, child) in zip(range(root_size, heavy), bonds):
+        lines.append(f'BRANCH {parent:3d} {child:3d}')
+        lines.extend(records[i])
+    for parent, child in reversed(bonds):
+        lines.append(f'ENDBRANCH {parent:3d} {child:3d}')
+    lines.append(f'TORSDOF {torsions}')
+    return '\n'.join(lines) + '\n'
+
+
+def library_sizes(count, seed=0):
+    """Heavy-atom and torsion counts of a library: drug-like spread, 8-50 atoms, 0-15 torsions."""
+    rng = np.random.default_rng(seed)
+    heavy = np.clip(rng.normal(26, 8, count), 8, 50).astype(int)
+    torsions = np.clip(rng.poisson(5, count), 0, 15)
+    return heavy, torsions
+
+
+def ligand_name(i):
+    return f'lig{i:07d}'
+
+
+def iter_library(count, center=(0.0, 0.0, 0.0), seed=0):
+    """(name, PDBQT text) of every ligand of a synthetic library."""
+    heavy, torsions = library_sizes(count, seed)
+    rng = np.random.default_rng(seed + 1)
+    for i in range(count):
+        yield ligand_name(i), ligand_text(ligand_name(i), int(heavy[i]), int(torsions[i]), center, rng=rng)
+
+
+def write_library(ligand_dir, count, center=(0.0, 0.0, 0.0), seed=0, shard_size=10000):
+    """One file per ligand, in shard subfolders of `shard_size` like a bulk upload."""
+    paths = []
+    for i, (name, text) in enumerate(iter_library(count, center, seed)):
+        folder = ligand_dir if count <= shard_size else os.path.join(ligand_dir, f'shard_{i // shard_size:04d}')
+        if i % shard_size == 0:
+            os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f'{name}.pdbqt')
+        with open(path, 'w') as f:
+            f.write(text)
+        paths.append(path)
+    return paths
+
+
+def write_library_file(path, count, center=(0.0, 0.0, 0.0), seed=0):
+    """All ligands concatenated into one multi-molecule PDBQT (a bulk upload)."""
+    with open(path, 'w') as f:
+        for _, text in iter_library(count, center, seed):
+            f.write(text)
+    return path
+
+
+def main(argv):
+    if len(argv) != 4 or argv[1] not in ('receptor', 'library'):
+        print('usage: synthetic.py receptor <out.pdb> <atoms> | library <out_dir> <count>', file=sys.stderr)
+        return 2
+    if argv[1] == 'receptor':
+        write_receptor(argv[2], int(argv[3]))
+    else:
+        write_library(argv[2], int(argv[3]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,156 @@
+"""
+Streaming hit-list export.
+
+Poses come from the results index in score order and are turned into CSV
+rows, concatenated PDBQT models or SDF records one at a time; the output is
+gathered into chunks of about CHUNK_SIZE bytes and optionally gzip-compressed
+on the fly, so an export of any length uses constant memory and the download
+starts with the first chunk.
+"""
+import os
+import csv
+import io
+import zlib
+
+import numpy as np
+
+import pdbqt
+from ligand_index import AD_TYPE_ELEMENTS
+from result_store import read_member, read_result
+
+CHUNK_SIZE = 64 * 1024
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'pdbqt': ('chemical/x-pdbqt', 'pdbqt'),
+    'sdf': ('chemical/x-mdl-sdfile', 'sdf'),
+}
+
+# Covalent radii (Angstrom) used to perceive bonds from distances
+COVALENT_RADII = {
+    'H': 0.31, 'B': 0.84, 'C': 0.76, 'N': 0.71, 'O': 0.66, 'F': 0.57, 'Si': 1.11, 'P': 1.07,
+    'S': 1.05, 'Cl': 1.02, 'Br': 1.20, 'I': 1.39, 'Se': 1.20, 'Fe': 1.32, 'Zn': 1.22,
+    'Mg': 1.41, 'Ca': 1.76, 'Mn': 1.39,
+}
+BOND_TOLERANCE = 0.45
+
+
+def read_pose(results_dir, pose):
+    """Text of one pose, read by its byte range in the result file (loose or packed, see result_store.py)."""
+    try:
+        with open(os.path.join(results_dir, pose['file']), 'rb') as f:
+            f.seek(pose['offset'])
+            data = f.read(pose['length'])
+    except FileNotFoundError:
+        if pose.get('packed'):
+            data = read_member(results_dir, *pose['packed'])
+        else:
+            data = read_result(results_dir, pose['file'])
+        data = data[pose['offset']:pose['offset'] + pose['length']]
+    return data.decode('utf-8', errors='replace')
+
+
+def pose_atoms(text):
+    """(elements, (N, 3) coordinates) of the atoms in a PDBQT pose."""
+    lines = [line for line in text.splitlines() if pdbqt.is_atom_line(line)]
+    elements = []
+    for line in lines:
+        fields = line.split()
+        ad_type = fields[-1].upper() if fields else 'C'
+        elements.append(AD_TYPE_ELEMENTS.get(ad_type, ad_type.capitalize()))
+    return elements, pdbqt.atom_coords(lines)
+
+
+def perceive_bonds(elements, coords):
+    """Atom pairs (0-based) closer than the sum of their covalent radii plus a tolerance."""
+    if len(coords) < 2:
+        return []
+    radii = np.asarray([COVALENT_RADII.get(e, 0.77) for e in elements])
+    diff = coords[:, None, :] - coords[None, :, :]
+    dist = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+    bonded = (dist > 0.4) & (dist <= radii[:, None] + radii[None, :] + BOND_TOLERANCE)
+    i, j = np.nonzero(np.triu(bonded, 1))
+    return list(zip(i.tolist(), j.tolist()))
+
+
+def pose_to_sdf(text, name, properties):
+    """One SDF record (V2000, single bonds only) for a PDBQT pose."""
+    elements, coords = pose_atoms(text)
+    bonds = perceive_bonds(elements, coords)
+    lines = [name, '  GUI_unidock', '', f'{len(elements):3d}{len(bonds):3d}  0  0  0  0  0  0  0  0999 V2000']
+    for element, (x, y, z) in zip(elements, coords):
+        lines.append(f'{x:10.4f}{y:10.4f}{z:10.4f} {element:<3} 0  0  0  0  0  0  0  0  0  0  0  0')
+    for i, j in bonds:
+        lines.append(f'{i + 1:3d}{j + 1:3d}  1  0')
+    lines.append('M  END')
+    for key, value in properties.items():
+        lines += [f'> <{key}>', str(value), '']
+    lines.append('$$$$')
+    return '\n'.join(lines) + '\n'
+
+
+def csv_rows(poses):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['hit', 'ligand', 'pose_rank', 'score', 'file'])
+    for number, pose in enumerate(poses, start=1):
+        writer.writerow([number, pose['ligand'], pose['rank'], pose['score'], pose['file']])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def model_block(text, pose):
+    """A pose as one MODEL block named after its ligand and rank."""
+    if not text.startswith('MODEL'):
+        text = 'MODEL\n' + text + 'ENDMDL\n'
+    # Name the pose so concatenated models stay readable
+    first, rest = text.split('\n', 1)
+    return f'{first}\nREMARK  Name = {pose["ligand"]} pose {pose["rank"]}\n{rest}'
+
+
+def pdbqt_records(results_dir, poses):
+    for pose in poses:
+        try:
+            text = read_pose(results_dir, pose)
+        except OSError:
+            continue
+        yield model_block(text, pose)
+
+
+def sdf_records(results_dir, poses):
+    for pose in poses:
+        try:
+            text = read_pose(results_dir, pose)
+        except OSError:
+            continue
+        yield pose_to_sdf(text, pose['ligand'], {'score': pose['score'], 'pose_rank': pose['rank']})
+
+
+def export_chunks(results_dir, poses, export_format, compress=False):
+    """Encoded output chunks of `poses` in `export_format`."""
+    if export_format == 'csv':
+        records = csv_rows(poses)
+    elif export_format == 'sdf':
+        records = sdf_records(results_dir, poses)
+    else:
+        records = pdbqt_records(results_dir, poses)
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    pending, size = [], 0
+    for record in records:
+        data = record.encode()
+        pending.append(data)
+        size += len(data)
+        if size >= CHUNK_SIZE:
+            chunk = b''.join(pending)
+            pending, size = [], 0
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+    chunk = b''.join(pending)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
@@ -0,0 +1,98 @@
+"""
+Docking box sizing and search-parameter tuning.
+
+Search cost grows with the box volume, so besides the classic fixed-buffer box
+the grid can be sized from the ligand library: just large enough to hold the
+largest uploaded ligand around the chosen site.  The box volume then drives a
+recommended Uni-Dock search mode and number of output modes.
+"""
+import os
+
+import numpy as np
+
+import ligand_index
+from unidock_multi import engine_search_mode
+
+# Classic box: site bounding box plus this buffer on every side (A)
+BUFFER = 5.0
+# Ligand-fitted box: extra room on every side beyond the ligand extent (A)
+FIT_MARGIN = 2.0
+
+# Relative cost of each search mode (exhaustiveness x max_step in Uni-Dock)
+SEARCH_COST = {'fast': 1.0, 'balance': 6.0, 'detail': 8.0}
+# Volume of a 22.5 A cube searched in Fast mode counts as a cost of 1.0
+REFERENCE_VOLUME = 22.5 ** 3
+
+# (upper volume in A^3, search mode, num_modes); larger boxes need a more
+# thorough search to sample them as well as a small one
+TUNING = [
+    (30.0 ** 3, 'Fast', 5),
+    (40.0 ** 3, 'Balanced', 9),
+    (float('inf'), 'Detail', 9),
+]
+
+def grid_dimensions(center, size):
+    return {
+        'center_x': float(center[0]),
+        'center_y': float(center[1]),
+        'center_z': float(center[2]),
+        'size_x': float(size[0]),
+        'size_y': float(size[1]),
+        'size_z': float(size[2]),
+    }
+
+
+def buffer_box(coords, buffer=BUFFER):
+    """Bounding box of `coords` grown by `buffer` on every side."""
+    min_coords = coords.min(axis=0) - buffer
+    max_coords = coords.max(axis=0) + buffer
+    return (min_coords + max_coords) / 2, max_coords - min_coords
+
+
+def ligand_fit_box(coords, ligand_extent, margin=FIT_MARGIN):
+    """
+    Smallest box around the site that still fits the largest ligand: each side
+    spans the site and is at least one ligand extent wide, plus `margin`.
+    """
+    min_coords = coords.min(axis=0)
+    max_coords = coords.max(axis=0)
+    center = (min_coords + max_coords) / 2
+    size = np.maximum(max_coords - min_coords, ligand_extent) + 2 * margin
+    return center, size
+
+
+def library_extent(ligand_dir):
+    """
+    Largest atom-to-atom extent over the ligands of `ligand_dir`, from the
+    extent column of its library index (ligand_index.py); None if it has none.
+    """
+    index = ligand_index.load(ligand_dir)
+    unknown = index.unknown_extent()
+    if unknown:
+        # Ligands indexed before extents were recorded are indexed again, once
+        ligand_index.add_files(ligand_dir, [p for p in (os.path.join(ligand_dir, rel) for rel in unknown)
+                                            if os.path.exists(p)])
+        index = ligand_index.load(ligand_dir)
+    return index.max_extent()
+
+
+def box_volume(grid):
+    return float(grid['size_x'] * grid['size_y'] * grid['size_z'])
+
+
+def relative_cost(volume, search_mode):
+    return volume / REFERENCE_VOLUME * SEARCH_COST[engine_search_mode(search_mode)]
+
+
+def recommend_search(grid):
+    """Recommended search mode and num_modes for a box, with its relative cost."""
+    volume = box_volume(grid)
+    for limit, search_mode, num_modes in TUNING:
+        if volume <= limit:
+            break
+    return {
+        'box_volume': round(volume, 1),
+        'search_mode': search_mode,
+        'num_modes': num_modes,
+        'relative_cost': round(relative_cost(volume, search_mode), 2),
+    }
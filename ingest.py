@@ -0,0 +1,460 @@
+"""
+Streaming bulk ligand ingestion.
+
+A ligand library arrives as one request body: a .tar.gz/.tgz/.tar or .zip
+archive, or a concatenated multi-molecule PDBQT or SDF file (optionally
+gzipped).  The body is read in chunks and split into single molecules on the
+fly; each molecule is validated and written by a worker pool into sharded
+subdirectories of the project's `ligand/` folder
+
+    ligand/shard_0000/<name>_00000000.pdbqt
+    ligand/shard_0001/...
+
+with at most SHARD_SIZE files per shard.  Only a bounded number of molecules
+is in flight at any time, so memory use does not grow with the library.
+Zip archives need random access and are spooled to a temporary file first.
+Written molecules are added to the library index (ligand_index.py) as they go.
+
+Validation is pure-Python parsing, which threads cannot run in parallel.  A
+small upload is handled by a thread pool, which starts at once; once an upload
+passes PROCESS_THRESHOLD molecules, its further batches go to a process pool
+shared by all uploads (`shared_pool`, which ligand_prep.py uses too).
+
+File names carry a running number kept in `ligand/.ingest.json`, which keeps
+them unique across uploads (results are named after the ligand file).
+"""
+import os
+import json
+import gzip
+import hashlib
+import zlib
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.utils import secure_filename
+
+try:
+    import fcntl
+except ImportError:
+    # Without flock uploads are only serialized within one process
+    fcntl = None
+
+import pdbqt
+import ligand_index
+
+CHUNK_SIZE = 1024 * 1024
+SHARD_SIZE = 10000
+# Molecules handed to a worker at once, and batches in flight per worker
+TASK_SIZE = 256
+TASKS_PER_WORKER = 2
+# Molecules of an upload validated in threads before its batches go to processes
+PROCESS_THRESHOLD = 4 * TASK_SIZE
+# Larger molecules (or lines without a newline) are rejected
+MAX_MOLECULE_BYTES = 4 * 1024 * 1024
+# Error messages returned to the client
+MAX_REPORTED_ERRORS = 20
+
+STATE_FILE = '.ingest.json'
+LOCK_FILE = '.ingest.lock'
+
+_dir_locks = {}
+_dir_locks_guard = threading.Lock()
+
+# Process pools of this process by name, with the settings they were started with
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class IngestError(ValueError):
+    pass
+
+
+class IngestBusy(IngestError):
+    """Another upload is being ingested into the same folder."""
+
+
+def default_workers():
+    return max(1, min(8, os.cpu_count() or 1))
+
+
+def shared_pool(name, workers, initializer=None, initargs=(), preload=()):
+    """
+    Process pool `name` of this process, started on first use (or when its
+    settings change).  The forkserver method is used where there is one: the
+    workers are not forked from the threaded server, and the `preload` modules
+    are imported once, in the fork server.
+    """
+    key = (workers, initializer, initargs)
+    with _pools_lock:
+        pool, pool_key = _pools.get(name, (None, None))
+        if pool is None or pool_key != key:
+            if pool is not None:
+                # Batches already submitted to the old pool still finish
+                pool.shutdown(wait=False)
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(list(preload))
+            else:
+                context = multiprocessing.get_context('spawn')
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                       initializer=initializer, initargs=initargs)
+            _pools[name] = (pool, key)
+        return pool
+
+
+def drop_pool(name, pool):
+    """Forget a broken pool; the next caller of shared_pool gets a new one."""
+    with _pools_lock:
+        if _pools.get(name, (None, None))[0] is pool:
+            del _pools[name]
+    pool.shutdown(wait=False)
+
+
+def split_format(filename):
+    """(container, molecule format) from an upload's file name."""
+    name = filename.lower()
+    if name.endswith(('.tar.gz', '.tgz')):
+        return 'tar.gz', None
+    if name.endswith('.tar'):
+        return 'tar', None
+    if name.endswith('.zip'):
+        return 'zip', None
+    compressed = name.endswith('.gz')
+    if compressed:
+        name = name[:-3]
+    molecule_format = ligand_index.MOLECULE_FORMATS.get(os.path.splitext(name)[1])
+    if molecule_format is None:
+        raise IngestError('Unsupported file type. Allowed: .tar.gz, .tgz, .tar, .zip, .pdbqt, .sdf (optionally .gz).')
+    return ('gz' if compressed else None), molecule_format
+
+
+def member_format(name):
+    return ligand_index.MOLECULE_FORMATS.get(os.path.splitext(name.lower())[1])
+
+
+def iter_lines(stream):
+    """Lines of a binary stream, read in CHUNK_SIZE pieces."""
+    partial = b''
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        lines = (partial + chunk).split(b'\n')
+        partial = lines.pop()
+        if len(partial) > MAX_MOLECULE_BYTES:
+            raise IngestError('Input contains an over-long line; is it a text file?')
+        for line in lines:
+            yield line.decode('utf-8', errors='replace') + '\n'
+    if partial:
+        yield partial.decode('utf-8', errors='replace') + '\n'
+
+
+def split_molecules(lines, molecule_format):
+    """
+    Yield (name, text) for each molecule in a stream of lines.  SDF records end
+    at "$$$$"; PDBQT ligands are delimited by MODEL/ENDMDL or end at TORSDOF;
+    SMILES files hold one "SMILES [name]" per line.  Over-sized molecules are
+    yielded with text None.
+    """
+    if molecule_format == 'smi':
+        for line in lines:
+            fields = line.split(None, 1)
+            # Blank lines, comments and a "smiles name" header carry no molecule
+            if fields and not fields[0].startswith('#') and fields[0].lower() != 'smiles':
+                yield (fields[1].strip() if len(fields) > 1 else ''), line
+        return
+
+    current, size, name = [], 0, ''
+
+    def emit():
+        text = ''.join(current) if size <= MAX_MOLECULE_BYTES else None
+        return name, text
+
+    for line in lines:
+        if molecule_format == 'sdf':
+            if line.startswith('$$$$'):
+                yield emit()
+                current, size, name = [], 0, ''
+                continue
+            if not current:
+                name = line.strip()
+        else:
+            if line.startswith('MODEL') or line.startswith('ENDMDL'):
+                if any(pdbqt.is_atom_line(l) for l in current):
+                    yield emit()
+                current, size, name = [], 0, ''
+                continue
+            if line.startswith('REMARK') and 'Name =' in line:
+                name = line.split('Name =', 1)[1].strip()
+
+        size += len(line)
+        if size <= MAX_MOLECULE_BYTES:
+            current.append(line)
+
+        if molecule_format == 'pdbqt' and line.startswith('TORSDOF'):
+            yield emit()
+            current, size, name = [], 0, ''
+
+    if any(l.strip() for l in current):
+        yield emit()
+
+
+def validate_pdbqt(text):
+    lines = text.splitlines()
+    atoms = [line for line in lines if pdbqt.is_atom_line(line)]
+    if not atoms:
+        return 'no ATOM/HETATM records'
+    try:
+        pdbqt.atom_coords(atoms)
+    except ValueError:
+        return 'unreadable atom coordinates'
+    branches = sum(1 for line in lines if line.startswith('BRANCH'))
+    if branches != sum(1 for line in lines if line.startswith('ENDBRANCH')):
+        return 'unbalanced BRANCH/ENDBRANCH records'
+    return None
+
+
+def validate_sdf(text):
+    lines = text.splitlines()
+    if len(lines) < 4 or not any(line.startswith('M  END') for line in lines):
+        return 'incomplete molfile (no counts line or M  END)'
+    counts = lines[3]
+    if 'V3000' in counts:
+        return None if any('BEGIN ATOM' in line for line in lines) else 'V3000 molfile without atom block'
+    try:
+        natoms = int(counts[0:3])
+        int(counts[3:6])
+    except ValueError:
+        return 'unreadable counts line'
+    if natoms == 0 or len(lines) < 4 + natoms:
+        return 'no atoms'
+    try:
+        for line in lines[4:4 + natoms]:
+            float(line[0:10]), float(line[10:20]), float(line[20:30])
+    except ValueError:
+        return 'unreadable atom block'
+    return None
+
+
+VALIDATORS = {'pdbqt': validate_pdbqt, 'sdf': validate_sdf}
+
+
+def _write_batch(batch):
+    """Validate, write and describe one batch of molecules; returns (errors, index rows)."""
+    errors, rows = [], []
+    for path, rel_path, label, molecule_format, text in batch:
+        if text is None:
+            errors.append(f'{label}: larger than {MAX_MOLECULE_BYTES} bytes')
+            continue
+        problem = VALIDATORS[molecule_format](text)
+        if problem:
+            errors.append(f'{label}: {problem}')
+            continue
+        data = text.encode()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        heavy, torsions, mask, extent = ligand_index.describe(text, molecule_format)
+        rows.append(ligand_index.row(rel_path, heavy, torsions, mask, hashlib.sha256(data).digest(), 0, len(data),
+                                     extent, os.stat(path).st_mtime_ns))
+    return errors, rows
+
+
+class LigandIngest:
+    # Batches are written by _write_batch, in threads and past
+    # process_threshold molecules in the shared 'ingest' process pool;
+    # ligand_prep.py swaps in preparation, all in processes.  Molecules are
+    # stored in their own format unless output_format is set.
+    _task = staticmethod(_write_batch)
+    output_format = None
+    process_threshold = PROCESS_THRESHOLD
+
+    def __init__(self, ligand_dir, workers=None):
+        self.ligand_dir = ligand_dir
+        self.workers = workers or default_workers()
+        self.state_path = os.path.join(ligand_dir, STATE_FILE)
+        self.molecules = 0
+        self.invalid = 0
+        self.errors = []
+        self.skipped = []
+        self.shards = set()
+        self._batch = []
+        self._futures = set()
+        # Index rows of the written molecules (see ligand_index.py)
+        self._index = ligand_index.IndexWriter(ligand_dir)
+        self.formats = {}
+        self._seq = 0
+        self._pool = None
+        self._process_pool = None
+
+    def _load_seq(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                return int(json.load(f).get('next_seq', 0))
+        except (OSError, ValueError):
+            return 0
+
+    def _save_seq(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'next_seq': self._seq}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def run(self, stream, filename):
+        container, molecule_format = self._upload_format(filename)
+        os.makedirs(self.ligand_dir, exist_ok=True)
+        with _dir_lock(self.ligand_dir):
+            try:
+                return self._run(stream, filename, container, molecule_format)
+            except BrokenProcessPool:
+                if self._process_pool is None:
+                    raise
+                # A worker died; the next upload gets a new pool
+                drop_pool('ingest', self._process_pool)
+                raise IngestError('A validation worker crashed; the upload was stopped part way.')
+
+    def _run(self, stream, filename, container, molecule_format):
+        self._seq = self._load_seq()
+        try:
+            with self._executor() as pool:
+                self._pool = pool
+                try:
+                    if container in ('tar.gz', 'tar'):
+                        self._read_tar(stream, 'r|gz' if container == 'tar.gz' else 'r|')
+                    elif container == 'zip':
+                        self._read_zip(stream)
+                    elif container == 'gz':
+                        self._read_molecules(gzip.GzipFile(fileobj=stream, mode='rb'), molecule_format, filename)
+                    else:
+                        self._read_molecules(stream, molecule_format, filename)
+                    self._flush()
+                finally:
+                    self._drain(0)
+                    self._index.flush()
+                    self._save_seq()
+        except (tarfile.TarError, zipfile.BadZipFile, gzip.BadGzipFile, zlib.error, EOFError) as e:
+            raise IngestError(f'Could not read {filename}: {e}')
+        return self.summary()
+
+    def _upload_format(self, filename):
+        return split_format(filename)
+
+    def _executor(self):
+        return ThreadPoolExecutor(max_workers=self.workers)
+
+    def _read_tar(self, stream, mode):
+        with tarfile.open(fileobj=stream, mode=mode) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                molecule_format = member_format(member.name)
+                if molecule_format is None or os.path.basename(member.name).startswith('.'):
+                    self.skipped.append(member.name)
+                    continue
+                self._read_molecules(tar.extractfile(member), molecule_format, member.name)
+
+    def _read_zip(self, stream):
+        # Zip keeps its directory at the end of the file, so it cannot be read
+        # as a stream; spool it to disk in chunks instead of holding it in memory
+        with tempfile.TemporaryFile(dir=self.ligand_dir) as spool:
+            shutil.copyfileobj(stream, spool, CHUNK_SIZE)
+            spool.seek(0)
+            with zipfile.ZipFile(spool) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    molecule_format = member_format(info.filename)
+                    if molecule_format is None or os.path.basename(info.filename).startswith('.'):
+                        self.skipped.append(info.filename)
+                        continue
+                    with archive.open(info) as member:
+                        self._read_molecules(member, molecule_format, info.filename)
+
+    def _read_molecules(self, stream, molecule_format, source):
+        source_stem = secure_filename(os.path.splitext(os.path.basename(source))[0])
+        extension = '.' + (self.output_format or molecule_format)
+        for index, (name, text) in enumerate(split_molecules(iter_lines(stream), molecule_format), start=1):
+            stem = secure_filename(name)[:60] or source_stem or 'mol'
+            shard = f'shard_{self._seq // SHARD_SIZE:04d}'
+            file_name = f'{stem}_{self._seq:08d}{extension}'
+            self.shards.add(shard)
+            self._seq += 1
+            self.molecules += 1
+            self.formats[molecule_format] = self.formats.get(molecule_format, 0) + 1
+            self._batch.append((os.path.join(self.ligand_dir, shard, file_name), f'{shard}/{file_name}',
+                                f'{source} #{index}', molecule_format, text))
+            if len(self._batch) >= TASK_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if not self._batch:
+            return
+        self._drain(self.workers * TASKS_PER_WORKER - 1)
+        pool = self._pool
+        if self.process_threshold is not None and self.molecules > self.process_threshold:
+            if self._process_pool is None:
+                self._process_pool = shared_pool('ingest', self.workers, preload=[__name__])
+            pool = self._process_pool
+        self._futures.add(pool.submit(self._task, self._batch))
+        self._batch = []
+
+    def _drain(self, max_pending):
+        # Wait until at most `max_pending` batches are in flight
+        while len(self._futures) > max_pending:
+            finished, self._futures = wait(self._futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                self._collect(future.result())
+
+    def _collect(self, result):
+        errors, rows = result
+        self._index.extend(rows)
+        self.invalid += len(errors)
+        self.errors.extend(errors[:MAX_REPORTED_ERRORS - len(self.errors)])
+
+    def summary(self):
+        return {
+            'molecules': self.molecules,
+            'written': self.molecules - self.invalid,
+            'invalid': self.invalid,
+            'errors': self.errors,
+            'skipped_files': self.skipped[:MAX_REPORTED_ERRORS],
+            'shards': sorted(self.shards),
+            'formats': self.formats,
+        }
+
+
+@contextmanager
+def _dir_lock(ligand_dir):
+    """
+    Held while an upload is ingested into `ligand_dir`: an flock on a file in
+    the folder, so that server workers in other processes never read the same
+    next_seq.  IngestBusy if another upload holds it.
+    """
+    busy = IngestBusy('Another ligand upload is already being ingested into this project.')
+    if fcntl is None:
+        with _dir_locks_guard:
+            lock = _dir_locks.setdefault(os.path.abspath(ligand_dir), threading.Lock())
+        if not lock.acquire(blocking=False):
+            raise busy
+        try:
+            yield
+        finally:
+            lock.release()
+        return
+
+    with open(os.path.join(ligand_dir, LOCK_FILE), 'a+') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise busy
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
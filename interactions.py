@@ -0,0 +1,258 @@
+"""
+Protein-ligand interaction fingerprints for docked poses.
+
+One KD-tree (scipy.spatial.cKDTree) is built over the heavy protein atoms of
+a receptor and kept with its cached arrays (receptor_cache.py).  Poses are
+analysed a batch at a time: the heavy atoms of the whole batch are stacked
+and looked up in one tree query, and the contact pairs it returns are
+classified with NumPy and summed per pose:
+
+    hbond         ligand N/O to receptor N/O, 2.5-3.5 A, donor/acceptor pair
+    hydrophobic   ligand C/halogen to receptor side-chain C/S, <= 4.0 A
+    salt_bridge   charged ligand N/O to Asp/Glu or Lys/Arg/His, <= 4.0 A
+    clash         any heavy-atom pair closer than 2.2 A
+
+A fingerprint is one bit per (interaction type, receptor residue), so it has
+the same length for every pose of a receptor; it is stored bit-packed.
+Results are kept in the `interactions` table of the run's results.db, keyed
+by a hash of the receptor and the pose text, so a pose is analysed once.
+"""
+import os
+import hashlib
+import sqlite3
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import pdbqt
+from receptor_cache import receptor_cache, ATOM
+from selection import residue_index
+from results_index import DB_NAME, JOURNAL_MODE
+from export import read_pose
+
+# Bump when the contact rules change so cached fingerprints are recomputed
+INTERACTION_VERSION = 1
+
+TYPES = ('hbond', 'hydrophobic', 'salt_bridge', 'clash')
+
+HBOND_MIN, HBOND_MAX = 2.5, 3.5
+HYDROPHOBIC_MAX = 4.0
+SALT_BRIDGE_MAX = 4.0
+CLASH_MAX = 2.2
+# Receptor atoms are looked up within this distance of the pose
+CUTOFF = max(HBOND_MAX, HYDROPHOBIC_MAX, SALT_BRIDGE_MAX)
+
+# Ligand partial charges (PDBQT charge column) treated as formal charges
+CATION_CHARGE = 0.3
+ANION_CHARGE = -0.4
+
+BATCH_SIZE = 256
+
+_RECEPTOR_DONORS = {('SER', 'OG'), ('THR', 'OG1'), ('TYR', 'OH')}
+_RECEPTOR_ANIONS = {('ASP', 'OD1'), ('ASP', 'OD2'), ('GLU', 'OE1'), ('GLU', 'OE2')}
+_RECEPTOR_CATIONS = {('LYS', 'NZ'), ('ARG', 'NE'), ('ARG', 'NH1'), ('ARG', 'NH2'), ('HIS', 'ND1'), ('HIS', 'NE2')}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS interactions (
+    pose_hash TEXT PRIMARY KEY,
+    ligand TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    hbond INTEGER NOT NULL,
+    hydrophobic INTEGER NOT NULL,
+    salt_bridge INTEGER NOT NULL,
+    clash INTEGER NOT NULL,
+    residues TEXT NOT NULL,
+    fingerprint BLOB NOT NULL
+);
+"""
+
+
+class ReceptorSite:
+    """Heavy protein atoms of a receptor with their contact classes and KD-tree."""
+
+    def __init__(self, receptor):
+        element = np.char.upper(np.asarray(receptor.element).astype(str))
+        keep = (np.asarray(receptor.hetero) == ATOM) & (element != 'H') & (element != 'D')
+        self.atoms = np.flatnonzero(keep)
+        self.coords = np.asarray(receptor.coords, dtype=np.float64)[self.atoms]
+        self.tree = cKDTree(self.coords)
+
+        element = element[self.atoms]
+        resname = np.asarray(receptor.resname).astype(str)[self.atoms]
+        name = np.asarray(receptor.name).astype(str)[self.atoms]
+        pairs = list(zip(resname.tolist(), name.tolist()))
+
+        polar = (element == 'N') | (element == 'O')
+        self.acceptor = (element == 'O') | np.array([p in {('HIS', 'ND1'), ('HIS', 'NE2')} for p in pairs], dtype=bool)
+        self.donor = ((element == 'N') & (resname != 'PRO')) | np.array([p in _RECEPTOR_DONORS for p in pairs], dtype=bool)
+        self.donor &= polar
+        self.hydrophobic = ((element == 'C') & (name != 'C')) | ((element == 'S') & np.isin(resname, ('MET', 'CYS')))
+        self.anion = np.array([p in _RECEPTOR_ANIONS for p in pairs], dtype=bool)
+        self.cation = np.array([p in _RECEPTOR_CATIONS for p in pairs], dtype=bool)
+
+        index = residue_index(receptor)
+        self.residue = index.atom_residue[self.atoms]
+        self.n_residues = len(index)
+        self.labels = [f'{ch}:{rn}{seq}{ic}' for ch, rn, seq, ic in
+                       zip(index.chain.tolist(), index.resname.tolist(), index.resseq.tolist(), index.icode.tolist())]
+
+
+def receptor_site(receptor_path):
+    """ReceptorSite of a receptor file, built once per cached structure."""
+    receptor = receptor_cache.get(receptor_path)
+    site = receptor.derived.get('interaction_site')
+    if site is None:
+        site = receptor.derived['interaction_site'] = ReceptorSite(receptor)
+    return receptor, site
+
+
+def pose_hash(receptor, text):
+    # receptor.key is the receptor file's path, size and mtime
+    digest = hashlib.sha256(f'{INTERACTION_VERSION}:{receptor.key}\n'.encode())
+    digest.update(text.encode())
+    return digest.hexdigest()
+
+
+def parse_pose(text):
+    """Heavy atoms of a PDBQT pose: AutoDock types, (N, 3) coords, charges and donor flags."""
+    lines = [line for line in text.splitlines() if pdbqt.is_atom_line(line)]
+    types, charges = [], []
+    for line in lines:
+        fields = line.split()
+        types.append(fields[-1].upper() if fields else 'C')
+        try:
+            charges.append(float(line[70:76]))
+        except ValueError:
+            charges.append(0.0)
+    types = np.asarray(types)
+    coords = pdbqt.atom_coords(lines)
+    charges = np.asarray(charges)
+
+    hydrogen = np.isin(types, ('H', 'HD', 'HS'))
+    heavy = ~hydrogen
+    # A polar heavy atom with a polar hydrogen within bonding distance is a donor
+    donor = np.zeros(len(types), dtype=bool)
+    polar_h = coords[types == 'HD']
+    if len(polar_h):
+        d = np.linalg.norm(coords[:, None, :] - polar_h[None, :, :], axis=2)
+        donor = (d < 1.15).any(axis=1)
+    return types[heavy], coords[heavy], charges[heavy], donor[heavy]
+
+
+def analyse(site, texts):
+    """Contact counts, interacting residue labels and packed fingerprint of each pose in `texts`."""
+    parsed = [parse_pose(text) for text in texts]
+    sizes = np.array([len(coords) for _, coords, _, _ in parsed], dtype=np.int64)
+    counts = np.zeros((len(texts), len(TYPES)), dtype=np.int64)
+    bits = np.zeros((len(texts), len(TYPES), site.n_residues), dtype=bool)
+
+    if sizes.sum() and len(site.coords):
+        types = np.concatenate([types for types, _, _, _ in parsed])
+        coords = np.concatenate([coords for _, coords, _, _ in parsed])
+        charges = np.concatenate([charges for _, _, charges, _ in parsed])
+        donor = np.concatenate([donor for _, _, _, donor in parsed])
+        pose = np.repeat(np.arange(len(texts)), sizes)
+
+        # One tree query for the whole batch: every (ligand atom, receptor atom)
+        # pair within the cutoff, with its distance, put in ligand atom (so pose) order
+        pairs = cKDTree(coords).sparse_distance_matrix(site.tree, CUTOFF, output_type='ndarray')
+        pairs = pairs[np.argsort(pairs['i'], kind='stable')]
+        lig, rec, dist = pairs['i'], pairs['j'], pairs['v']
+
+        ligand_nitrogen = np.char.startswith(types, 'N')[lig]
+        ligand_oxygen = np.char.startswith(types, 'O')[lig]
+        ligand_donor = donor[lig]
+        ligand_polar = ligand_nitrogen | ligand_oxygen
+        ligand_acceptor = np.isin(types, ('OA', 'NA', 'OS', 'NS'))[lig]
+        ligand_hydrophobic = np.isin(types, ('C', 'A', 'CL', 'BR', 'I', 'F'))[lig]
+        charges = charges[lig]
+
+        contacts = {
+            'hbond': (dist >= HBOND_MIN) & (dist <= HBOND_MAX) & ligand_polar & (
+                (ligand_donor & site.acceptor[rec]) | (ligand_acceptor & site.donor[rec])),
+            'hydrophobic': (dist <= HYDROPHOBIC_MAX) & ligand_hydrophobic & site.hydrophobic[rec],
+            'salt_bridge': (dist <= SALT_BRIDGE_MAX) & (
+                (ligand_nitrogen & (charges >= CATION_CHARGE) & site.anion[rec]) |
+                (ligand_oxygen & (charges <= ANION_CHARGE) & site.cation[rec])),
+            'clash': dist < CLASH_MAX,
+        }
+        # The pairs of a pose are contiguous, so its counts are one reduceat
+        # segment; reduceat gives a pose without pairs the next element, so those
+        # are zeroed (the appended False keeps a start at len(lig) in range)
+        pair_pose = pose[lig]
+        starts = np.searchsorted(pair_pose, np.arange(len(texts)))
+        empty = starts == np.append(starts[1:], len(lig))
+        for row, kind in enumerate(TYPES):
+            found = contacts[kind]
+            counts[:, row] = np.add.reduceat(np.append(found, False).astype(np.int64), starts)
+            counts[empty, row] = 0
+            bits[pair_pose[found], row, site.residue[rec[found]]] = True
+
+    results = []
+    for pose_counts, pose_bits in zip(counts, bits):
+        residues = [site.labels[i] for i in np.flatnonzero(pose_bits.any(axis=0))]
+        results.append((dict(zip(TYPES, pose_counts.tolist())), residues, np.packbits(pose_bits).tobytes()))
+    return results
+
+
+def _connect(results_dir):
+    conn = sqlite3.connect(os.path.join(results_dir, DB_NAME), timeout=30, isolation_level=None)
+    conn.execute(f'PRAGMA journal_mode={JOURNAL_MODE}')
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def fingerprint_poses(receptor_path, results_dir, poses):
+    """
+    Interaction summaries for `poses` (dicts from the results index), computed
+    in batches and stored in results.db; poses analysed before are read back.
+    """
+    receptor, site = receptor_site(receptor_path)
+    conn = _connect(results_dir)
+    results = []
+    try:
+        for start in range(0, len(poses), BATCH_SIZE):
+            batch = poses[start:start + BATCH_SIZE]
+            texts = []
+            for pose in batch:
+                try:
+                    texts.append(read_pose(results_dir, pose))
+                except OSError:
+                    texts.append('')
+            hashes = [pose_hash(receptor, text) for text in texts]
+            placeholders = ','.join('?' * len(hashes))
+            stored = {
+                row[0]: row[1:] for row in conn.execute(
+                    f'SELECT pose_hash, hbond, hydrophobic, salt_bridge, clash, residues, fingerprint '
+                    f'FROM interactions WHERE pose_hash IN ({placeholders})', hashes)
+            }
+
+            # Poses not analysed before go through the tree together
+            missing = [i for i, key in enumerate(hashes) if key not in stored]
+            analysed = dict(zip(missing, analyse(site, [texts[i] for i in missing])))
+
+            new_rows = []
+            for i, (pose, key) in enumerate(zip(batch, hashes)):
+                if key in stored:
+                    hbond, hydrophobic, salt_bridge, clash, residues, fingerprint = stored[key]
+                    counts = {'hbond': hbond, 'hydrophobic': hydrophobic, 'salt_bridge': salt_bridge, 'clash': clash}
+                    residues = residues.split(',') if residues else []
+                else:
+                    counts, residues, fingerprint = analysed[i]
+                    new_rows.append((key, pose['ligand'], pose['rank'], counts['hbond'], counts['hydrophobic'],
+                                     counts['salt_bridge'], counts['clash'], ','.join(residues), fingerprint))
+                results.append({**pose, 'pose_hash': key, 'interactions': counts, 'residues': residues,
+                                'fingerprint': fingerprint.hex()})
+            if new_rows:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.executemany('INSERT OR REPLACE INTO interactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', new_rows)
+                conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return results
+
+
+def fingerprint_layout(receptor_path):
+    """Meaning of the fingerprint bits: interaction types by receptor residues."""
+    _, site = receptor_site(receptor_path)
+    return {'types': list(TYPES), 'residues': site.labels, 'bits': len(TYPES) * site.n_residues}
@@ -0,0 +1,422 @@
+"""
+Columnar index of a project's ligand library.
+
+The index lives in `ligand/.index/` as a series of parts, each a folder of
+NumPy column files with one row per ligand file:
+
+    heavy       heavy atom count
+    torsions    rotatable torsions (TORSDOF, else BRANCH count; -1 for SDF)
+    elements    bitmask over ELEMENTS
+    hash        first 16 bytes of the file's SHA-256
+    offset      byte offset and length of the molecule in its file
+    length
+    path_hash   64-bit hash of the path, used to drop superseded rows
+    extent      largest atom-to-atom distance (A), NaN if unknown
+    mtime_ns    modification time of the file when it was indexed, -1 if unknown
+    paths.bin   UTF-8 paths relative to `ligand/`, one per line, addressed
+                by path_offsets
+
+Uploads append a part as they go, so the index is built incrementally and
+queries (filters, random samples, the largest extent for sizing a box) only
+read these columns, never the ligand files.  `refresh()` brings an index back
+in line with the folder after files were added, changed or removed by hand.
+"""
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import pdbqt
+
+INDEX_DIR = '.index'
+# Rows buffered before a part is written
+PART_ROWS = 100000
+# Loaded indexes kept in memory (one per ligand folder)
+LOADED_MAX = 8
+# Ligand file formats by extension; the docking engine reads PDBQT only
+MOLECULE_FORMATS = {'.pdbqt': 'pdbqt', '.sdf': 'sdf'}
+LIGAND_EXTENSIONS = tuple(MOLECULE_FORMATS)
+DOCKING_EXTENSIONS = ('.pdbqt',)
+
+ELEMENTS = ('H', 'C', 'N', 'O', 'F', 'P', 'S', 'Cl', 'Br', 'I', 'B', 'Si', 'Se', 'Fe', 'Zn', 'Mg', 'Ca', 'Mn', 'other')
+ELEMENT_BITS = {element: 1 << i for i, element in enumerate(ELEMENTS)}
+
+# AutoDock atom types that are not simply an element symbol
+AD_TYPE_ELEMENTS = {
+    'A': 'C', 'NA': 'N', 'NS': 'N', 'OA': 'O', 'OS': 'O', 'SA': 'S',
+    'HD': 'H', 'HS': 'H', 'CL': 'Cl', 'BR': 'Br', 'SI': 'Si', 'SE': 'Se',
+    'FE': 'Fe', 'ZN': 'Zn', 'MG': 'Mg', 'CA': 'Ca', 'MN': 'Mn',
+}
+
+COLUMNS = {
+    'heavy': np.int32, 'torsions': np.int16, 'elements': np.uint32,
+    'offset': np.int64, 'length': np.int64, 'path_hash': np.uint64, 'extent': np.float32,
+    'mtime_ns': np.int64,
+}
+# Value of a column in parts written before it existed
+COLUMN_DEFAULTS = {'extent': np.nan, 'mtime_ns': -1}
+
+_loaded = OrderedDict()
+_loaded_lock = threading.Lock()
+
+
+def element_bit(symbol):
+    return ELEMENT_BITS.get(symbol, ELEMENT_BITS['other'])
+
+
+def element_mask(symbols):
+    mask = 0
+    for symbol in symbols:
+        mask |= element_bit(symbol)
+    return mask
+
+
+def extent_of(coords):
+    """Largest atom-to-atom distance of (x, y, z) strings, NaN if they do not parse."""
+    try:
+        return pdbqt.max_extent(np.asarray(coords, dtype=np.float64).reshape(-1, 3))
+    except ValueError:
+        return float('nan')
+
+
+def describe_pdbqt(text):
+    """(heavy atoms, torsions, element mask, extent) of a PDBQT ligand."""
+    lines = text.splitlines()
+    heavy, torsions = pdbqt.ligand_stats(lines)
+    mask = 0
+    coords = []
+    for line in lines:
+        if pdbqt.is_atom_line(line):
+            fields = line.split()
+            if fields:
+                ad_type = fields[-1].upper()
+                mask |= element_bit(AD_TYPE_ELEMENTS.get(ad_type, ad_type.capitalize()))
+            coords.append((line[30:38], line[38:46], line[46:54]))
+        elif line.startswith('ENDMDL'):
+            break
+    return heavy, torsions, mask, extent_of(coords)
+
+
+def describe_sdf(text):
+    """(heavy atoms, -1, element mask, extent) of an SDF record; torsions need bond perception."""
+    lines = text.splitlines()
+    heavy, mask = 0, 0
+    coords = []
+    try:
+        natoms = int(lines[3][0:3])
+    except (IndexError, ValueError):
+        natoms = 0
+    for line in lines[4:4 + natoms]:
+        symbol = line[31:34].strip().capitalize()
+        mask |= element_bit(symbol)
+        if symbol not in ('H', 'D'):
+            heavy += 1
+        coords.append((line[0:10], line[10:20], line[20:30]))
+    return heavy, -1, mask, extent_of(coords)
+
+
+def describe(text, molecule_format):
+    return describe_sdf(text) if molecule_format == 'sdf' else describe_pdbqt(text)
+
+
+def path_hash(rel_path):
+    return int.from_bytes(hashlib.blake2b(rel_path.encode(), digest_size=8).digest(), 'little')
+
+
+def file_row(ligand_dir, path):
+    """Index row for the ligand file at `path`."""
+    with open(path, 'rb') as f:
+        mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        data = f.read()
+    molecule_format = MOLECULE_FORMATS.get(os.path.splitext(path.lower())[1], 'pdbqt')
+    heavy, torsions, mask, extent = describe(data.decode('utf-8', errors='replace'), molecule_format)
+    return row(os.path.relpath(path, ligand_dir), heavy, torsions, mask, hashlib.sha256(data).digest(), 0, len(data),
+               extent, mtime_ns)
+
+
+def row(rel_path, heavy, torsions, mask, digest, offset, length, extent, mtime_ns):
+    return (rel_path.replace(os.sep, '/'), heavy, torsions, mask, digest[:16], offset, length, extent, mtime_ns)
+
+
+def index_dir(ligand_dir):
+    return os.path.join(ligand_dir, INDEX_DIR)
+
+
+class IndexWriter:
+    """Buffers index rows and writes them out as parts of PART_ROWS rows."""
+
+    def __init__(self, ligand_dir):
+        self.ligand_dir = ligand_dir
+        self.rows = []
+
+    def add(self, entry):
+        self.rows.append(entry)
+        if len(self.rows) >= PART_ROWS:
+            self.flush()
+
+    def extend(self, entries):
+        for entry in entries:
+            self.add(entry)
+
+    def flush(self):
+        if not self.rows:
+            return
+        write_part(self.ligand_dir, self.rows)
+        self.rows = []
+
+
+def _next_part(directory, after=-1):
+    existing = [int(p[5:]) for p in os.listdir(directory) if p.startswith('part_') and p[5:].isdigit()]
+    return f'part_{max(existing + [after], default=-1) + 1:05d}'
+
+
+def write_part(ligand_dir, rows, name=None):
+    """
+    Write `rows` as a new part after every existing one (or as `name`) and
+    return its name.  Several writers may add parts at once, in threads or
+    processes: a part whose name was taken meanwhile gets the next one.
+    """
+    directory = index_dir(ligand_dir)
+    os.makedirs(directory, exist_ok=True)
+
+    rel_paths, heavy, torsions, masks, digests, offsets, lengths, extents, mtimes = zip(*rows)
+    encoded = [p.encode() + b'\n' for p in rel_paths]
+    columns = {
+        'heavy': heavy, 'torsions': torsions, 'elements': masks,
+        'offset': offsets, 'length': lengths, 'path_hash': [path_hash(p) for p in rel_paths],
+        'extent': extents, 'mtime_ns': mtimes,
+    }
+
+    # Written to a temporary folder and renamed, so readers never see half a part
+    tmp_dir = tempfile.mkdtemp(prefix='.part_', suffix='.tmp', dir=directory)
+    for column, dtype in COLUMNS.items():
+        np.save(os.path.join(tmp_dir, column + '.npy'), np.asarray(columns[column], dtype=dtype))
+    np.save(os.path.join(tmp_dir, 'hash.npy'), np.frombuffer(b''.join(digests), dtype=np.uint8).reshape(-1, 16))
+    np.save(os.path.join(tmp_dir, 'path_offsets.npy'), np.concatenate([[0], np.cumsum([len(e) for e in encoded])]).astype(np.int64))
+    with open(os.path.join(tmp_dir, 'paths.bin'), 'wb') as f:
+        f.write(b''.join(encoded))
+
+    name = name or _next_part(directory)
+    while True:
+        try:
+            # Renaming a folder onto a part that exists (is not empty) fails
+            os.rename(tmp_dir, os.path.join(directory, name))
+            return name
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+        name = _next_part(directory, int(name[5:]))
+
+
+class LigandIndex:
+    """All parts of a ligand index, with superseded rows (same path) dropped."""
+
+    def __init__(self, ligand_dir):
+        self.ligand_dir = ligand_dir
+        directory = index_dir(ligand_dir)
+        try:
+            self.parts = sorted(p for p in os.listdir(directory) if p.startswith('part_'))
+        except FileNotFoundError:
+            self.parts = []
+
+        columns = {column: [] for column in list(COLUMNS) + ['hash']}
+        self._paths, self._path_offsets, starts = [], [], [0]
+        for part in self.parts:
+            part_dir = os.path.join(directory, part)
+            for column in columns:
+                try:
+                    columns[column].append(np.load(os.path.join(part_dir, column + '.npy'), mmap_mode='r'))
+                except FileNotFoundError:
+                    # Parts written before the column existed
+                    columns[column].append(np.full(len(columns['heavy'][-1]), COLUMN_DEFAULTS[column],
+                                                   dtype=COLUMNS[column]))
+            self._path_offsets.append(np.load(os.path.join(part_dir, 'path_offsets.npy')))
+            with open(os.path.join(part_dir, 'paths.bin'), 'rb') as f:
+                self._paths.append(f.read())
+            starts.append(starts[-1] + len(columns['heavy'][-1]))
+        self._starts = np.asarray(starts, dtype=np.int64)
+
+        for column, dtype in COLUMNS.items():
+            parts = columns[column]
+            setattr(self, column, np.concatenate(parts) if parts else np.zeros(0, dtype=dtype))
+        self.hash = np.concatenate(columns['hash']) if columns['hash'] else np.zeros((0, 16), dtype=np.uint8)
+
+        # Later rows for the same path replace earlier ones
+        reverse = self.path_hash[::-1]
+        _, first = np.unique(reverse, return_index=True)
+        self.rows = np.sort(len(reverse) - 1 - first)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def path(self, row_id):
+        """Path (relative to the ligand folder) of a global row id."""
+        part = int(np.searchsorted(self._starts, row_id, side='right')) - 1
+        local = row_id - self._starts[part]
+        offsets = self._path_offsets[part]
+        return self._paths[part][offsets[local]:offsets[local + 1] - 1].decode()
+
+    def paths(self, row_ids):
+        return [self.path(int(i)) for i in row_ids]
+
+    def select(self, min_torsions=None, max_torsions=None, min_heavy=None, max_heavy=None,
+               elements=None, exclude_elements=None, sample=None, seed=None):
+        """Row ids of the ligands matching all filters, optionally a random sample of them."""
+        rows = self.rows
+        keep = np.ones(len(rows), dtype=bool)
+        torsions = self.torsions[rows]
+        heavy = self.heavy[rows]
+        if min_torsions is not None:
+            keep &= torsions >= min_torsions
+        if max_torsions is not None:
+            keep &= torsions <= max_torsions
+        if min_heavy is not None:
+            keep &= heavy >= min_heavy
+        if max_heavy is not None:
+            keep &= heavy <= max_heavy
+        if elements:
+            required = element_mask(elements)
+            keep &= (self.elements[rows] & required) == required
+        if exclude_elements:
+            keep &= (self.elements[rows] & element_mask(exclude_elements)) == 0
+        selected = rows[keep]
+        if sample is not None and sample < 0:
+            raise ValueError('sample must not be negative')
+        if sample is not None and sample < len(selected):
+            rng = np.random.default_rng(seed)
+            selected = np.sort(rng.choice(selected, size=sample, replace=False))
+        return selected
+
+    def summary(self):
+        rows = self.rows
+        torsions = self.torsions[rows]
+        heavy = self.heavy[rows]
+        masks = self.elements[rows]
+        known = torsions[torsions >= 0]
+        return {
+            'ligands': int(len(rows)),
+            'parts': len(self.parts),
+            'heavy_atoms': {
+                'min': int(heavy.min()) if len(heavy) else None,
+                'max': int(heavy.max()) if len(heavy) else None,
+                'mean': round(float(heavy.mean()), 2) if len(heavy) else None,
+            },
+            'torsion_histogram': {str(t): int(n) for t, n in enumerate(np.bincount(known)) if n} if len(known) else {},
+            'unknown_torsions': int(len(torsions) - len(known)),
+            'elements': {element: int(np.count_nonzero(masks & bit)) for element, bit in ELEMENT_BITS.items()
+                         if np.any(masks & bit)},
+        }
+
+    def max_extent(self):
+        """Largest extent over the library, None if no ligand has a known one."""
+        extents = self.extent[self.rows]
+        extents = extents[~np.isnan(extents)]
+        return float(extents.max()) if len(extents) else None
+
+    def unknown_extent(self):
+        """Paths of ligands indexed before extents were recorded."""
+        return self.paths(self.rows[np.isnan(self.extent[self.rows])])
+
+    def stats_for(self, paths):
+        """{absolute path: (heavy, torsions)} for indexed ligand files."""
+        wanted = {}
+        for p in paths:
+            wanted.setdefault(path_hash(os.path.relpath(p, self.ligand_dir).replace(os.sep, '/')), p)
+        if not wanted:
+            return {}
+        hashes = self.path_hash[self.rows]
+        found = np.nonzero(np.isin(hashes, np.fromiter(wanted, dtype=np.uint64)))[0]
+        return {
+            wanted[int(hashes[i])]: (int(self.heavy[self.rows[i]]), int(self.torsions[self.rows[i]]))
+            for i in found
+        }
+
+
+def load(ligand_dir):
+    """Index of `ligand_dir`, reused while its parts are unchanged."""
+    directory = index_dir(ligand_dir)
+    try:
+        signature = tuple(sorted(p for p in os.listdir(directory) if p.startswith('part_')))
+    except FileNotFoundError:
+        signature = ()
+    key = os.path.abspath(ligand_dir)
+    with _loaded_lock:
+        cached = _loaded.get(key)
+        if cached and cached[0] == signature:
+            _loaded.move_to_end(key)
+            return cached[1]
+    index = LigandIndex(ligand_dir)
+    with _loaded_lock:
+        _loaded[key] = (signature, index)
+        _loaded.move_to_end(key)
+        while len(_loaded) > LOADED_MAX:
+            _loaded.popitem(last=False)
+    return index
+
+
+def find_files(ligand_dir):
+    for root, dirs, files in os.walk(ligand_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if not name.startswith('.') and name.lower().endswith(LIGAND_EXTENSIONS):
+                yield os.path.join(root, name)
+
+
+def add_files(ligand_dir, paths):
+    """Index (or re-index) the given ligand files."""
+    writer = IndexWriter(ligand_dir)
+    for p in paths:
+        writer.add(file_row(ligand_dir, p))
+    writer.flush()
+
+
+def refresh(ligand_dir):
+    """
+    Re-sync the index with the folder: index files that are missing from it,
+    re-index files whose size or mtime changed since they were indexed and,
+    if any indexed file is gone, compact the index into one part without
+    them.  Returns (added, updated, removed).
+    """
+    index = load(ligand_dir)
+    indexed = dict(zip(index.path_hash[index.rows].tolist(), index.rows.tolist()))
+    on_disk = {}
+    for p in find_files(ligand_dir):
+        on_disk[path_hash(os.path.relpath(p, ligand_dir).replace(os.sep, '/'))] = p
+
+    missing = [p for h, p in on_disk.items() if h not in indexed]
+    changed = []
+    for h, p in on_disk.items():
+        i = indexed.get(h)
+        if i is None:
+            continue
+        try:
+            st = os.stat(p)
+        except FileNotFoundError:
+            continue
+        # Rows of older parts have no mtime (-1) and are indexed again once
+        if st.st_size != index.length[i] or st.st_mtime_ns != index.mtime_ns[i]:
+            changed.append(p)
+    removed = set(indexed) - set(on_disk)
+    if removed:
+        keep = np.asarray([i for i in index.rows if int(index.path_hash[i]) not in removed], dtype=np.int64)
+        rows = [
+            (index.path(i), int(index.heavy[i]), int(index.torsions[i]), int(index.elements[i]),
+             index.hash[i].tobytes(), int(index.offset[i]), int(index.length[i]), float(index.extent[i]),
+             int(index.mtime_ns[i]))
+            for i in keep
+        ]
+        old_parts = index.parts
+        directory = index_dir(ligand_dir)
+        if rows:
+            write_part(ligand_dir, rows, name=f'part_{int(old_parts[-1][5:]) + 1:05d}')
+        for part in old_parts:
+            shutil.rmtree(os.path.join(directory, part), ignore_errors=True)
+    # Later rows for the same path replace the stale ones
+    add_files(ligand_dir, missing + changed)
+    return len(missing), len(changed), len(removed)
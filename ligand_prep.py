@@ -0,0 +1,233 @@
+"""
+Ligand preparation: SMILES and SDF libraries turned into docking-ready PDBQT.
+
+    python ligand_prep.py <library.smi|.sdf[.gz]> <ligand_dir> [--workers N] [--cache DIR]
+
+Molecules are read as a stream (ingest.py), keep their largest fragment, get
+explicit hydrogens, are embedded in 3D (RDKit ETKDG, then an MMFF or UFF
+clean-up) and written as PDBQT by meeko.  SDF input is read for its structure
+only; coordinates are generated again, so a molecule always prepares the same
+way whatever format it came in.  Batches run in a process pool over all cores
+and land in the sharded `ligand/` folders of a bulk upload, in the library
+index, ready for docking.
+
+The pool is shared by every preparation in the process and started once,
+with the forkserver method where there is one: its workers are not forked
+from the threaded server, and RDKit and meeko are imported once, in the fork
+server.
+
+Prepared molecules are cached by the SHA-256 of their canonical SMILES and
+PREP_VERSION in a ResultCache (result_cache.py), shared by all projects, so a
+library uploaded again is copied instead of being prepared again.  A molecule
+that fails is reported with its reason and does not stop the batch; the full
+list goes to `ligand/.prep_failures.txt`.
+
+RDKit and meeko are optional dependencies (pip install rdkit meeko).
+"""
+import os
+import sys
+import hashlib
+import argparse
+from contextlib import nullcontext
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from rdkit import Chem, RDLogger
+    from rdkit.Chem import AllChem
+except ImportError:
+    Chem = None
+try:
+    from meeko import MoleculePreparation
+except ImportError:
+    MoleculePreparation = None
+try:
+    from meeko import PDBQTWriterLegacy
+except ImportError:
+    # meeko < 0.5 writes the PDBQT from the preparation itself
+    PDBQTWriterLegacy = None
+
+from ingest import LigandIngest, IngestError, _write_batch, shared_pool, drop_pool, MAX_MOLECULE_BYTES
+from result_cache import ResultCache
+
+# Part of every cache key: bump when preparation changes its output
+PREP_VERSION = 1
+EMBED_SEED = 0xD0C
+PREP_FORMATS = {'.smi': 'smi', '.smiles': 'smi', '.sdf': 'sdf'}
+FAILURES_FILE = '.prep_failures.txt'
+
+# Cache of the worker process, opened by _init_worker
+_cache = None
+
+
+class PrepError(IngestError):
+    pass
+
+
+def missing_dependencies():
+    return [name for name, module in (('rdkit', Chem), ('meeko', MoleculePreparation)) if module is None]
+
+
+def parse_molecule(text, molecule_format):
+    """RDKit molecule of one SMILES line or SDF record, reduced to its largest fragment."""
+    if molecule_format == 'smi':
+        mol = Chem.MolFromSmiles(text.split()[0])
+    else:
+        mol = Chem.MolFromMolBlock(text)
+    if mol is None:
+        raise PrepError('RDKit could not read the molecule')
+    # Counter-ions and solvent of a salt are not docked
+    fragments = Chem.GetMolFrags(mol, asMols=True)
+    if len(fragments) > 1:
+        mol = max(fragments, key=lambda fragment: fragment.GetNumHeavyAtoms())
+    if mol.GetNumHeavyAtoms() == 0:
+        raise PrepError('no heavy atoms')
+    return mol
+
+
+def prep_key(mol):
+    smiles = Chem.MolToSmiles(mol)
+    return hashlib.sha256(f'{PREP_VERSION}:{smiles}'.encode()).hexdigest()
+
+
+def embed(mol):
+    """The molecule with explicit hydrogens and optimized 3D coordinates."""
+    mol = Chem.AddHs(mol)
+    params = AllChem.ETKDGv3()
+    params.randomSeed = EMBED_SEED
+    if AllChem.EmbedMolecule(mol, params) != 0:
+        # Random starting coordinates get large or strained molecules embedded
+        params.useRandomCoords = True
+        if AllChem.EmbedMolecule(mol, params) != 0:
+            raise PrepError('3D embedding failed')
+    if AllChem.MMFFHasAllMoleculeParams(mol):
+        AllChem.MMFFOptimizeMolecule(mol, maxIters=500)
+    else:
+        AllChem.UFFOptimizeMolecule(mol, maxIters=500)
+    return mol
+
+
+def to_pdbqt(mol):
+    preparation = MoleculePreparation()
+    setups = preparation.prepare(mol)
+    if PDBQTWriterLegacy is None:
+        return preparation.write_pdbqt_string()
+    text, ok, error = PDBQTWriterLegacy.write_string(setups[0])
+    if not ok:
+        raise PrepError(f'PDBQT conversion failed: {error}')
+    return text
+
+
+def _init_worker(cache_dir):
+    global _cache
+    RDLogger.DisableLog('rdApp.*')
+    _cache = ResultCache(cache_dir) if cache_dir else None
+
+
+def _prepare_batch(batch):
+    """Prepare (or take from the cache) and write one batch; returns (errors, index rows, cache hits)."""
+    errors, prepared, keys, hits = [], [], {}, 0
+    for path, rel_path, label, molecule_format, text in batch:
+        if text is None:
+            errors.append(f'{label}: larger than {MAX_MOLECULE_BYTES} bytes')
+            continue
+        try:
+            mol = parse_molecule(text, molecule_format)
+            key = prep_key(mol)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if _cache is not None and _cache.fetch(key, path):
+                with open(path, 'r') as f:
+                    text = f.read()
+                hits += 1
+            else:
+                text = to_pdbqt(embed(mol))
+                keys[path] = key
+        except Exception as e:
+            # RDKit and meeko fail in many ways; one molecule never stops the batch
+            errors.append(f'{label}: {" ".join(str(e).split()) or type(e).__name__}')
+            continue
+        prepared.append((path, rel_path, label, 'pdbqt', text))
+
+    write_errors, rows = _write_batch(prepared)
+    if _cache is not None:
+        for path, key in keys.items():
+            if os.path.exists(path):
+                _cache.store(key, path)
+    return errors + write_errors, rows, hits
+
+
+class LigandPrep(LigandIngest):
+    """Bulk ingestion of a SMILES or SDF library, prepared into PDBQT on the way in."""
+    _task = staticmethod(_prepare_batch)
+    output_format = 'pdbqt'
+    # Every batch already runs in the preparation pool
+    process_threshold = None
+
+    def __init__(self, ligand_dir, cache_dir=None, workers=None):
+        super().__init__(ligand_dir, workers or os.cpu_count() or 1)
+        self.cache_dir = cache_dir
+        self.cached = 0
+        self._failures = None
+
+    def run(self, stream, filename):
+        missing = missing_dependencies()
+        if missing:
+            raise PrepError(f'Ligand preparation needs {" and ".join(missing)} (pip install {" ".join(missing)}).')
+        os.makedirs(self.ligand_dir, exist_ok=True)
+        with open(os.path.join(self.ligand_dir, FAILURES_FILE), 'w') as self._failures:
+            try:
+                return super().run(stream, filename)
+            except BrokenProcessPool:
+                # A worker died (RDKit can crash on odd input); the next upload gets a new pool
+                drop_pool('prep', self._pool)
+                raise PrepError('A preparation worker crashed; the upload was stopped part way.')
+
+    def _upload_format(self, filename):
+        name = filename.lower()
+        compressed = name.endswith('.gz')
+        if compressed:
+            name = name[:-3]
+        molecule_format = PREP_FORMATS.get(os.path.splitext(name)[1])
+        if molecule_format is None:
+            raise PrepError('Unsupported file type for preparation. Allowed: .smi, .smiles, .sdf (optionally .gz).')
+        return ('gz' if compressed else None), molecule_format
+
+    def _executor(self):
+        # The shared pool outlives the upload, so leaving the block must not shut it down
+        return nullcontext(shared_pool('prep', self.workers, _init_worker, (self.cache_dir,), preload=[__name__]))
+
+    def _collect(self, result):
+        errors, rows, hits = result
+        super()._collect((errors, rows))
+        self.cached += hits
+        for error in errors:
+            self._failures.write(error + '\n')
+
+    def summary(self):
+        summary = super().summary()
+        summary.update(cached=self.cached, failures_file=os.path.join(self.ligand_dir, FAILURES_FILE))
+        return summary
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Prepare a SMILES or SDF library into docking-ready PDBQT.')
+    parser.add_argument('library')
+    parser.add_argument('ligand_dir')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--cache', default=None, help='conversion cache folder')
+    args = parser.parse_args(argv[1:])
+
+    try:
+        with open(args.library, 'rb') as stream:
+            summary = LigandPrep(args.ligand_dir, args.cache, args.workers).run(stream, os.path.basename(args.library))
+    except IngestError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(f"{summary['written']} of {summary['molecules']} molecule(s) prepared "
+          f"({summary['cached']} from the cache), {summary['invalid']} failed.")
+    for error in summary['errors']:
+        print(f'  {error}')
+    return 0 if summary['written'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
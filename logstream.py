@@ -0,0 +1,99 @@
+"""
+Incremental reading of docking logs.
+
+Clients keep a byte offset into the log and only receive what was appended
+since, either by polling /run-status or through the /run-stream SSE endpoint,
+so the cost of an update does not grow with the size of the log.
+"""
+import os
+import json
+import time
+
+# Largest amount of log text returned by one poll or SSE event (bytes)
+MAX_CHUNK = 256 * 1024
+# How often the SSE stream checks the log for new data (seconds)
+STREAM_INTERVAL = 0.5
+# Idle time after which the SSE stream sends a keep-alive comment (seconds)
+KEEPALIVE_INTERVAL = 15.0
+
+
+def read_chunk(path, offset, limit=MAX_CHUNK):
+    """
+    Read up to `limit` bytes of the log starting at `offset`.
+
+    Returns (text, next_offset, size, reset).  `reset` is True when the log is
+    shorter than `offset` (a new run replaced it) and reading restarted at 0.
+    A full chunk is cut at its last newline so lines are never split.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return '', 0, 0, offset > 0
+
+    reset = offset > size or offset < 0
+    if reset:
+        offset = 0
+    if offset == size:
+        return '', offset, size, reset
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(limit)
+
+    if len(data) == limit and offset + len(data) < size:
+        cut = data.rfind(b'\n')
+        if cut >= 0:
+            data = data[:cut + 1]
+
+    return data.decode('utf-8', errors='replace'), offset + len(data), size, reset
+
+
+def sse_event(event, data, event_id=None):
+    lines = [f'event: {event}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.extend(f'data: {line}' for line in data.split('\n'))
+    return '\n'.join(lines) + '\n\n'
+
+
+def stream_log(path, offset, get_status):
+    """
+    Generator of SSE events tailing the log at `path` from `offset`.
+
+    `get_status` returns a status dict whose `status` is 'queued' or 'running'
+    while the run is active; once it reports anything else and the log is fully
+    sent, a final `status` event is emitted and the stream ends.  A `progress`
+    entry in the status is sent as its own event whenever it changes, and so is
+    the whole status (as a `state` event) when the run moves from queued to
+    running.
+    """
+    last_sent = time.monotonic()
+    last_progress = None
+    last_state = None
+    while True:
+        status = get_status()
+        if status.get('status') != last_state and status.get('status') in ('running', 'queued'):
+            last_state = status.get('status')
+            yield sse_event('state', json.dumps(status))
+        progress = status.get('progress')
+        if progress is not None and progress != last_progress:
+            last_progress = progress
+            yield sse_event('progress', json.dumps(progress))
+        text, offset, _, reset = read_chunk(path, offset)
+        if reset:
+            yield sse_event('reset', '', event_id=offset)
+        if text:
+            # Text is sent JSON-encoded so partial lines survive intact; the
+            # event id is the offset, so a reconnecting EventSource resumes there
+            yield sse_event('log', json.dumps(text), event_id=offset)
+            last_sent = time.monotonic()
+            continue
+
+        if status.get('status') not in ('running', 'queued'):
+            yield sse_event('status', json.dumps(status), event_id=offset)
+            return
+
+        if time.monotonic() - last_sent >= KEEPALIVE_INTERVAL:
+            yield ': keepalive\n\n'
+            last_sent = time.monotonic()
+        time.sleep(STREAM_INTERVAL)
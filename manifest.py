@@ -0,0 +1,118 @@
+"""
+Run manifest: per-ligand completion state of a docking run.
+
+Every state change is appended to `manifest.jsonl` in the results directory
+as one complete line per ligand, written with a single write() and fsync'ed,
+so an interrupted run loses at most the batch in flight.  From time to time
+the journal is folded into `manifest.json`, which is replaced atomically.
+A manifest belongs to one run configuration (its fingerprint); a changed
+receptor, box or search setting starts a fresh manifest.
+"""
+import os
+import json
+import hashlib
+
+SNAPSHOT = 'manifest.json'
+JOURNAL = 'manifest.jsonl'
+
+DONE, FAILED = 'done', 'failed'
+
+# Fold the journal into the snapshot after this many appended records
+COMPACT_EVERY = 50000
+
+# Config keys that change docking results; any change invalidates the manifest
+FINGERPRINT_KEYS = (
+    'center_x', 'center_y', 'center_z', 'size_x', 'size_y', 'size_z',
+    'search_mode', 'scoring_method', 'num_modes',
+)
+
+
+def file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def config_fingerprint(config):
+    receptor = config['receptor']
+    data = {key: config.get(key) for key in FINGERPRINT_KEYS}
+    data['receptor'] = [os.path.abspath(receptor)] + file_signature(receptor)
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+class RunManifest:
+    def __init__(self, results_dir, fingerprint, resume=True):
+        self.results_dir = results_dir
+        self.fingerprint = fingerprint
+        self.snapshot_path = os.path.join(results_dir, SNAPSHOT)
+        self.journal_path = os.path.join(results_dir, JOURNAL)
+        # ligand name -> {'state': ..., 'source': [size, mtime_ns]}
+        self.ligands = {}
+        self._pending = 0
+        self.resumed = self._load(resume)
+
+    def _load(self, resume):
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            snapshot = None
+
+        if not resume or snapshot is None or snapshot.get('fingerprint') != self.fingerprint:
+            # Nothing usable: start over with an empty journal
+            self.ligands = {}
+            self._write_snapshot()
+            return False
+
+        self.ligands = snapshot.get('ligands', {})
+        try:
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash; everything before it is intact
+                        break
+                    self.ligands[record['ligand']] = {'state': record['state'], 'source': record.get('source')}
+        except OSError:
+            pass
+        # Start from a clean journal so new records never follow a torn line
+        self._write_snapshot()
+        return True
+
+    def _write_snapshot(self):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'fingerprint': self.fingerprint, 'ligands': self.ligands}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # The snapshot now holds everything the journal did
+        open(self.journal_path, 'w').close()
+        self._pending = 0
+
+    def is_done(self, name, source):
+        entry = self.ligands.get(name)
+        return entry is not None and entry['state'] == DONE and entry.get('source') == source
+
+    def record(self, entries, state):
+        """Record `state` for (name, source) pairs in one durable append."""
+        if not entries:
+            return
+        lines = []
+        for name, source in entries:
+            self.ligands[name] = {'state': state, 'source': source}
+            lines.append(json.dumps({'ligand': name, 'state': state, 'source': source}))
+        with open(self.journal_path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending += len(lines)
+        if self._pending >= COMPACT_EVERY:
+            self.compact()
+
+    def compact(self):
+        self._write_snapshot()
+
+    def counts(self):
+        done = sum(1 for entry in self.ligands.values() if entry['state'] == DONE)
+        return {'done': done, 'failed': len(self.ligands) - done}
@@ -0,0 +1,366 @@
+"""
+Prometheus-style metrics.
+
+Counters, gauges and latency histograms are kept in process memory and
+rendered in the Prometheus text exposition format by /metrics.  `install()`
+hooks every Flask route (request counts, latency and bytes by endpoint), and
+code stages are timed with
+
+    with metrics.stage('parse'):
+        ...
+
+or `@metrics.stage('parse')` on a function, which records into the
+`unidock_stage_duration_seconds` histogram.  Recording costs one
+perf_counter() call and a short locked update, so hot paths can use it.
+
+Metrics are recorded in the memory of each process.  Under a multi-worker
+server (serve.py) the workers share a directory, UNIDOCK_METRICS_DIR: each
+writes its counters and histograms there as `<pid>.json` every FLUSH_INTERVAL
+seconds (and at exit), and /metrics sums the files of all workers, so any
+worker gives the whole server's figures.  The files of workers that exited
+are folded into `retired.json` (`retire()`, called by the server), so
+counters never go backwards.  Gauges are computed at scrape time from the
+shared databases and are the same whichever worker answers.
+"""
+import os
+import glob
+import json
+import time
+import atexit
+import bisect
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Latency buckets in seconds (upper bounds; +Inf is implicit)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Queue waits and runs last minutes to days
+LONG_BUCKETS = (1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0, 4 * 3600.0, 12 * 3600.0, 24 * 3600.0, 72 * 3600.0)
+
+# Directory shared by the workers of one server; unset for a single process
+MULTIPROCESS_DIR = os.environ.get('UNIDOCK_METRICS_DIR')
+# How often a worker writes its metrics there (seconds)
+FLUSH_INTERVAL = 5.0
+RETIRED_FILE = 'retired.json'
+
+_registry = {}
+_registry_lock = threading.Lock()
+_flusher = None
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, values):
+        for key, value in values:
+            key = tuple(key)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """Compute the value at scrape time: `function()` returns a number, or
+        a dict of label-value tuples to numbers for a labelled gauge."""
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception:
+                value = None
+            if value is not None:
+                with self._lock:
+                    self._values = dict(value) if isinstance(value, dict) else {(): value}
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), [list(counts), total, count]] for key, (counts, total, count) in self._values.items()]
+
+    def merge(self, values):
+        for key, (counts, total, count) in values:
+            state = self._values.setdefault(tuple(key), [[0] * (len(self.buckets) + 1), 0.0, 0])
+            state[0] = [a + b for a, b in zip(state[0], counts)]
+            state[1] += total
+            state[2] += count
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (made cumulative when rendered), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def _register(cls, name, *args, **kwargs):
+    # Registering the same name again returns the existing metric, so modules
+    # can declare what they record without coordinating
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+        return metric
+
+
+def counter(name, documentation, labels=()):
+    return _register(Counter, name, documentation, labels)
+
+
+def gauge(name, documentation, labels=()):
+    return _register(Gauge, name, documentation, labels)
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, documentation, labels, buckets=buckets)
+
+
+def _snapshot(metrics):
+    # Counters and histograms with what is needed to rebuild them in another process
+    return {
+        metric.name: {'kind': metric.kind, 'documentation': metric.documentation, 'labels': list(metric.labels),
+                      'buckets': list(getattr(metric, 'buckets', ())), 'values': metric.snapshot()}
+        for metric in metrics if isinstance(metric, (Counter, Histogram))
+    }
+
+
+@contextmanager
+def _dir_lock(directory, exclusive):
+    # Readers must not see a retired worker both in its own file and in retired.json
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(directory, '.lock'), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def _write(path, data):
+    temp = f'{path}.{os.getpid()}.tmp'
+    with open(temp, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp, path)
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _merge_into(merged, snapshot):
+    for name, data in snapshot.items():
+        metric = merged.get(name)
+        if metric is None:
+            cls = Histogram if data['kind'] == 'histogram' else Counter
+            extra = {'buckets': data['buckets']} if cls is Histogram else {}
+            metric = merged[name] = cls(name, data['documentation'], data['labels'], **extra)
+        metric.merge(data['values'])
+
+
+def flush():
+    """Write this process's counters and histograms to the shared directory."""
+    if MULTIPROCESS_DIR:
+        with _registry_lock:
+            metrics = list(_registry.values())
+        _write(os.path.join(MULTIPROCESS_DIR, f'{os.getpid()}.json'), _snapshot(metrics))
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+def start_flushing():
+    """Keep this process's file in the shared directory up to date (no-op for a single process)."""
+    global _flusher
+    if not MULTIPROCESS_DIR or _flusher is not None:
+        return
+    os.makedirs(MULTIPROCESS_DIR, exist_ok=True)
+    _flusher = threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True)
+    _flusher.start()
+    atexit.register(flush)
+
+
+def retire(pid, directory=None):
+    """Fold the file of an exited worker into retired.json, so its counts are kept."""
+    directory = directory or MULTIPROCESS_DIR
+    path = os.path.join(directory, f'{pid}.json')
+    if not os.path.exists(path):
+        return
+    with _dir_lock(directory, exclusive=True):
+        merged = {}
+        retired = os.path.join(directory, RETIRED_FILE)
+        _merge_into(merged, _read(retired))
+        _merge_into(merged, _read(path))
+        _write(retired, _snapshot(merged.values()))
+        os.remove(path)
+
+
+def _aggregated():
+    # Counters and histograms summed over every worker, live and retired
+    flush()
+    merged = {}
+    with _dir_lock(MULTIPROCESS_DIR, exclusive=False):
+        for path in glob.glob(os.path.join(MULTIPROCESS_DIR, '*.json')):
+            _merge_into(merged, _read(path))
+    return merged
+
+
+def render():
+    """All metrics in the Prometheus text format (version 0.0.4)."""
+    with _registry_lock:
+        metrics = dict(_registry)
+    if MULTIPROCESS_DIR:
+        # Gauges stay those of this process: they are computed from shared state
+        metrics.update(_aggregated())
+    metrics = sorted(metrics.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STAGE_SECONDS = histogram('unidock_stage_duration_seconds', 'Time spent in instrumented code stages.', ('stage',))
+
+
+@contextmanager
+def stage(name):
+    """Time a block (or, as a decorator, each call of a function) as stage `name`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=name)
+
+
+HTTP_REQUESTS = counter('unidock_http_requests_total', 'HTTP requests by route, method and status.',
+                        ('endpoint', 'method', 'status'))
+HTTP_SECONDS = histogram('unidock_http_request_duration_seconds', 'HTTP request latency by route.',
+                         ('endpoint', 'method'))
+HTTP_REQUEST_BYTES = counter('unidock_http_request_bytes_total', 'Request body bytes received by route.', ('endpoint',))
+HTTP_RESPONSE_BYTES = counter('unidock_http_response_bytes_total',
+                              'Response body bytes sent by route (streamed responses excluded).', ('endpoint',))
+
+
+def install(app):
+    """Record count, latency and bytes of every request to `app`."""
+    from flask import g, request
+
+    start_flushing()
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        started = g.pop('metrics_started', None)
+        # The route pattern, not the URL, keeps the label set bounded
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        if started is not None:
+            HTTP_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        if request.content_length:
+            HTTP_REQUEST_BYTES.inc(request.content_length, endpoint=endpoint)
+        if not response.is_streamed:
+            HTTP_RESPONSE_BYTES.inc(response.calculate_content_length() or 0, endpoint=endpoint)
+        return response
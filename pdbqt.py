@@ -0,0 +1,80 @@
+"""
+Small helpers for reading PDBQT files without a full structure parser.
+"""
+import os
+
+import numpy as np
+
+
+def is_atom_line(line):
+    return line.startswith('ATOM') or line.startswith('HETATM')
+
+
+def atom_coords(lines):
+    """(N, 3) array of the ATOM/HETATM coordinates in `lines`."""
+    coords = [
+        (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+        for line in lines if is_atom_line(line)
+    ]
+    return np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+
+
+def read_coords(path, first_model_only=True):
+    """Atom coordinates of a PDBQT file (only the first MODEL by default)."""
+    lines = []
+    with open(path, 'r', errors='replace') as f:
+        for line in f:
+            if first_model_only and line.startswith('ENDMDL'):
+                break
+            lines.append(line)
+    return atom_coords(lines)
+
+
+def max_extent(coords):
+    """Largest distance between any two atoms (0 for fewer than two atoms)."""
+    if len(coords) < 2:
+        return 0.0
+    diff = coords[:, None, :] - coords[None, :, :]
+    return float(np.sqrt(np.einsum('ijk,ijk->ij', diff, diff).max()))
+
+
+def ligand_stats(lines):
+    """(heavy atom count, torsion count) of a ligand from its PDBQT lines."""
+    heavy = 0
+    torsions = None
+    branches = 0
+    for line in lines:
+        if is_atom_line(line):
+            # AutoDock atom type is the last column; hydrogens are H, HD, HS
+            fields = line.split()
+            if fields and not fields[-1].upper().startswith('H'):
+                heavy += 1
+        elif line.startswith('TORSDOF'):
+            try:
+                torsions = int(line.split()[1])
+            except (IndexError, ValueError):
+                pass
+        elif line.startswith('BRANCH'):
+            branches += 1
+        elif line.startswith('ENDMDL'):
+            break
+    return heavy, torsions if torsions is not None else branches
+
+
+def read_stats(path):
+    with open(path, 'r', errors='replace') as f:
+        return ligand_stats(f)
+
+
+def is_valid_result(path):
+    """A docking output exists, is non-empty and holds at least one scored pose."""
+    try:
+        if os.path.getsize(path) == 0:
+            return False
+        with open(path, 'r', errors='replace') as f:
+            for line in f:
+                if line.startswith('REMARK VINA RESULT'):
+                    return True
+    except OSError:
+        pass
+    return False
@@ -0,0 +1,143 @@
+"""
+Grid-based pocket detection.
+
+A LIGSITE-style scan over the receptor: atoms are stamped onto a voxel grid,
+every empty voxel counts along how many of seven scan lines (the three axes and
+the four body diagonals) it is enclosed by protein on both sides, and buried
+empty voxels are grouped into connected pockets.  Each pocket is returned with
+a tight docking box in the same format as the /grid `grid_dimensions`.
+"""
+import numpy as np
+
+from receptor_cache import ATOM
+from gridbox import buffer_box, grid_dimensions
+
+# Scan lines used to measure buriedness
+DIRECTIONS = [
+    (1, 0, 0), (0, 1, 0), (0, 0, 1),
+    (1, 1, 1), (1, 1, -1), (1, -1, 1), (-1, 1, 1),
+]
+
+
+def _shift(grid, offset):
+    """Shift a 3D array by a voxel offset, filling with False instead of wrapping."""
+    out = np.zeros_like(grid)
+    src, dst = [], []
+    for o, n in zip(offset, grid.shape):
+        if o >= 0:
+            src.append(slice(0, n - o))
+            dst.append(slice(o, n))
+        else:
+            src.append(slice(-o, n))
+            dst.append(slice(0, n + o))
+    out[tuple(dst)] = grid[tuple(src)]
+    return out
+
+
+def _seen_along(occupied, direction, reach):
+    """Voxels that have an occupied voxel within `reach` steps in `direction`."""
+    # Doubling: after k rounds each voxel has looked 2**k steps ahead
+    seen = _shift(occupied, tuple(-d for d in direction))
+    step = 1
+    while step * 2 <= reach:
+        seen |= _shift(seen, tuple(-d * step for d in direction))
+        step *= 2
+    return seen
+
+
+def _occupancy(coords, origin, shape, spacing, radius):
+    occupied = np.zeros(shape, dtype=bool)
+    voxel = np.floor((coords - origin) / spacing + 0.5).astype(np.int64)
+    r = int(np.ceil(radius / spacing))
+    span = np.arange(-r, r + 1)
+    offsets = np.stack(np.meshgrid(span, span, span, indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets = offsets[(offsets ** 2).sum(axis=1) * spacing ** 2 <= radius ** 2]
+    upper = np.array(shape) - 1
+    for offset in offsets:
+        idx = np.clip(voxel + offset, 0, upper)
+        occupied[idx[:, 0], idx[:, 1], idx[:, 2]] = True
+    return occupied
+
+
+def _label(mask):
+    """Connected components (6-connectivity) of a boolean grid."""
+    flat = np.flatnonzero(mask)
+    compact = np.full(mask.size, -1, dtype=np.int64)
+    compact[flat] = np.arange(len(flat))
+    compact = compact.reshape(mask.shape)
+
+    edges_u, edges_v = [], []
+    for axis in range(3):
+        lo = [slice(None)] * 3
+        hi = [slice(None)] * 3
+        lo[axis] = slice(0, -1)
+        hi[axis] = slice(1, None)
+        both = mask[tuple(lo)] & mask[tuple(hi)]
+        edges_u.append(compact[tuple(lo)][both])
+        edges_v.append(compact[tuple(hi)][both])
+    u = np.concatenate(edges_u)
+    v = np.concatenate(edges_v)
+
+    # Min-label propagation with pointer jumping
+    labels = np.arange(len(flat))
+    while True:
+        new = labels.copy()
+        np.minimum.at(new, u, labels[v])
+        np.minimum.at(new, v, labels[u])
+        new = new[new]
+        if np.array_equal(new, labels):
+            break
+        labels = new
+    return flat, labels
+
+
+def detect_pockets(receptor, spacing=1.0, probe_radius=3.0, min_buriedness=5,
+                   min_volume=30.0, padding=4.0, top_k=5, reach=16.0):
+    """Ranked pockets of a cached receptor, largest and most buried first."""
+    coords = np.asarray(receptor.coords, dtype=np.float64)
+    coords = coords[np.asarray(receptor.hetero) == ATOM]
+    if not len(coords):
+        return []
+
+    margin = probe_radius + 2 * spacing
+    origin = coords.min(axis=0) - margin
+    shape = tuple(int(n) for n in np.ceil((coords.max(axis=0) + margin - origin) / spacing) + 1)
+
+    occupied = _occupancy(coords, origin, shape, spacing, probe_radius)
+    steps = max(1, int(reach / spacing))
+
+    buriedness = np.zeros(shape, dtype=np.int8)
+    for direction in DIRECTIONS:
+        back = tuple(-d for d in direction)
+        buriedness += _seen_along(occupied, direction, steps) & _seen_along(occupied, back, steps)
+
+    pocket_mask = ~occupied & (buriedness >= min_buriedness)
+    if not pocket_mask.any():
+        return []
+    flat, labels = _label(pocket_mask)
+
+    voxel_volume = spacing ** 3
+    points = np.stack(np.unravel_index(flat, shape), axis=1) * spacing + origin
+    scores = buriedness.ravel()[flat].astype(np.float64)
+
+    # Group voxels by component label
+    order = np.argsort(labels, kind='stable')
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+    pockets = []
+    for members in np.split(order, boundaries):
+        volume = len(members) * voxel_volume
+        if volume < min_volume:
+            continue
+        center, size = buffer_box(points[members], padding)
+        pockets.append({
+            'volume': float(volume),
+            'buriedness': float(scores[members].mean()),
+            'score': float(scores[members].sum() * voxel_volume / len(DIRECTIONS)),
+            'grid_dimensions': grid_dimensions(center, size),
+        })
+
+    pockets.sort(key=lambda p: p['score'], reverse=True)
+    pockets = pockets[:top_k] if top_k else pockets
+    for rank, pocket in enumerate(pockets, start=1):
+        pocket['rank'] = rank
+    return pockets
@@ -0,0 +1,214 @@
+"""
+Pose clustering and RMSD-based deduplication of docking outputs.
+
+    python pose_clusters.py <results_dir> [--cutoff 2.0] [--rewrite]
+
+Poses of one ligand share their atom order, so the heavy-atom RMSD between
+all of them (no superposition; they are in the receptor frame) comes from a
+single (poses x poses x atoms) NumPy pass.  Poses are clustered greedily in
+score order: the best remaining pose becomes a representative and takes every
+pose within the cutoff into its cluster.  With `rewrite`, each output file is
+replaced atomically by one holding only the representatives; otherwise the
+report shows what that would save.  Packed results (result_store.py) are
+read from their shards and put back as new members; the superseded ones stay
+in the shards as dead bytes until the results are unpacked and packed again.
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+import pdbqt
+from results_index import ResultsIndex, RESULT_SUFFIX
+from result_store import ResultStore, PACK_CHUNK
+
+DEFAULT_CUTOFF = 2.0
+
+HYDROGEN_TYPES = ('H', 'HD', 'HS')
+
+
+def split_models(text):
+    """MODEL blocks of a result file (the whole text if it has none)."""
+    models, current = [], []
+    for line in text.splitlines(keepends=True):
+        current.append(line)
+        if line.startswith('ENDMDL'):
+            models.append(''.join(current))
+            current = []
+    if not models and current:
+        models.append(''.join(current))
+    return models
+
+
+def heavy_coords(model):
+    lines = [line for line in model.splitlines()
+             if pdbqt.is_atom_line(line) and line.split()[-1].upper() not in HYDROGEN_TYPES]
+    return pdbqt.atom_coords(lines)
+
+
+def pairwise_rmsd(coords):
+    """(P, P) heavy-atom RMSD matrix of P poses given as a (P, N, 3) array."""
+    diff = coords[:, None, :, :] - coords[None, :, :, :]
+    return np.sqrt(np.einsum('ijkl,ijkl->ij', diff, diff) / coords.shape[1])
+
+
+def cluster(rmsd, cutoff):
+    """Greedy clustering in pose order; returns (representatives, cluster label per pose)."""
+    labels = np.full(len(rmsd), -1)
+    representatives = []
+    for i in range(len(rmsd)):
+        if labels[i] >= 0:
+            continue
+        members = (labels < 0) & (rmsd[i] <= cutoff)
+        labels[members] = len(representatives)
+        representatives.append(i)
+    return representatives, labels
+
+
+def renumber(models):
+    out = []
+    for number, model in enumerate(models, start=1):
+        if model.startswith('MODEL'):
+            model = f'MODEL {number}\n' + model.split('\n', 1)[1]
+        out.append(model)
+    return ''.join(out)
+
+
+def dedupe_file(path, cutoff=DEFAULT_CUTOFF, rewrite=False):
+    """Cluster the poses of one result file; returns its before/after report."""
+    with open(path, 'r', errors='replace') as f:
+        text = f.read()
+    report, kept = dedupe_text(text, cutoff)
+    if rewrite and kept is not None:
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(kept)
+        os.replace(tmp_path, path)
+    return report
+
+
+def dedupe_text(text, cutoff=DEFAULT_CUTOFF):
+    """(report, text of the representatives) of one result; the text is None if no pose goes."""
+    started = time.perf_counter()
+    models = split_models(text)
+    coords = [heavy_coords(model) for model in models]
+    load_before = time.perf_counter() - started
+
+    report = {'poses': len(models), 'kept': len(models), 'bytes': len(text.encode()), 'bytes_kept': len(text.encode()),
+              'load_seconds': load_before, 'load_seconds_kept': load_before}
+    # Poses that do not share one atom layout cannot be compared
+    if len(models) < 2 or len({c.shape for c in coords}) != 1 or coords[0].shape[0] == 0:
+        return report, None
+
+    representatives, _ = cluster(pairwise_rmsd(np.stack(coords)), cutoff)
+    if len(representatives) == len(models):
+        return report, None
+    kept = renumber([models[i] for i in representatives])
+
+    started = time.perf_counter()
+    for model in split_models(kept):
+        heavy_coords(model)
+    report.update(kept=len(representatives), bytes_kept=len(kept.encode()),
+                  load_seconds_kept=time.perf_counter() - started)
+    return report, kept
+
+
+REPORT_KEYS = ('poses', 'kept', 'bytes', 'bytes_kept', 'load_seconds', 'load_seconds_kept')
+
+
+def new_totals():
+    return dict.fromkeys(('files',) + REPORT_KEYS, 0)
+
+
+def add_report(totals, report):
+    totals['files'] += 1
+    for key in REPORT_KEYS:
+        totals[key] += report[key]
+
+
+def summarize(totals, cutoff):
+    """Savings of the per-file reports added to `totals`."""
+    totals.update(
+        cutoff=cutoff,
+        load_seconds=round(totals['load_seconds'], 3),
+        load_seconds_kept=round(totals['load_seconds_kept'], 3),
+        poses_removed=totals['poses'] - totals['kept'],
+        bytes_saved=totals['bytes'] - totals['bytes_kept'],
+        space_saving=round(1 - totals['bytes_kept'] / totals['bytes'], 4) if totals['bytes'] else 0.0,
+        load_time_saving=round(1 - totals['load_seconds_kept'] / totals['load_seconds'], 4) if totals['load_seconds'] else 0.0,
+    )
+    return totals
+
+
+def dedupe_results(results_dir, cutoff=DEFAULT_CUTOFF, rewrite=False):
+    """
+    Cluster every result of a run, loose or packed; rewritten results are
+    re-indexed.
+    """
+    totals = new_totals()
+    rewritten, loose = [], set()
+    with os.scandir(results_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(RESULT_SUFFIX) or not entry.is_file():
+                continue
+            loose.add(entry.name)
+            report = dedupe_file(entry.path, cutoff, rewrite)
+            add_report(totals, report)
+            if rewrite and report['kept'] < report['poses']:
+                rewritten.append(entry.path)
+
+    index = ResultsIndex(results_dir)
+    if rewritten:
+        # Pose offsets changed, so the scores index must be refreshed
+        index.add(rewritten)
+
+    store = ResultStore(results_dir)
+    packed, repacked = [], 0
+    try:
+        for file_name, data in store.iter_members():
+            # A loose file supersedes its packed copy and was handled above
+            if file_name in loose:
+                continue
+            report, kept = dedupe_text(data.decode('utf-8', errors='replace'), cutoff)
+            add_report(totals, report)
+            if rewrite and kept is not None:
+                packed.append((file_name, kept.encode()))
+            if len(packed) >= PACK_CHUNK:
+                repacked += _repack(store, index, packed)
+        repacked += _repack(store, index, packed)
+    finally:
+        store.close()
+
+    totals['rewritten'] = len(rewritten) + repacked
+    return summarize(totals, cutoff)
+
+
+def _repack(store, index, items):
+    """Put deduplicated packed results back and re-index them; empties `items`."""
+    if not items:
+        return 0
+    store.put(items)
+    index.add_packed(items)
+    count = len(items)
+    items.clear()
+    return count
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Cluster docked poses by RMSD and drop near-duplicates.')
+    parser.add_argument('results_dir')
+    parser.add_argument('--cutoff', type=float, default=DEFAULT_CUTOFF, help='RMSD cutoff in Angstrom')
+    parser.add_argument('--rewrite', action='store_true', help='rewrite result files keeping only representatives')
+    args = parser.parse_args(argv[1:])
+    report = dedupe_results(args.results_dir, args.cutoff, args.rewrite)
+    print(f"{report['files']} file(s): kept {report['kept']} of {report['poses']} pose(s) at {args.cutoff} A; "
+          f"{report['bytes_saved']} bytes ({report['space_saving']:.0%}) and "
+          f"{report['load_time_saving']:.0%} of parse time saved"
+          f"{'' if args.rewrite else ' (dry run)'}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
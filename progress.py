@@ -0,0 +1,153 @@
+"""
+Incremental progress tracking for docking runs.
+
+A ProgressTracker follows the run log from its own byte offset, so each
+update only reads what was appended since the previous one.  The driver
+reports per-ligand events in the log with lines of the form
+
+    [progress] total=<n>
+    [ligand] done <name>
+    [ligand] failed <name> <reason>
+
+Ligands taken from a resumed run or the result cache are logged as done too,
+so the counters never need to look at the results directory.  Until the
+driver has logged its total, the ligand index gives an estimate.  Done
+ligands are only counted; just the names of failed ones are kept, so a
+ligand that fails and then succeeds on a retry is not counted twice.
+"""
+import os
+import re
+import time
+import threading
+from collections import deque
+
+import ligand_index
+
+# Throughput is averaged over this many seconds of history
+RATE_WINDOW = 60.0
+# The log is parsed in blocks of this many bytes
+READ_BLOCK = 1024 * 1024
+
+_TOTAL_RE = re.compile(r'^\[progress\] total=(\d+)')
+_LIGAND_RE = re.compile(r'^\[ligand\] (done|failed) (\S+)')
+
+
+def count_ligands(ligand_dir):
+    """Ligands in the library index; 0 if the folder has no index."""
+    try:
+        return len(ligand_index.load(ligand_dir))
+    except (OSError, ValueError):
+        return 0
+
+
+class ProgressTracker:
+    def __init__(self, project_path, run_id=None):
+        self.run_id = run_id
+        self.log_path = os.path.join(project_path, 'results', 'docking_run.log')
+        self.total = count_ligands(os.path.join(project_path, 'ligand'))
+        self._lock = threading.Lock()
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.log_offset = 0
+        self._partial = b''
+        self.completed = 0
+        self.failed = set()
+        self._samples = deque()
+
+    def _read_log(self):
+        try:
+            size = os.path.getsize(self.log_path)
+        except OSError:
+            return
+        if size < self.log_offset:
+            # The log was replaced by a new run
+            self._reset_counters()
+        if size == self.log_offset:
+            return
+
+        with open(self.log_path, 'rb') as f:
+            f.seek(self.log_offset)
+            while self.log_offset < size:
+                block = f.read(min(READ_BLOCK, size - self.log_offset))
+                if not block:
+                    break
+                self.log_offset += len(block)
+                self._parse(block)
+
+    def _parse(self, block):
+        lines = (self._partial + block).split(b'\n')
+        # The last element is an unfinished line (or empty); keep it for later
+        self._partial = lines.pop()
+        for raw in lines:
+            line = raw.decode('utf-8', errors='replace').strip()
+            match = _LIGAND_RE.match(line)
+            if match:
+                state, name = match.groups()
+                if state == 'done':
+                    self.completed += 1
+                    self.failed.discard(name)
+                else:
+                    self.failed.add(name)
+                continue
+            match = _TOTAL_RE.match(line)
+            if match:
+                self.total = int(match.group(1))
+
+    def update(self, finished=False):
+        """Read what is new and return the current counters as a dict."""
+        with self._lock:
+            self._read_log()
+            if finished and self._partial:
+                # A finished run will not complete its last line
+                self._parse(b'\n')
+
+            # A sample is taken when the count moves; the rate runs from the
+            # oldest sample in the window up to now, so it falls while a run
+            # is stalled and reaches 0 once nothing has finished for a window
+            now = time.time()
+            done = self.completed
+            if not self._samples or self._samples[-1][1] != done:
+                self._samples.append((now, done))
+            while len(self._samples) > 1 and now - self._samples[1][0] >= RATE_WINDOW:
+                self._samples.popleft()
+
+            first_time, first_done = self._samples[0]
+            elapsed = now - first_time
+            rate = (done - first_done) / elapsed if elapsed > 0 else 0.0
+
+            remaining = max(self.total - done - len(self.failed), 0)
+            eta = remaining / rate if rate > 0 else None
+
+            return {
+                'ligands_total': self.total,
+                'ligands_completed': done,
+                'ligands_failed': len(self.failed),
+                'ligands_remaining': remaining,
+                'ligands_per_second': round(rate, 3),
+                'eta_seconds': round(eta, 1) if eta is not None else None,
+            }
+
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def start_tracking(project_path, run_id=None):
+    """Begin tracking a new run of a project, replacing any old tracker."""
+    with _trackers_lock:
+        tracker = _trackers[project_path] = ProgressTracker(project_path, run_id)
+    return tracker
+
+
+def get_tracker(project_path, run_id=None):
+    """
+    Tracker of a project's run.  With `run_id` (the job id), a tracker left
+    from an earlier run is replaced, so a worker that did not submit the job
+    still starts counting from the new run's log.
+    """
+    with _trackers_lock:
+        tracker = _trackers.get(project_path)
+        if tracker is None or (run_id is not None and tracker.run_id != run_id):
+            tracker = _trackers[project_path] = ProgressTracker(project_path, run_id)
+    return tracker
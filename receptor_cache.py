@@ -0,0 +1,169 @@
+"""
+Cache of parsed receptor structures.
+
+Parsing a large receptor with Bio.PDB takes seconds, so the atom data the grid
+code needs is kept as flat NumPy arrays.  Entries live in an in-memory LRU and
+are also written next to the receptor as .npy sidecars, which are loaded
+memory-mapped so a server restart does not have to parse the PDB again.
+"""
+import os
+import json
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from Bio.PDB import PDBParser
+
+# Bump when the sidecar layout changes so stale caches are rebuilt
+CACHE_VERSION = 1
+
+# Per-atom arrays stored for every receptor
+FIELDS = ('coords', 'chain', 'resseq', 'icode', 'resname', 'name', 'element', 'hetero')
+
+# Values of the `hetero` array
+ATOM, HETATM, WATER = 0, 1, 2
+
+
+class ReceptorData:
+    """Atom arrays of one receptor file, plus a slot for derived data."""
+
+    def __init__(self, path, key, arrays):
+        self.path = path
+        self.key = key
+        self.coords = arrays['coords']    # (N, 3) float32
+        self.chain = arrays['chain']      # (N,) chain identifiers
+        self.resseq = arrays['resseq']    # (N,) int32 residue numbers
+        self.icode = arrays['icode']      # (N,) insertion codes ('' if none)
+        self.resname = arrays['resname']  # (N,) residue names
+        self.name = arrays['name']        # (N,) atom names
+        self.element = arrays['element']  # (N,) element symbols
+        self.hetero = arrays['hetero']    # (N,) ATOM / HETATM / WATER
+        # Structures computed from the arrays (indexes, trees...) keyed by name
+        self.derived = {}
+
+    def __len__(self):
+        return len(self.coords)
+
+
+def file_key(path):
+    """Identity of a receptor file: absolute path, size and mtime."""
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+
+def sidecar_dir(path):
+    folder, filename = os.path.split(os.path.abspath(path))
+    return os.path.join(folder, f'.{filename}.cache')
+
+
+def parse_receptor(path):
+    """Parse the first model of a PDB file into per-atom arrays."""
+    structure = PDBParser(QUIET=True).get_structure('protein', path)
+    models = list(structure)
+    if not models:
+        raise ValueError(f'No atoms found in {path}')
+
+    coords, chain, resseq, icode, resname, name, element, hetero = ([] for _ in FIELDS)
+    for ch in models[0]:
+        for res in ch:
+            hetflag, number, ins = res.id
+            if hetflag == 'W':
+                kind = WATER
+            elif hetflag.strip():
+                kind = HETATM
+            else:
+                kind = ATOM
+            for atom in res:
+                coords.append(atom.coord)
+                chain.append(ch.id)
+                resseq.append(number)
+                icode.append(ins.strip())
+                resname.append(res.resname)
+                name.append(atom.get_name())
+                element.append(atom.element)
+                hetero.append(kind)
+
+    return {
+        'coords': np.asarray(coords, dtype=np.float32).reshape(-1, 3),
+        'chain': np.asarray(chain, dtype='U4'),
+        'resseq': np.asarray(resseq, dtype=np.int32),
+        'icode': np.asarray(icode, dtype='U1'),
+        'resname': np.asarray(resname, dtype='U3'),
+        'name': np.asarray(name, dtype='U4'),
+        'element': np.asarray(element, dtype='U2'),
+        'hetero': np.asarray(hetero, dtype=np.int8),
+    }
+
+
+def _load_sidecar(path, key):
+    folder = sidecar_dir(path)
+    try:
+        with open(os.path.join(folder, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('version') != CACHE_VERSION or [meta.get('size'), meta.get('mtime_ns')] != list(key[1:]):
+        return None
+
+    try:
+        return {field: np.load(os.path.join(folder, f'{field}.npy'), mmap_mode='r') for field in FIELDS}
+    except (OSError, ValueError):
+        return None
+
+
+def _save_sidecar(path, key, arrays):
+    folder = sidecar_dir(path)
+    tmp_folder = f'{folder}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.makedirs(tmp_folder, exist_ok=True)
+        for field in FIELDS:
+            np.save(os.path.join(tmp_folder, f'{field}.npy'), arrays[field])
+        # meta.json is written last: a sidecar without it is never trusted
+        with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'size': key[1], 'mtime_ns': key[2]}, f)
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(tmp_folder, folder)
+    except OSError:
+        # The receptor folder may be read-only; the in-memory entry still works
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+
+class ReceptorCache:
+    """LRU cache of ReceptorData keyed by (path, size, mtime)."""
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        key = file_key(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        arrays = _load_sidecar(path, key)
+        if arrays is None:
+            arrays = parse_receptor(path)
+            _save_sidecar(path, key, arrays)
+        entry = ReceptorData(key[0], key, arrays)
+
+        with self._lock:
+            # Drop entries for older versions of the same file straight away
+            for old_key in [k for k in self._entries if k[0] == key[0]]:
+                del self._entries[old_key]
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+receptor_cache = ReceptorCache()
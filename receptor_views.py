@@ -0,0 +1,118 @@
+"""
+Compact receptor delivery for the 3Dmol viewer.
+
+/get_pdb serves a receptor at one of three levels of detail:
+
+    full       the PDB file as uploaded
+    backbone   N, CA, C and O of the protein residues
+    ca         the CA trace
+
+Reduced models are written from the cached atom arrays (receptor_cache.py),
+so they never need the PDB to be parsed again.  Every payload is gzipped once
+and kept in a small LRU keyed by the file's path, size and mtime, together
+with an ETag derived from the same identity, so a repeated request is served
+from memory or answered with 304 Not Modified.
+"""
+import os
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from receptor_cache import receptor_cache, file_key, ATOM
+
+# Bump when the reduced PDB layout changes so browsers refetch
+VIEW_VERSION = 1
+
+LEVELS = {
+    'full': None,
+    'backbone': ('N', 'CA', 'C', 'O'),
+    'ca': ('CA',),
+}
+
+GZIP_LEVEL = 6
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+class Payload:
+    """One receptor at one level of detail, plain and gzipped."""
+
+    def __init__(self, key, level, data, atoms):
+        self.data = data
+        self.gzipped = gzip.compress(data, GZIP_LEVEL, mtime=0)
+        self.atoms = atoms
+        self.etag = hashlib.sha1(f'{VIEW_VERSION}:{key}:{level}'.encode()).hexdigest()[:24]
+        self.last_modified = key[2] / 1e9
+
+    @property
+    def size(self):
+        return len(self.data) + len(self.gzipped)
+
+
+def _atom_name(name):
+    # Names shorter than four characters start in column 14
+    return name if len(name) == 4 else f' {name:<3}'
+
+
+def reduced_pdb(receptor, names):
+    """PDB text of the protein atoms of `receptor` whose names are in `names`."""
+    atoms = np.flatnonzero((np.asarray(receptor.hetero) == ATOM) & np.isin(np.asarray(receptor.name), names))
+    columns = zip(*(np.asarray(field)[atoms].tolist() for field in (
+        receptor.name, receptor.resname, receptor.chain, receptor.resseq, receptor.icode, receptor.element)))
+    lines = []
+    for serial, ((name, resname, chain, resseq, icode, element), (x, y, z)) in enumerate(
+            zip(columns, np.asarray(receptor.coords)[atoms].tolist()), start=1):
+        lines.append(
+            f'ATOM  {serial % 100000:5d} {_atom_name(name):<4} {resname:>3} {chain[:1]:1}{resseq % 10000:4d}{icode:1}   '
+            f'{x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00          {element:>2}')
+    lines.append('END')
+    return '\n'.join(lines) + '\n', len(atoms)
+
+
+class PayloadCache:
+    """LRU of Payloads keyed by (file key, level), bounded by total bytes."""
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, path, level):
+        key = file_key(path)
+        with self._lock:
+            payload = self._entries.get((key, level))
+            if payload is not None:
+                self._entries.move_to_end((key, level))
+                return payload
+
+        if LEVELS[level] is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+            atoms = None
+        else:
+            text, atoms = reduced_pdb(receptor_cache.get(path), LEVELS[level])
+            data = text.encode()
+        payload = Payload(key, level, data, atoms)
+
+        with self._lock:
+            # Payloads of older versions of the file are never asked for again
+            for old in [k for k in self._entries if k[0][0] == key[0] and k[0] != key]:
+                self._bytes -= self._entries.pop(old).size
+            if (key, level) not in self._entries:
+                self._entries[(key, level)] = payload
+                self._bytes += payload.size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._bytes -= self._entries.popitem(last=False)[1].size
+        return payload
+
+
+payload_cache = PayloadCache()
+
+
+def receptor_payload(path, level='full'):
+    if level not in LEVELS:
+        raise ValueError(f'Unknown level of detail: {level}')
+    return payload_cache.get(os.path.abspath(path), level)
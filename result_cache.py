@@ -0,0 +1,167 @@
+"""
+Content-addressed cache of docking results shared by all projects.
+
+A result is keyed by the SHA-256 of the receptor file, the ligand file, the
+grid box and the search/scoring parameters, so re-docking an identical input
+(in any project) copies the stored pose file instead of running the engine.
+Pose files live under `objects/` and an SQLite index tracks their size and
+last use; when the cache grows past its size limit the least recently used
+entries are evicted.  Hit and miss counters are kept for reporting.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import sqlite3
+
+from manifest import FINGERPRINT_KEYS
+
+# Default size limit, overridable with UNIDOCK_CACHE_MAX_BYTES
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0), ('bytes', 0);
+"""
+
+
+def hash_file(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def params_digest(config):
+    """Digest of the grid box and search/scoring settings of a run config."""
+    params = {key: str(config.get(key)) for key in FINGERPRINT_KEYS}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def result_key(receptor_hash, ligand_hash, params_hash):
+    return hashlib.sha256(f'{receptor_hash}:{ligand_hash}:{params_hash}'.encode()).hexdigest()
+
+
+def default_max_bytes():
+    return int(os.environ.get('UNIDOCK_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes if max_bytes is not None else default_max_bytes()
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(cache_dir, 'index.db'), timeout=30, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+        # The byte counter is kept in step with the entries; re-derive it in
+        # case an older version let it drift
+        self._conn.execute("UPDATE stats SET value = (SELECT COALESCE(SUM(size), 0) FROM entries) "
+                           "WHERE name = 'bytes'")
+        # The limit may have been lowered since the cache was last used
+        self.evict()
+
+    def close(self):
+        self._conn.close()
+
+    def _object_path(self, key):
+        return os.path.join(self.cache_dir, 'objects', key[:2], key + '.pdbqt')
+
+    def _bump(self, name, amount):
+        self._conn.execute('UPDATE stats SET value = value + ? WHERE name = ?', (amount, name))
+
+    def _forget(self, key, size):
+        """Delete the entry of `key` inside a transaction; True if this call removed it."""
+        if self._conn.execute('DELETE FROM entries WHERE key = ?', (key,)).rowcount != 1:
+            # Another process evicted it first and already counted its bytes
+            return False
+        self._bump('bytes', -size)
+        return True
+
+    def fetch(self, key, dest_path):
+        """Copy the cached result for `key` to `dest_path`; False on a miss."""
+        row = self._conn.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            try:
+                shutil.copyfile(self._object_path(key), dest_path)
+            except FileNotFoundError:
+                # The object was removed behind our back; forget the entry
+                self._conn.execute('BEGIN IMMEDIATE')
+                row = self._conn.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self._forget(key, row[0])
+                self._conn.execute('COMMIT')
+            else:
+                self._conn.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+                self._bump('hits', 1)
+                return True
+        self._bump('misses', 1)
+        return False
+
+    def store(self, key, src_path):
+        """Add the result file at `src_path` under `key`, evicting old entries if needed."""
+        path = self._object_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+
+        now = time.time()
+        self._conn.execute('BEGIN IMMEDIATE')
+        old = self._conn.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+        self._conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (key, size, now, now))
+        self._bump('bytes', size - (old[0] if old else 0))
+        self._conn.execute('COMMIT')
+        self.evict()
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits its limit."""
+        while True:
+            # One batch per transaction, so the total read and the entries
+            # deleted agree with what other processes store or evict meanwhile
+            self._conn.execute('BEGIN IMMEDIATE')
+            total = self._conn.execute("SELECT value FROM stats WHERE name = 'bytes'").fetchone()[0]
+            rows = []
+            if total > self.max_bytes:
+                rows = self._conn.execute('SELECT key, size FROM entries ORDER BY last_access LIMIT 100').fetchall()
+            removed = []
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                if self._forget(key, size):
+                    removed.append(key)
+                    total -= size
+            self._conn.execute('COMMIT')
+            for key in removed:
+                try:
+                    os.remove(self._object_path(key))
+                except FileNotFoundError:
+                    pass
+            if not rows or total <= self.max_bytes:
+                return
+
+    def stats(self):
+        values = dict(self._conn.execute('SELECT name, value FROM stats').fetchall())
+        entries = self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        lookups = values['hits'] + values['misses']
+        return {
+            'entries': entries,
+            'bytes': values['bytes'],
+            'max_bytes': self.max_bytes,
+            'hits': values['hits'],
+            'misses': values['misses'],
+            'hit_rate': round(values['hits'] / lookups, 4) if lookups else None,
+        }
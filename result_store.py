@@ -0,0 +1,287 @@
+"""
+Sharded, compressed storage of docking results.
+
+    python result_store.py pack <results_dir> [--shard-mb 256] [--keep]
+    python result_store.py unpack <results_dir>
+    python result_store.py stats <results_dir>
+
+Uni-Dock writes one `<ligand>_out.pdbqt` per ligand, so a large screen leaves
+millions of small files in one directory.  Packing compresses each result file
+on its own (one gzip member) and appends it to a shard under `shards/`, up to
+SHARD_BYTES per shard; the `members` table of results.db records the shard,
+byte offset and length of every member.  Reading a result seeks to its member
+and decompresses that ligand only.  Shards are plain concatenated gzip, so
+`zcat shards/*.gz` still lists every pose.
+
+Pose rows of the results index stay valid, their offsets being within the
+uncompressed file.  `read_result()` prefers a loose file over a packed copy,
+so a ligand docked again after packing reads its new result until that is
+packed as well.  A store only appends to shards it created itself, so several
+writers can pack into one directory.
+
+`pack` migrates an existing results directory (and the receptor and stage
+folders in it), `unpack` writes the loose files back.
+"""
+import os
+import re
+import sys
+import gzip
+import sqlite3
+import argparse
+from contextlib import contextmanager
+
+from results_index import ResultsIndex, DB_NAME, JOURNAL_MODE, RESULT_SUFFIX
+
+SHARD_DIR = 'shards'
+SHARD_SUFFIX = '.pdbqt.gz'
+# Default shard size, overridable with UNIDOCK_SHARD_BYTES
+SHARD_BYTES = 256 * 1024 ** 2
+COMPRESS_LEVEL = 6
+# Files packed per transaction by the migration
+PACK_CHUNK = 1000
+
+_SHARD_RE = re.compile(r'shard_(\d+)' + re.escape(SHARD_SUFFIX) + '$')
+
+
+def default_shard_bytes():
+    return int(os.environ.get('UNIDOCK_SHARD_BYTES', SHARD_BYTES))
+
+
+@contextmanager
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        conn.execute(f'PRAGMA journal_mode={JOURNAL_MODE}')
+        yield conn
+    finally:
+        conn.close()
+
+
+def read_member(results_dir, shard, offset, length):
+    """Uncompressed bytes of one packed result file."""
+    with open(os.path.join(results_dir, SHARD_DIR, shard), 'rb') as f:
+        f.seek(offset)
+        return gzip.decompress(f.read(length))
+
+
+def read_result(results_dir, file_name):
+    """Bytes of a result file, loose or packed; FileNotFoundError if it is neither."""
+    try:
+        with open(os.path.join(results_dir, file_name), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    try:
+        with _connect(os.path.join(results_dir, DB_NAME)) as conn:
+            row = conn.execute('SELECT shard, offset, length FROM members WHERE file = ?', (file_name,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    if row is None:
+        raise FileNotFoundError(os.path.join(results_dir, file_name))
+    return read_member(results_dir, *row)
+
+
+class ResultStore:
+    def __init__(self, results_dir, shard_bytes=None):
+        self.results_dir = results_dir
+        self.shard_dir = os.path.join(results_dir, SHARD_DIR)
+        self.shard_bytes = shard_bytes or default_shard_bytes()
+        # Creates results.db and its members table if needed
+        self.db_path = ResultsIndex(results_dir).db_path
+        self._shard = None
+        self._shard_name = None
+
+    def close(self):
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+
+    def _next_shard(self):
+        self.close()
+        os.makedirs(self.shard_dir, exist_ok=True)
+        with os.scandir(self.shard_dir) as entries:
+            numbers = [int(m.group(1)) for m in (_SHARD_RE.match(e.name) for e in entries) if m]
+        number = max(numbers, default=0)
+        while True:
+            number += 1
+            name = f'shard_{number:06d}{SHARD_SUFFIX}'
+            try:
+                # O_EXCL: no two stores ever append to the same shard
+                fd = os.open(os.path.join(self.shard_dir, name), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                continue
+            self._shard, self._shard_name = os.fdopen(fd, 'wb'), name
+            return
+
+    def put(self, items):
+        """Append (file name, bytes) pairs to the store; returns the compressed bytes written."""
+        rows = []
+        for file_name, data in items:
+            if self._shard is None or self._shard.tell() >= self.shard_bytes:
+                if self._shard is not None:
+                    os.fsync(self._shard.fileno())
+                self._next_shard()
+            member = gzip.compress(data, COMPRESS_LEVEL, mtime=0)
+            rows.append((file_name, self._shard_name, self._shard.tell(), len(member), len(data)))
+            self._shard.write(member)
+        if not rows:
+            return 0
+
+        # Members are on disk before the index points at them
+        self._shard.flush()
+        os.fsync(self._shard.fileno())
+        with _connect(self.db_path) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)', rows)
+            conn.execute('COMMIT')
+        return sum(row[3] for row in rows)
+
+    def pack(self, paths, remove=True):
+        """Move result files into the store; returns (files, bytes read, bytes written)."""
+        items = []
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    items.append((path, f.read()))
+            except FileNotFoundError:
+                continue
+        written = self.put((os.path.basename(path), data) for path, data in items)
+        if remove:
+            for path, _ in items:
+                os.remove(path)
+        return len(items), sum(len(data) for _, data in items), written
+
+    def read(self, file_name):
+        return read_result(self.results_dir, file_name)
+
+    def files(self):
+        """Names of the packed result files."""
+        with _connect(self.db_path) as conn:
+            return {row[0] for row in conn.execute('SELECT file FROM members')}
+
+    def iter_members(self, batch_size=1000):
+        """
+        (file name, bytes) of every packed file, read shard by shard in file
+        order.  Members are looked up a page at a time, so files can be put
+        back while iterating; members put meanwhile (in newer shards) are not
+        returned.
+        """
+        with _connect(self.db_path) as conn:
+            last = conn.execute('SELECT MAX(shard) FROM members').fetchone()[0]
+        shard, offset = '', -1
+        while last is not None:
+            with _connect(self.db_path) as conn:
+                rows = conn.execute(
+                    'SELECT file, shard, offset, length FROM members '
+                    'WHERE shard <= ? AND (shard > ? OR (shard = ? AND offset > ?)) '
+                    'ORDER BY shard, offset LIMIT ?', (last, shard, shard, offset, batch_size)).fetchall()
+            if not rows:
+                break
+            for file_name, shard, offset, length in rows:
+                yield file_name, read_member(self.results_dir, shard, offset, length)
+
+    def stats(self):
+        with _connect(self.db_path) as conn:
+            files, size, stored = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(length), 0) FROM members').fetchone()
+        shards, shard_bytes = 0, 0
+        if os.path.isdir(self.shard_dir):
+            with os.scandir(self.shard_dir) as entries:
+                for entry in entries:
+                    if _SHARD_RE.match(entry.name):
+                        shards += 1
+                        shard_bytes += entry.stat().st_size
+        return {
+            'files': files,
+            'shards': shards,
+            'bytes': size,
+            'stored_bytes': stored,
+            # Superseded members of files packed more than once
+            'dead_bytes': shard_bytes - stored,
+            'ratio': round(stored / size, 4) if size else None,
+        }
+
+
+def result_dirs(results_dir):
+    """`results_dir` and the receptor and stage folders in it that hold results."""
+    dirs = []
+    for root, subdirs, files in os.walk(results_dir):
+        subdirs[:] = sorted(d for d in subdirs if d != SHARD_DIR and not d.startswith('.'))
+        if DB_NAME in files or any(name.endswith(RESULT_SUFFIX) for name in files):
+            dirs.append(root)
+    return dirs
+
+
+def migrate(results_dir, shard_bytes=None, remove=True):
+    """Pack the loose result files of a results directory; returns one report per folder."""
+    reports = []
+    for folder in result_dirs(results_dir):
+        # Poses of loose files must be indexed before the files go
+        ResultsIndex(folder).sync(force=True)
+        with os.scandir(folder) as entries:
+            paths = sorted(e.path for e in entries if e.name.endswith(RESULT_SUFFIX) and e.is_file())
+        store = ResultStore(folder, shard_bytes)
+        report = {'folder': folder, 'files': 0, 'bytes': 0, 'stored_bytes': 0}
+        try:
+            for start in range(0, len(paths), PACK_CHUNK):
+                files, size, written = store.pack(paths[start:start + PACK_CHUNK], remove)
+                report['files'] += files
+                report['bytes'] += size
+                report['stored_bytes'] += written
+        finally:
+            store.close()
+        reports.append(report)
+    return reports
+
+
+def unpack(results_dir):
+    """Write every packed result back as a loose file and drop the shards; returns files written."""
+    written = 0
+    for folder in result_dirs(results_dir):
+        store = ResultStore(folder)
+        for file_name, data in store.iter_members():
+            path = os.path.join(folder, file_name)
+            # A loose file is newer than its packed copy
+            if os.path.exists(path):
+                continue
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            written += 1
+        with _connect(store.db_path) as conn:
+            conn.execute('DELETE FROM members')
+        if os.path.isdir(store.shard_dir):
+            for name in os.listdir(store.shard_dir):
+                if _SHARD_RE.match(name):
+                    os.remove(os.path.join(store.shard_dir, name))
+            os.rmdir(store.shard_dir)
+        # Unpacked files must match the index's size and mtime again
+        ResultsIndex(folder).sync(force=True)
+    return written
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Pack docking results into compressed shards, or unpack them.')
+    parser.add_argument('command', choices=['pack', 'unpack', 'stats'])
+    parser.add_argument('results_dir')
+    parser.add_argument('--shard-mb', type=int, default=None, help='shard size in MiB')
+    parser.add_argument('--keep', action='store_true', help='keep the loose files after packing')
+    args = parser.parse_args(argv[1:])
+
+    if args.command == 'pack':
+        shard_bytes = args.shard_mb * 1024 ** 2 if args.shard_mb else None
+        for report in migrate(args.results_dir, shard_bytes, remove=not args.keep):
+            ratio = report['stored_bytes'] / report['bytes'] if report['bytes'] else 0
+            print(f"{report['folder']}: packed {report['files']} file(s), "
+                  f"{report['bytes']} -> {report['stored_bytes']} bytes ({ratio:.0%}).")
+    elif args.command == 'unpack':
+        print(f'Unpacked {unpack(args.results_dir)} file(s).')
+    else:
+        for folder in result_dirs(args.results_dir):
+            print(folder, ResultStore(folder).stats())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
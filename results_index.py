@@ -0,0 +1,340 @@
+"""
+Scored-results index of a docking run.
+
+Every `<ligand>_out.pdbqt` in a results directory is parsed once for its
+`REMARK VINA RESULT` lines and recorded in `results.db` (SQLite, in the same
+directory): one row per pose with its rank, score and the byte offset and
+length of its MODEL block.  The driver adds files as each batch finishes and
+records the directory's mtime as it does; `sync()` catches up with files
+written by anything else, and only scans when the directory changed since.
+Queries (top-N pages, score histograms) are served from the table alone.
+
+Result files packed into compressed shards (result_store.py) keep their pose
+rows; the `members` table says where each packed file is, and poses of packed
+files carry that location as `packed` (shard, offset, length).
+"""
+import io
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_NAME = 'results.db'
+RESULT_SUFFIX = '_out.pdbqt'
+# Not WAL: its -wal file comes and goes with every connection and would
+# change the directory's mtime, which sync() relies on
+JOURNAL_MODE = 'TRUNCATE'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS poses (
+    ligand TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    score REAL NOT NULL,
+    file TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (ligand, rank)
+);
+CREATE INDEX IF NOT EXISTS poses_rank_score ON poses (rank, score);
+CREATE INDEX IF NOT EXISTS poses_file ON poses (file);
+CREATE TABLE IF NOT EXISTS members (
+    file TEXT PRIMARY KEY,
+    shard TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS members_shard ON members (shard, offset);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+_CONSENSUS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS consensus (
+    ligand TEXT PRIMARY KEY,
+    best_score REAL NOT NULL,
+    mean_score REAL NOT NULL,
+    receptors INTEGER NOT NULL,
+    best_receptor TEXT
+);
+CREATE INDEX IF NOT EXISTS consensus_best ON consensus (best_score);
+CREATE INDEX IF NOT EXISTS consensus_mean ON consensus (mean_score);
+"""
+
+# One sync per results directory at a time
+_sync_locks = {}
+_sync_locks_guard = threading.Lock()
+
+
+def ligand_of(file_name):
+    return file_name[:-len(RESULT_SUFFIX)]
+
+
+def parse_poses(path):
+    """[(rank, score, offset, length)] of the scored poses in a result file."""
+    with open(path, 'rb') as f:
+        return pose_rows(f)
+
+
+def pose_rows(lines):
+    """[(rank, score, offset, length)] of the scored poses in binary result lines."""
+    poses = []
+    offset = 0
+    start, score = 0, None
+    for line in lines:
+        if line.startswith(b'MODEL'):
+            start, score = offset, None
+        elif line.startswith(b'REMARK VINA RESULT'):
+            try:
+                score = float(line.split(b':', 1)[1].split()[0])
+            except (IndexError, ValueError):
+                score = None
+        elif line.startswith(b'ENDMDL') and score is not None:
+            poses.append((len(poses) + 1, score, start, offset + len(line) - start))
+            score = None
+        offset += len(line)
+    if score is not None:
+        # Single pose without MODEL/ENDMDL records
+        poses.append((len(poses) + 1, score, start, offset - start))
+    return poses
+
+
+# Poses with the shard location of their file, when it is packed
+_POSE_QUERY = ('SELECT p.ligand, p.rank, p.score, p.file, p.offset, p.length, m.shard, m.offset, m.length '
+               'FROM poses p LEFT JOIN members m ON m.file = p.file')
+
+
+def _pose_dict(row):
+    ligand, rank, score, file, offset, length, shard, member_offset, member_length = row
+    pose = {'ligand': ligand, 'rank': rank, 'score': score, 'file': file, 'offset': offset, 'length': length}
+    if shard is not None:
+        pose['packed'] = (shard, member_offset, member_length)
+    return pose
+
+
+@contextmanager
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        conn.execute(f'PRAGMA journal_mode={JOURNAL_MODE}')
+        yield conn
+    finally:
+        conn.close()
+
+
+class ResultsIndex:
+    def __init__(self, results_dir):
+        self.results_dir = results_dir
+        self.db_path = os.path.join(results_dir, DB_NAME)
+        os.makedirs(results_dir, exist_ok=True)
+        with _connect(self.db_path) as conn:
+            conn.executescript(_SCHEMA)
+
+    def _index_files(self, conn, file_names):
+        conn.execute('BEGIN IMMEDIATE')
+        for name in file_names:
+            path = os.path.join(self.results_dir, name)
+            conn.execute('DELETE FROM poses WHERE file = ?', (name,))
+            try:
+                st = os.stat(path)
+                poses = parse_poses(path)
+            except FileNotFoundError:
+                conn.execute('DELETE FROM files WHERE file = ?', (name,))
+                continue
+            ligand = ligand_of(name)
+            conn.executemany(
+                'INSERT OR REPLACE INTO poses VALUES (?, ?, ?, ?, ?, ?)',
+                [(ligand, rank, score, name, offset, length) for rank, score, offset, length in poses])
+            conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (name, st.st_size, st.st_mtime_ns))
+        conn.execute('COMMIT')
+
+    def add(self, paths):
+        """
+        Index (or re-index) result files that were just written.  The caller is
+        the directory's only writer, so the index is then in sync with it.
+        """
+        names = [os.path.basename(p) for p in paths]
+        with _connect(self.db_path) as conn:
+            if names:
+                self._index_files(conn, names)
+            self._mark_synced(conn)
+
+    def add_packed(self, items):
+        """Re-index the poses of packed result files from their (file name, bytes)."""
+        with _connect(self.db_path) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for name, data in items:
+                conn.execute('DELETE FROM poses WHERE file = ?', (name,))
+                conn.executemany(
+                    'INSERT OR REPLACE INTO poses VALUES (?, ?, ?, ?, ?, ?)',
+                    [(ligand_of(name), rank, score, name, offset, length)
+                     for rank, score, offset, length in pose_rows(io.BytesIO(data))])
+            conn.execute('COMMIT')
+
+    def mark_synced(self):
+        """Record the directory as indexed, after its writer removed or packed files."""
+        with _connect(self.db_path) as conn:
+            self._mark_synced(conn)
+
+    def _mark_synced(self, conn):
+        try:
+            dir_mtime = os.stat(self.results_dir).st_mtime_ns
+        except FileNotFoundError:
+            return
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('dir_mtime_ns', ?)", (dir_mtime,))
+
+    def sync(self, force=False):
+        """Bring the index up to date with the directory; returns files (re)indexed."""
+        try:
+            dir_mtime = os.stat(self.results_dir).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+        with _sync_lock(self.results_dir), _connect(self.db_path) as conn:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'dir_mtime_ns'").fetchone()
+            if not force and row is not None and row[0] == dir_mtime:
+                return 0
+
+            known = {name: (size, mtime) for name, size, mtime in conn.execute('SELECT * FROM files')}
+            # Packed files are gone from the directory but not from the results
+            packed = {row[0] for row in conn.execute('SELECT file FROM members')}
+            changed, present = [], set()
+            with os.scandir(self.results_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(RESULT_SUFFIX) or not entry.is_file():
+                        continue
+                    present.add(entry.name)
+                    st = entry.stat()
+                    if known.get(entry.name) != (st.st_size, st.st_mtime_ns):
+                        changed.append(entry.name)
+            changed.extend(name for name in known if name not in present and name not in packed)
+            if changed:
+                self._index_files(conn, changed)
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('dir_mtime_ns', ?)", (dir_mtime,))
+            return len(changed)
+
+    def top(self, limit=50, offset=0, rank=1, max_score=None):
+        """Best-scoring poses of one rank (best pose per ligand by default), with the total count."""
+        where, args = ['rank = ?'], [rank]
+        if max_score is not None:
+            where.append('score <= ?')
+            args.append(max_score)
+        clause = ' AND '.join(where)
+        with _connect(self.db_path) as conn:
+            total = conn.execute(f'SELECT COUNT(*) FROM poses WHERE {clause}', args).fetchone()[0]
+            rows = conn.execute(
+                f'{_POSE_QUERY} WHERE {clause} ORDER BY score, ligand LIMIT ? OFFSET ?', args + [limit, offset]).fetchall()
+        return total, [_pose_dict(row) for row in rows]
+
+    def iter_poses(self, rank=1, max_score=None, limit=None, batch_size=1000):
+        """
+        Poses in score order (of one rank, or all ranks with rank=None), read
+        from the table in batches so memory use does not depend on `limit`.
+        """
+        where, args = [], []
+        if rank is not None:
+            where.append('rank = ?')
+            args.append(rank)
+        if max_score is not None:
+            where.append('score <= ?')
+            args.append(max_score)
+        query = _POSE_QUERY
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY score, ligand, rank'
+        if limit is not None:
+            query += ' LIMIT ?'
+            args.append(limit)
+        with _connect(self.db_path) as conn:
+            cursor = conn.execute(query, args)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield _pose_dict(row)
+
+    def histogram(self, bins=20, rank=1):
+        """Score histogram of one pose rank: bin edges and counts."""
+        with _connect(self.db_path) as conn:
+            low, high = conn.execute('SELECT MIN(score), MAX(score) FROM poses WHERE rank = ?', (rank,)).fetchone()
+            if low is None:
+                return {'edges': [], 'counts': []}
+            width = (high - low) / bins or 1.0
+            counts = [0] * bins
+            for b, count in conn.execute(
+                    'SELECT MIN(CAST((score - ?) / ? AS INTEGER), ?), COUNT(*) FROM poses WHERE rank = ? GROUP BY 1',
+                    (low, width, bins - 1, rank)):
+                counts[b] = count
+        return {'edges': [round(low + i * width, 3) for i in range(bins + 1)], 'counts': counts}
+
+    def pose(self, ligand, rank=1):
+        with _connect(self.db_path) as conn:
+            row = conn.execute(f'{_POSE_QUERY} WHERE ligand = ? AND rank = ?', (ligand, rank)).fetchone()
+        return _pose_dict(row) if row is not None else None
+
+    def counts(self):
+        with _connect(self.db_path) as conn:
+            ligands = conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+            poses = conn.execute('SELECT COUNT(*) FROM poses').fetchone()[0]
+        return {'ligands': ligands, 'poses': poses}
+
+
+def write_consensus(results_dir, receptors):
+    """
+    Per-ligand consensus of an ensemble run: best and mean best-pose score
+    over the receptor result folders `results_dir/<receptor>`, stored in the
+    `consensus` table of `results_dir/results.db`.  Returns the ligand count.
+    """
+    ResultsIndex(results_dir)
+    with _connect(os.path.join(results_dir, DB_NAME)) as conn:
+        conn.executescript(_CONSENSUS_SCHEMA)
+        conn.execute('CREATE TEMP TABLE scores (ligand TEXT, receptor TEXT, score REAL)')
+        for receptor in receptors:
+            # One receptor database attached at a time keeps clear of SQLite's attach limit
+            db_path = os.path.join(results_dir, receptor, DB_NAME)
+            if not os.path.exists(db_path):
+                continue
+            conn.execute('ATTACH DATABASE ? AS receptor_db', (db_path,))
+            conn.execute('INSERT INTO scores SELECT ligand, ?, score FROM receptor_db.poses WHERE rank = 1', (receptor,))
+            conn.execute('DETACH DATABASE receptor_db')
+        conn.execute('CREATE INDEX temp.scores_ligand ON scores (ligand, score)')
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM consensus')
+        conn.execute(
+            'INSERT INTO consensus '
+            'SELECT s.ligand, MIN(s.score), AVG(s.score), COUNT(*), '
+            '(SELECT b.receptor FROM scores b WHERE b.ligand = s.ligand ORDER BY b.score LIMIT 1) '
+            'FROM scores s GROUP BY s.ligand')
+        conn.execute('COMMIT')
+        conn.execute('DROP TABLE scores')
+        return conn.execute('SELECT COUNT(*) FROM consensus').fetchone()[0]
+
+
+def consensus_top(results_dir, limit=50, offset=0, order='best'):
+    """A page of the consensus table ordered by best or mean score, with the total count."""
+    column = 'mean_score' if order == 'mean' else 'best_score'
+    with _connect(os.path.join(results_dir, DB_NAME)) as conn:
+        conn.executescript(_CONSENSUS_SCHEMA)
+        total = conn.execute('SELECT COUNT(*) FROM consensus').fetchone()[0]
+        rows = conn.execute(
+            f'SELECT ligand, best_score, mean_score, receptors, best_receptor FROM consensus '
+            f'ORDER BY {column}, ligand LIMIT ? OFFSET ?', (limit, offset)).fetchall()
+    hits = [
+        {'ligand': ligand, 'best_score': best, 'mean_score': round(mean, 3), 'receptors': count,
+         'best_receptor': best_receptor}
+        for ligand, best, mean, count, best_receptor in rows
+    ]
+    return total, hits
+
+
+def _sync_lock(results_dir):
+    with _sync_locks_guard:
+        return _sync_locks.setdefault(os.path.abspath(results_dir), threading.Lock())
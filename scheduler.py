@@ -0,0 +1,478 @@
+"""
+Persistent docking job scheduler.
+
+Jobs are stored in a SQLite database under the workspace so they survive a
+server restart.  A dispatcher thread starts queued jobs, highest priority
+first, whenever one of a fixed number of worker slots is free.  Each slot owns
+a share of the CPU cores and, when GPU devices are configured, one device, so
+concurrent runs never oversubscribe the machine.
+
+Every job runs under a small wrapper process (`python scheduler.py exec ...`)
+that owns the docking process and records its exit status in the database
+itself, so a job's final state is known even if the server was restarted
+while it ran.
+
+Several server workers may share one database: only the worker holding the
+dispatcher lock (an flock on `<db>.lock`) starts and reaps jobs; the others
+only submit, query and cancel, and one of them takes over the lock when its
+holder exits.
+
+Configuration (environment):
+    UNIDOCK_GPU_DEVICES   comma-separated device ids, e.g. "0,1"
+    UNIDOCK_MAX_WORKERS   number of concurrent jobs (default: one per GPU, or 1)
+"""
+import os
+import sys
+import json
+import time
+import signal
+import sqlite3
+import threading
+import subprocess
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Without flock every process dispatches; claiming a job is atomic anyway
+    fcntl = None
+
+import metrics
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+# How often the dispatcher looks for finished and queued jobs (seconds)
+DISPATCH_INTERVAL = 1.0
+# How often a job's wrapper looks for a cancel request, and how long a
+# cancelled docking process may take to stop before it is killed (seconds)
+CANCEL_POLL_INTERVAL = 1.0
+CANCEL_GRACE_SECONDS = 30.0
+
+QUEUE_WAIT_SECONDS = metrics.histogram('unidock_job_queue_wait_seconds', 'Time jobs spent queued before starting.',
+                                       buckets=metrics.LONG_BUCKETS)
+RUN_SECONDS = metrics.histogram('unidock_job_run_seconds', 'Run time of jobs started by this server, by final state.',
+                                ('state',), buckets=metrics.LONG_BUCKETS)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_path TEXT NOT NULL,
+    command TEXT NOT NULL,
+    log_path TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    resources TEXT,
+    pid INTEGER,
+    pid_token TEXT,
+    return_code INTEGER,
+    error TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, priority DESC, id);
+CREATE INDEX IF NOT EXISTS jobs_project ON jobs (project_path, id);
+"""
+
+
+@contextmanager
+def _connect(db_path):
+    # Autocommit connection; multi-statement updates use BEGIN IMMEDIATE
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        yield conn
+    finally:
+        conn.close()
+
+
+def _row_to_job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job['command'] = json.loads(job['command'])
+    job['resources'] = json.loads(job['resources']) if job['resources'] else None
+    return job
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _process_token(pid):
+    """
+    Boot id and start time (clock ticks since boot, /proc/<pid>/stat field 22)
+    of a process, which tell it apart from a later one given the same pid;
+    None where /proc is not available.
+    """
+    try:
+        with open('/proc/sys/kernel/random/boot_id', 'r') as f:
+            boot_id = f.read().strip()
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name (field 2) may hold spaces and parentheses
+    return f"{boot_id}:{int(stat[stat.rindex(b')') + 2:].split()[19])}"
+
+
+def _job_alive(pid, token):
+    """True while `pid` is still the process recorded for a job, not a reuse of its pid."""
+    if not pid or not _pid_alive(pid):
+        return False
+    return token is None or _process_token(pid) == token
+
+
+def _signal_group(pid, sig):
+    """Signal a process and everything it started (its process group on POSIX)."""
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(pid, sig)
+        else:
+            os.kill(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def default_slots():
+    """Worker slots from the environment: a CPU core set and optional GPU each."""
+    gpus = [d.strip() for d in os.environ.get('UNIDOCK_GPU_DEVICES', '').split(',') if d.strip()]
+    workers = max(1, int(os.environ.get('UNIDOCK_MAX_WORKERS', len(gpus) or 1)))
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+
+    per_slot = max(1, len(cores) // workers)
+    slots = []
+    for i in range(workers):
+        cpus = cores[i * per_slot:(i + 1) * per_slot] or cores
+        slots.append({'slot': i, 'cpus': cpus, 'gpu': gpus[i % len(gpus)] if gpus else None})
+    return slots
+
+
+class JobScheduler:
+    def __init__(self, db_path, slots=None):
+        self.db_path = db_path
+        self.slots = slots if slots is not None else default_slots()
+        self._wrappers = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock_file = None
+        self._dispatching = False
+        with _connect(self.db_path) as conn:
+            conn.executescript(_SCHEMA)
+            # Databases created before cancel requests and pid tokens were recorded
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for column, definition in (('cancel_requested', 'INTEGER NOT NULL DEFAULT 0'), ('pid_token', 'TEXT')):
+                if column in columns:
+                    continue
+                try:
+                    conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {definition}')
+                except sqlite3.OperationalError:
+                    # Another worker added it first
+                    pass
+
+    # --- Queue API ---
+
+    def submit(self, project_path, command, log_path, priority=0):
+        with _connect(self.db_path) as conn:
+            cur = conn.execute(
+                'INSERT INTO jobs (project_path, command, log_path, priority, state, submitted) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (project_path, json.dumps(command), log_path, int(priority), QUEUED, time.time()))
+            job_id = cur.lastrowid
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id):
+        with _connect(self.db_path) as conn:
+            return _row_to_job(conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+    def latest_for_project(self, project_path):
+        with _connect(self.db_path) as conn:
+            return _row_to_job(conn.execute(
+                'SELECT * FROM jobs WHERE project_path = ? ORDER BY id DESC LIMIT 1',
+                (project_path,)).fetchone())
+
+    def list_jobs(self, states=None, limit=100, project_path=None):
+        where, args = [], []
+        if states:
+            where.append(f'state IN ({",".join("?" * len(states))})')
+            args.extend(states)
+        if project_path is not None:
+            where.append('project_path = ?')
+            args.append(project_path)
+        query = 'SELECT * FROM jobs'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY id DESC LIMIT ?'
+        args.append(limit)
+        with _connect(self.db_path) as conn:
+            return [_row_to_job(row) for row in conn.execute(query, args)]
+
+    def queue_position(self, job):
+        """1-based position of a queued job in dispatch order."""
+        with _connect(self.db_path) as conn:
+            ahead = conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE state = ? AND (priority > ? OR (priority = ? AND id < ?))',
+                (QUEUED, job['priority'], job['priority'], job['id'])).fetchone()[0]
+        return ahead + 1
+
+    def counts(self, project_path=None):
+        """Jobs per state, of one project or of all."""
+        with _connect(self.db_path) as conn:
+            if project_path is None:
+                rows = conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+            else:
+                rows = conn.execute('SELECT state, COUNT(*) FROM jobs WHERE project_path = ? GROUP BY state',
+                                    (project_path,)).fetchall()
+        return {state: count for state, count in rows}
+
+    def cancel(self, job_id):
+        """Cancel a queued job or stop a running one. Returns False if already finished."""
+        with _connect(self.db_path) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT state, pid, pid_token FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None or row['state'] not in ACTIVE_STATES:
+                conn.execute('COMMIT')
+                return False
+            if row['state'] == QUEUED:
+                conn.execute('UPDATE jobs SET state = ?, finished = ? WHERE id = ?', (CANCELLED, time.time(), job_id))
+                conn.execute('COMMIT')
+                return True
+            # A wrapper that is still starting (no pid yet) finds the request itself
+            conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+            conn.execute('COMMIT')
+
+        # The wrapper stops the docking process group and records the
+        # cancelled state once it has exited
+        if _job_alive(row['pid'], row['pid_token']):
+            try:
+                os.kill(row['pid'], signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        return True
+
+    # --- Dispatcher ---
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='job-dispatcher', daemon=True)
+        self._thread.start()
+
+    def is_dispatcher(self):
+        """Take the dispatcher lock if it is free; True while this process holds it."""
+        if self._dispatching:
+            return True
+        if fcntl is not None:
+            lock_file = open(f'{self.db_path}.lock', 'a+')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            lock_file.seek(0)
+            lock_file.truncate()
+            lock_file.write(f'{os.getpid()}\n')
+            lock_file.flush()
+            # The lock goes with the process, so a crashed holder never keeps it
+            self._lock_file = lock_file
+        self._dispatching = True
+        self._recover()
+        return True
+
+    def _recover(self):
+        # Jobs whose wrapper died without recording an exit status (e.g. the
+        # machine rebooted) cannot be followed any more; a live process that
+        # only reuses the wrapper's pid does not keep them running
+        with _connect(self.db_path) as conn:
+            for row in conn.execute('SELECT id, pid, pid_token FROM jobs WHERE state = ?', (RUNNING,)).fetchall():
+                if not _job_alive(row['pid'], row['pid_token']):
+                    conn.execute(
+                        'UPDATE jobs SET state = ?, error = ?, finished = ? WHERE id = ? AND state = ?',
+                        (FAILED, 'Job was interrupted before it finished.', time.time(), row['id'], RUNNING))
+
+    def _run(self):
+        while True:
+            try:
+                if self.is_dispatcher():
+                    self.dispatch()
+            except Exception as e:
+                print(f'Job dispatcher error: {e}', file=sys.stderr)
+            self._wake.wait(DISPATCH_INTERVAL)
+            self._wake.clear()
+
+    def dispatch(self):
+        """Reap finished wrappers and start queued jobs on free slots."""
+        with self._lock:
+            self._reap()
+            while True:
+                job, slot = self._claim_next()
+                if job is None:
+                    break
+                self._spawn(job, slot)
+
+    def _reap(self):
+        for job_id, wrapper in list(self._wrappers.items()):
+            if wrapper.poll() is None:
+                continue
+            del self._wrappers[job_id]
+            # A wrapper that exits without recording a state has crashed, or was
+            # cancelled before it could start the docking process
+            with _connect(self.db_path) as conn:
+                conn.execute(
+                    'UPDATE jobs SET state = ?, error = ?, return_code = ?, finished = ? '
+                    'WHERE id = ? AND state = ? AND cancel_requested = 1',
+                    (CANCELLED, 'Cancelled by user.', wrapper.returncode, time.time(), job_id, RUNNING))
+                conn.execute(
+                    'UPDATE jobs SET state = ?, error = ?, return_code = ?, finished = ? WHERE id = ? AND state = ?',
+                    (FAILED, 'Job wrapper exited unexpectedly.', wrapper.returncode, time.time(), job_id, RUNNING))
+                row = conn.execute('SELECT state, started, finished FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is not None and row['started'] and row['finished']:
+                RUN_SECONDS.observe(row['finished'] - row['started'], state=row['state'])
+
+    def _claim_next(self):
+        with _connect(self.db_path) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            busy = set()
+            for row in conn.execute('SELECT resources FROM jobs WHERE state = ?', (RUNNING,)):
+                if row['resources']:
+                    busy.add(json.loads(row['resources'])['slot'])
+            free = [slot for slot in self.slots if slot['slot'] not in busy]
+            row = None
+            if free:
+                row = conn.execute(
+                    'SELECT * FROM jobs WHERE state = ? ORDER BY priority DESC, id LIMIT 1', (QUEUED,)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None, None
+
+            slot = free[0]
+            started = time.time()
+            conn.execute(
+                'UPDATE jobs SET state = ?, resources = ?, started = ? WHERE id = ?',
+                (RUNNING, json.dumps(slot), started, row['id']))
+            conn.execute('COMMIT')
+        QUEUE_WAIT_SECONDS.observe(max(started - row['submitted'], 0.0))
+        return _row_to_job(row), slot
+
+    def _spawn(self, job, slot):
+        env = dict(os.environ)
+        env['OMP_NUM_THREADS'] = str(len(slot['cpus']))
+        if slot['gpu'] is not None:
+            env['CUDA_VISIBLE_DEVICES'] = str(slot['gpu'])
+
+        try:
+            with metrics.stage('process_spawn'):
+                # Own session so stopping the server does not kill the job. No
+                # preexec_fn: it is unsafe in the threaded server, so the wrapper
+                # pins itself to the slot's cores (_exec_job)
+                wrapper = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), 'exec', self.db_path, str(job['id'])],
+                    env=env, start_new_session=True)
+        except OSError as e:
+            with _connect(self.db_path) as conn:
+                conn.execute('UPDATE jobs SET state = ?, error = ?, finished = ? WHERE id = ?',
+                             (FAILED, f'Could not start job: {e}', time.time(), job['id']))
+            return
+
+        self._wrappers[job['id']] = wrapper
+        with _connect(self.db_path) as conn:
+            conn.execute('UPDATE jobs SET pid = ?, pid_token = ? WHERE id = ?',
+                         (wrapper.pid, _process_token(wrapper.pid), job['id']))
+
+
+def _cancel_requested(db_path, job_id):
+    with _connect(db_path) as conn:
+        row = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    return row is None or bool(row['cancel_requested'])
+
+
+def _exec_job(db_path, job_id):
+    """Body of the wrapper process: run one job and record how it ended."""
+    # Time the docking process was asked to stop, once cancelled. The handler is
+    # installed before the process starts: a cancel that arrives earlier is
+    # remembered and forwarded as soon as the process exists.
+    stop_requested = []
+    running = []
+
+    def stop(signum=None, frame=None):
+        if not stop_requested:
+            stop_requested.append(time.monotonic())
+            if running:
+                _signal_group(running[0].pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, stop)
+
+    with _connect(db_path) as conn:
+        conn.execute('UPDATE jobs SET pid = ?, pid_token = ? WHERE id = ?',
+                     (os.getpid(), _process_token(os.getpid()), job_id))
+        job = _row_to_job(conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+    # The slot's cores, set before the docking process (which inherits them) starts
+    cpus = (job['resources'] or {}).get('cpus')
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+    os.makedirs(os.path.dirname(job['log_path']) or '.', exist_ok=True)
+    with open(job['log_path'], 'w') as log_file:
+        child = None
+        if job['cancel_requested'] or stop_requested:
+            state, return_code, error = CANCELLED, None, 'Cancelled by user.'
+        else:
+            try:
+                # Own process group: the driver and the engine it starts are stopped together
+                child = subprocess.Popen(job['command'], stdout=log_file, stderr=subprocess.STDOUT,
+                                         start_new_session=True)
+            except OSError as e:
+                log_file.write(f'Could not start docking process: {e}\n')
+                state, return_code, error = FAILED, None, str(e)
+
+        if child is not None:
+            running.append(child)
+            if stop_requested:
+                # Cancelled while the process was being started
+                _signal_group(child.pid, signal.SIGTERM)
+
+            while True:
+                try:
+                    return_code = child.wait(timeout=CANCEL_POLL_INTERVAL)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if not stop_requested and _cancel_requested(db_path, job_id):
+                    stop()
+                elif stop_requested and time.monotonic() - stop_requested[0] > CANCEL_GRACE_SECONDS:
+                    _signal_group(child.pid, getattr(signal, 'SIGKILL', signal.SIGTERM))
+            if stop_requested:
+                if hasattr(os, 'killpg'):
+                    # Whatever is left of the group (engine processes) goes too
+                    _signal_group(child.pid, signal.SIGKILL)
+                state, error = CANCELLED, 'Cancelled by user.'
+            elif return_code == 0:
+                state, error = DONE, None
+            else:
+                state, error = FAILED, f'Docking process exited with code {return_code}.'
+
+    with _connect(db_path) as conn:
+        conn.execute('UPDATE jobs SET state = ?, return_code = ?, error = ?, finished = ? WHERE id = ?',
+                     (state, return_code, error, time.time(), job_id))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'exec':
+        _exec_job(sys.argv[2], int(sys.argv[3]))
+    else:
+        print('usage: scheduler.py exec <db_path> <job_id>', file=sys.stderr)
+        sys.exit(2)
@@ -0,0 +1,169 @@
+"""
+Residue selection for targeted grid mode.
+
+A ResidueIndex is built once per cached receptor and turns selector strings
+into boolean atom masks.  Supported selectors (case-insensitive keywords):
+
+    A:100           one residue
+    A:52A           residue with insertion code
+    A:100-140       inclusive residue range (insertion codes allowed at both ends)
+    A,B:100-140     the same residues on several chains
+    A or A:*        a whole chain
+    ligand          every HETATM residue except water
+    ligand:ATP      HETATM residues with the given residue name
+    within 6 of ligand
+                    residues with any atom within 6 A of another selection
+"""
+import re
+
+import numpy as np
+
+from receptor_cache import HETATM
+
+_RESIDUE_RE = re.compile(r'^(-?\d+)([A-Za-z]?)$')
+_WITHIN_RE = re.compile(r'^within\s+([0-9]*\.?[0-9]+)\s+of\s+(.+)$', re.IGNORECASE)
+
+# Distances are computed in blocks of this many anchor atoms (and 8x as many
+# receptor atoms) to keep memory bounded on large selections
+_BLOCK = 512
+
+
+class SelectionError(ValueError):
+    pass
+
+
+def _parse_residue(text):
+    match = _RESIDUE_RE.match(text.strip())
+    if not match:
+        raise SelectionError(f'Invalid residue number "{text}".')
+    return int(match.group(1)), match.group(2).upper()
+
+
+class ResidueIndex:
+    """Residue table of a receptor: chain -> (resnum, icode) -> atom slice."""
+
+    def __init__(self, receptor):
+        self.receptor = receptor
+        n_atoms = len(receptor)
+
+        # Atoms of one residue are contiguous, so residues start where the
+        # (chain, resseq, icode) triple changes
+        chain = np.asarray(receptor.chain)
+        resseq = np.asarray(receptor.resseq)
+        icode = np.asarray(receptor.icode)
+        change = np.ones(n_atoms, dtype=bool)
+        if n_atoms:
+            change[1:] = (chain[1:] != chain[:-1]) | (resseq[1:] != resseq[:-1]) | (icode[1:] != icode[:-1])
+        self.starts = np.flatnonzero(change)
+        self.stops = np.append(self.starts[1:], n_atoms)
+
+        self.chain = chain[self.starts]
+        self.resseq = resseq[self.starts]
+        self.icode = icode[self.starts]
+        self.resname = np.asarray(receptor.resname)[self.starts]
+        self.hetero = np.asarray(receptor.hetero)[self.starts]
+        self.atom_residue = np.repeat(np.arange(len(self.starts)), self.stops - self.starts)
+
+        self.lookup = {}
+        for i, (ch, seq, ins) in enumerate(zip(self.chain.tolist(), self.resseq.tolist(), self.icode.tolist())):
+            self.lookup.setdefault(ch, {})[(seq, ins)] = i
+
+    def __len__(self):
+        return len(self.starts)
+
+    def atom_slice(self, chain_id, resseq, icode=''):
+        i = self.lookup.get(chain_id, {}).get((resseq, icode))
+        if i is None:
+            return None
+        return slice(int(self.starts[i]), int(self.stops[i]))
+
+    def residues_to_atoms(self, residue_mask):
+        return residue_mask[self.atom_residue]
+
+    def select(self, selectors):
+        """Boolean atom mask for a selector string or list of selectors."""
+        if isinstance(selectors, str):
+            selectors = [selectors]
+        mask = np.zeros(len(self.receptor), dtype=bool)
+        for selector in selectors:
+            mask |= self.select_one(selector)
+        return mask
+
+    def select_one(self, selector):
+        selector = selector.strip()
+        if not selector:
+            raise SelectionError('Empty residue selector.')
+
+        within = _WITHIN_RE.match(selector)
+        if within:
+            return self._within(float(within.group(1)), self.select_one(within.group(2)))
+
+        residue_mask = np.zeros(len(self), dtype=bool)
+        head, _, tail = selector.partition(':')
+
+        if head.strip().lower() == 'ligand':
+            residue_mask = self.hetero == HETATM
+            if tail.strip():
+                residue_mask &= self.resname == tail.strip().upper()
+            return self.residues_to_atoms(residue_mask)
+
+        chains = [c.strip() for c in head.split(',') if c.strip()]
+        if not chains:
+            raise SelectionError(f'No chain given in "{selector}".')
+        tail = tail.strip()
+
+        for chain_id in chains:
+            if chain_id not in self.lookup:
+                continue
+            on_chain = self.chain == chain_id
+            if tail in ('', '*'):
+                residue_mask |= on_chain
+            elif '-' in tail[1:]:
+                # Split on the dash that separates the bounds, not a minus sign
+                cut = tail.index('-', 1)
+                lo_seq, lo_ins = _parse_residue(tail[:cut])
+                hi_seq, hi_ins = _parse_residue(tail[cut + 1:])
+                above = (self.resseq > lo_seq) | ((self.resseq == lo_seq) & (self.icode >= lo_ins))
+                below = (self.resseq < hi_seq) | ((self.resseq == hi_seq) & (self.icode <= hi_ins))
+                residue_mask |= on_chain & above & below
+            else:
+                i = self.lookup[chain_id].get(_parse_residue(tail))
+                if i is not None:
+                    residue_mask[i] = True
+        return self.residues_to_atoms(residue_mask)
+
+    def _within(self, cutoff, anchor_mask):
+        """Residues with any atom within `cutoff` of the anchor atoms."""
+        coords = np.asarray(self.receptor.coords)
+        anchor = coords[anchor_mask]
+        residue_mask = np.zeros(len(self), dtype=bool)
+        if not len(anchor):
+            return self.residues_to_atoms(residue_mask)
+
+        # Only atoms inside the anchor bounding box (plus cutoff) can qualify
+        lo = anchor.min(axis=0) - cutoff
+        hi = anchor.max(axis=0) + cutoff
+        candidates = np.flatnonzero(np.all((coords >= lo) & (coords <= hi), axis=1))
+        candidate_coords = coords[candidates]
+        near = np.zeros(len(candidates), dtype=bool)
+        cutoff_sq = cutoff * cutoff
+        # Squared distances via |c|^2 + |a|^2 - 2 c.a, one block pair at a time
+        for c_start in range(0, len(candidates), _BLOCK * 8):
+            c_block = candidate_coords[c_start:c_start + _BLOCK * 8]
+            c_sq = np.einsum('ij,ij->i', c_block, c_block)[:, None]
+            for a_start in range(0, len(anchor), _BLOCK):
+                a_block = anchor[a_start:a_start + _BLOCK]
+                a_sq = np.einsum('ij,ij->i', a_block, a_block)[None, :]
+                dist_sq = c_sq + a_sq - 2 * (c_block @ a_block.T)
+                near[c_start:c_start + len(c_block)] |= (dist_sq <= cutoff_sq).any(axis=1)
+
+        residue_mask[self.atom_residue[candidates[near]]] = True
+        return self.residues_to_atoms(residue_mask)
+
+
+def residue_index(receptor):
+    """The ResidueIndex of a cached receptor, built on first use."""
+    index = receptor.derived.get('residue_index')
+    if index is None:
+        index = receptor.derived['residue_index'] = ResidueIndex(receptor)
+    return index
@@ -0,0 +1,125 @@
+"""
+Production server for GUI_UniDock.
+
+    python serve.py [--host 0.0.0.0] [--port 5000] [--workers 4] [--threads 8]
+                    [--server auto|gunicorn|waitress|werkzeug]
+
+`python app.py` runs Flask's single-process development server.  This runs the
+same app under a WSGI server with several workers, so slow requests (large
+ligand uploads, exports, log streams) do not hold up everyone else:
+
+    gunicorn   `workers` processes with `threads` threads each (Linux/macOS)
+    waitress   one process with `workers * threads` threads (any platform)
+    werkzeug   one process with `threads` threads; only for --workers 1 when
+               neither is installed
+
+Workers share all state through the workspace: jobs (scheduler.py, one worker
+holds the dispatcher lock), sessions and the secret key (sessions.py), result
+indexes and caches.  So a status poll or result query gets the same answer
+whichever worker serves it.  gunicorn workers also pool their metrics in
+workspace/metrics (see metrics.py), so /metrics covers the whole server;
+waitress and werkzeug run one process, which has them all.
+"""
+import os
+import sys
+import glob
+import argparse
+
+# Uploads of whole ligand libraries are streamed, not buffered, so the body
+# limit only guards against runaway clients
+MAX_REQUEST_BYTES = 64 * 1024 ** 3
+# Where gunicorn workers pool their metrics (UNIDOCK_METRICS_DIR, metrics.py)
+METRICS_DIR = os.path.join('workspace', 'metrics')
+
+
+def available_servers():
+    servers = []
+    for name in ('gunicorn', 'waitress'):
+        try:
+            __import__(name)
+        except ImportError:
+            continue
+        if name == 'gunicorn' and os.name != 'posix':
+            continue
+        servers.append(name)
+    return servers + ['werkzeug']
+
+
+def serve_gunicorn(host, port, workers, threads):
+    from gunicorn.app.base import BaseApplication
+
+    # Set before the workers import the app; counts of an earlier server are dropped
+    metrics_dir = os.environ.setdefault('UNIDOCK_METRICS_DIR', os.path.abspath(METRICS_DIR))
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+        os.remove(path)
+    import metrics
+
+    def child_exit(server, worker):
+        # Keep the counts of a worker that exited (or was restarted)
+        metrics.retire(worker.pid, metrics_dir)
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+            # Each worker imports the app itself: the job dispatcher thread
+            # must not be started before the fork
+            self.cfg.set('preload_app', False)
+            self.cfg.set('timeout', 300)
+            self.cfg.set('limit_request_line', 8190)
+            self.cfg.set('child_exit', child_exit)
+
+        def load(self):
+            from app import app
+            return app
+
+    Application().run()
+
+
+def serve_waitress(host, port, workers, threads):
+    from waitress import serve
+    from app import app
+    serve(app, host=host, port=port, threads=workers * threads, max_request_body_size=MAX_REQUEST_BYTES,
+          channel_timeout=300)
+
+
+def serve_werkzeug(host, port, workers, threads):
+    from werkzeug.serving import run_simple
+    from app import app
+    print('Using the Werkzeug development server (pip install waitress for a production server).',
+          file=sys.stderr)
+    run_simple(host, port, app, threaded=True)
+
+
+SERVERS = {'gunicorn': serve_gunicorn, 'waitress': serve_waitress, 'werkzeug': serve_werkzeug}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run GUI_UniDock under a multi-worker WSGI server.')
+    parser.add_argument('--host', default=os.environ.get('UNIDOCK_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('UNIDOCK_PORT', 5000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('UNIDOCK_WORKERS', min(os.cpu_count() or 1, 4))))
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('UNIDOCK_THREADS', 8)))
+    parser.add_argument('--server', choices=['auto'] + list(SERVERS), default='auto')
+    args = parser.parse_args(argv[1:])
+
+    available = available_servers()
+    server = available[0] if args.server == 'auto' else args.server
+    if server not in available:
+        parser.error(f'{server} is not installed (available: {", ".join(available)}).')
+    if server == 'werkzeug' and args.workers > 1:
+        # Its multi-process mode forks once per request, not per worker
+        parser.error('Several workers need gunicorn or waitress (pip install waitress); '
+                     'the Werkzeug server only runs with --workers 1.')
+
+    print(f'Serving on http://{args.host}:{args.port}/ with {server} '
+          f'({args.workers} worker(s) x {args.threads} thread(s)).')
+    SERVERS[server](args.host, args.port, max(args.workers, 1), max(args.threads, 1))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
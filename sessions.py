@@ -0,0 +1,117 @@
+"""
+Session state shared by every server worker.
+
+Flask's default session lives in a cookie signed with `app.secret_key`, which
+is random per process, so a second worker cannot read it.  Here the cookie
+only carries a random session id; the session data (the active project) is
+kept in SQLite under the workspace, where any worker process or thread finds
+it.  The secret key is persisted in the workspace as well, so anything else
+Flask signs stays valid across workers and restarts.
+"""
+import os
+import json
+import time
+import secrets
+import sqlite3
+from contextlib import contextmanager
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+SESSION_LIFETIME = 30 * 24 * 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    sid TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+"""
+
+
+def load_secret_key(workspace):
+    """$UNIDOCK_SECRET_KEY, or a key created once in the workspace and then reused."""
+    if os.environ.get('UNIDOCK_SECRET_KEY'):
+        return os.environ['UNIDOCK_SECRET_KEY']
+    os.makedirs(workspace, exist_ok=True)
+    path = os.path.join(workspace, 'secret_key')
+    try:
+        # O_EXCL: of several workers starting together, exactly one writes the key
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):
+            with open(path, 'r') as f:
+                key = f.read().strip()
+            if key:
+                return key
+            time.sleep(0.1)
+        raise RuntimeError(f'Secret key file {path} is empty.')
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, 'w') as f:
+        f.write(key)
+    return key
+
+
+@contextmanager
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        yield conn
+    finally:
+        conn.close()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class SqliteSessionInterface(SessionInterface):
+    """Sessions stored in a SQLite table, keyed by a random id in the cookie."""
+
+    def __init__(self, db_path, lifetime=SESSION_LIFETIME):
+        self.db_path = db_path
+        self.lifetime = lifetime
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with _connect(db_path) as conn:
+            conn.executescript(_SCHEMA)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            with _connect(self.db_path) as conn:
+                row = conn.execute('SELECT data FROM sessions WHERE sid = ? AND expires > ?',
+                                   (sid, time.time())).fetchone()
+            if row is not None:
+                return ServerSession(json.loads(row[0]), sid=sid)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session.modified:
+            return
+
+        with _connect(self.db_path) as conn:
+            if not session:
+                conn.execute('DELETE FROM sessions WHERE sid = ?', (session.sid,))
+                if not session.new:
+                    response.delete_cookie(name, domain=domain, path=path)
+                return
+            now = time.time()
+            conn.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                         (session.sid, json.dumps(dict(session)), now + self.lifetime))
+            conn.execute('DELETE FROM sessions WHERE expires <= ?', (now,))
+
+        response.set_cookie(
+            name, session.sid, max_age=self.lifetime, domain=domain, path=path,
+            httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app))
@@ -15,7 +15,7 @@ def install(package):
 def install_requirements():
     required_packages = [
         'numpy', 'pandas', 'py3Dmol', 
-        'biopython', 'flask'
+        'biopython', 'scipy', 'flask', 'waitress'
     ]
     print("Installing required Python packages...")
     for package in required_packages:
@@ -26,8 +26,10 @@ document.getElementById('grid-form').onsubmit = async (event) => {
 
         if (response.ok) {
             const message = result.message || "Grid generated successfully!";
+            const rec = result.search_recommendation;
+            const hint = rec ? ` Suggested search: ${rec.search_mode}, ${rec.num_modes} modes (relative cost ${rec.relative_cost}).` : "";
             document.getElementById('grid-response').innerHTML = `
-                ${message}`;
+                ${message}${hint}`;
             document.getElementById('grid-response').classList.remove('text-danger');
             document.getElementById('grid-response').classList.add('text-success');
 
@@ -6,17 +6,18 @@ window.onload = function () {
     });
 };
 
-// Function to load the protein structure into the viewer
-async function loadProteinStructure(filepath) {
+// Function to load the protein structure into the viewer.
+// The CA trace is shown first; the full model is fetched only when asked for.
+async function loadProteinStructure(filepath, detail = 'ca') {
     try {
-        const response = await fetch(`/get_pdb?filepath=${encodeURIComponent(filepath)}`);
+        const response = await fetch(`/get_pdb?filepath=${encodeURIComponent(filepath)}&detail=${detail}`);
         if (!response.ok) {
             throw new Error("Failed to fetch PDB file from the server.");
         }
         const pdbText = await response.text();
 
-        // Clear any existing models
-        viewer.clear();
+        // Replace the current model but keep the grid box shapes
+        viewer.removeAllModels();
 
         // Load the PDB data into the viewer
         viewer.addModel(pdbText, "pdb");
@@ -24,14 +25,140 @@ async function loadProteinStructure(filepath) {
         // Set display styles
         viewer.setStyle({}, { cartoon: { color: 'spectrum' } });
 
-        // Zoom to fit the structure
-        viewer.zoomTo();
+        // Zoom to fit the structure on first load; keep the camera when adding detail
+        if (detail !== 'full') {
+            viewer.zoomTo();
+        }
         viewer.render();
 
         // Show the viewer
         document.getElementById('viewer').style.display = 'block';
 
+        const fullBtn = document.getElementById('load-full-detail-btn');
+        if (fullBtn) {
+            fullBtn.style.display = detail === 'full' ? 'none' : 'inline-block';
+            fullBtn.disabled = false;
+            fullBtn.onclick = function () {
+                fullBtn.disabled = true;
+                loadProteinStructure(filepath, 'full');
+            };
+        }
+
     } catch (error) {
         console.error("Error loading protein structure:", error);
     }
-}
\ No newline at end of file
+}
+
+// Docked hit browser: ranked hits are fetched a page at a time from
+// /results/poses and shown one pose at a time against the receptor trace.
+var poseViewer = null;
+var poseModel = null;
+var hitPage = { offset: 0, limit: 10, total: 0, hits: [], current: 0, receptor: null };
+
+async function showHitBrowser() {
+    document.getElementById('hit-browser').style.display = 'block';
+    if (!poseViewer) {
+        poseViewer = $3Dmol.createViewer("pose-viewer", {
+            defaultcolors: $3Dmol.rasmolElementColors
+        });
+    }
+    await loadHitPage(0, 0);
+}
+
+async function loadHitPage(offset, select) {
+    try {
+        const response = await fetch(`/results/poses?offset=${offset}&limit=${hitPage.limit}`);
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || "Failed to fetch docked poses.");
+        }
+
+        if (data.receptor && data.receptor !== hitPage.receptor) {
+            const receptorResponse = await fetch(`/get_pdb?filepath=${encodeURIComponent(data.receptor)}&detail=ca`);
+            if (receptorResponse.ok) {
+                poseViewer.removeAllModels();
+                poseModel = null;
+                poseViewer.addModel(await receptorResponse.text(), "pdb");
+                poseViewer.setStyle({}, { cartoon: { color: 'spectrum', opacity: 0.8 } });
+            }
+            hitPage.receptor = data.receptor;
+        }
+
+        hitPage.offset = data.offset;
+        hitPage.total = data.total;
+        hitPage.hits = data.hits;
+        renderHitList();
+        if (data.hits.length) {
+            showHit(Math.min(select, data.hits.length - 1));
+        }
+    } catch (error) {
+        console.error("Error loading docked poses:", error);
+        document.getElementById('hit-status').textContent = error.message;
+    }
+}
+
+function renderHitList() {
+    const list = document.getElementById('hit-list');
+    list.innerHTML = '';
+    hitPage.hits.forEach((hit, i) => {
+        const item = document.createElement('button');
+        item.type = 'button';
+        item.className = 'list-group-item list-group-item-action py-1';
+        item.textContent = `${hitPage.offset + i + 1}. ${hit.ligand}  (${hit.score.toFixed(2)} kcal/mol)`;
+        item.onclick = () => showHit(i);
+        list.appendChild(item);
+    });
+    const last = Math.min(hitPage.offset + hitPage.limit, hitPage.total);
+    document.getElementById('hit-status').textContent =
+        hitPage.total ? `Hits ${hitPage.offset + 1}-${last} of ${hitPage.total}` : 'No docked poses yet.';
+}
+
+function displayPose(text) {
+    if (poseModel) {
+        poseViewer.removeModel(poseModel);
+    }
+    poseModel = poseViewer.addModel(text, "pdbqt");
+    poseModel.setStyle({}, { stick: { colorscheme: 'greenCarbon', radius: 0.2 } });
+    poseViewer.zoomTo({ model: poseModel });
+    poseViewer.render();
+}
+
+function showHit(i) {
+    const hit = hitPage.hits[i];
+    if (!hit || !hit.pose) {
+        return;
+    }
+    hitPage.current = i;
+    document.querySelectorAll('#hit-list .list-group-item').forEach((item, j) => {
+        item.classList.toggle('active', j === i);
+    });
+    displayPose(hit.pose);
+}
+
+// Step through the ranked list; crossing a page boundary fetches the next page
+function stepHit(delta) {
+    const i = hitPage.current + delta;
+    if (i < 0) {
+        if (hitPage.offset > 0) {
+            loadHitPage(Math.max(hitPage.offset - hitPage.limit, 0), hitPage.limit - 1);
+        }
+    } else if (i >= hitPage.hits.length) {
+        if (hitPage.offset + hitPage.limit < hitPage.total) {
+            loadHitPage(hitPage.offset + hitPage.limit, 0);
+        }
+    } else {
+        showHit(i);
+    }
+}
+
+// Jump straight to one ligand's best pose
+async function showLigandPose(ligand) {
+    const response = await fetch(`/results/pose?ligand=${encodeURIComponent(ligand)}`);
+    if (!response.ok) {
+        document.getElementById('hit-status').textContent = `No pose found for ${ligand}.`;
+        return;
+    }
+    document.querySelectorAll('#hit-list .list-group-item').forEach((item) => item.classList.remove('active'));
+    displayPose(await response.text());
+    document.getElementById('hit-status').textContent = `${ligand} (${response.headers.get('X-Score')} kcal/mol)`;
+}
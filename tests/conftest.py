@@ -0,0 +1,66 @@
+"""
+Shared fixtures.  The modules are imported from the repository root, and
+receptors, ligands and the docking engine are the synthetic stand-ins of
+benchmarks/ (synthetic.py, fake_engine.py), so no GPU or Uni-Dock is needed.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT, 'benchmarks')
+sys.path[:0] = [ROOT, BENCH_DIR]
+
+import synthetic  # noqa: E402
+
+RECEPTOR_ATOMS = 2000
+
+# Records the ligands of every call, drops the ones named in TEST_ENGINE_FAIL
+# (as if they produced no output) and docks the rest with fake_engine.py
+_ENGINE = """
+import os
+import sys
+sys.path.insert(0, {bench_dir!r})
+import fake_engine
+
+args = sys.argv[1:]
+index_path = args[args.index('--ligand_index') + 1]
+with open(index_path) as f:
+    ligands = [line.strip() for line in f if line.strip()]
+failing = set(filter(None, os.environ.get('TEST_ENGINE_FAIL', '').split(',')))
+with open(os.environ['TEST_ENGINE_LOG'], 'a') as log:
+    log.write(''.join(os.path.basename(p) + '\\n' for p in ligands))
+with open(index_path, 'w') as f:
+    f.write(''.join(p + '\\n' for p in ligands if os.path.splitext(os.path.basename(p))[0] not in failing))
+sys.exit(fake_engine.main(['fake_engine.py', '--seed', '0'] + args))
+"""
+
+
+@pytest.fixture
+def receptor(tmp_path):
+    return synthetic.write_receptor(str(tmp_path / 'receptor.pdb'), RECEPTOR_ATOMS)
+
+
+@pytest.fixture
+def center():
+    return synthetic.receptor_center(RECEPTOR_ATOMS)
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """Engine command for a driver config; engine.calls() lists the ligand files it was given."""
+    script = tmp_path / 'engine.py'
+    script.write_text(_ENGINE.format(bench_dir=BENCH_DIR))
+    log_path = tmp_path / 'engine_calls.txt'
+    monkeypatch.setenv('TEST_ENGINE_LOG', str(log_path))
+
+    class Engine(list):
+        def calls(self):
+            return log_path.read_text().split() if log_path.exists() else []
+
+        def reset(self):
+            if log_path.exists():
+                log_path.unlink()
+
+    return Engine([sys.executable, str(script)])
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+import interactions
+import synthetic
+from interactions import (TYPES, HBOND_MIN, HBOND_MAX, HYDROPHOBIC_MAX, SALT_BRIDGE_MAX, CLASH_MAX,
+                          CATION_CHARGE, ANION_CHARGE)
+from receptor_cache import receptor_cache
+
+RECEPTOR_ATOMS = 5000
+POSES = 600
+
+
+def reference(site, text):
+    """One pose against every receptor atom with a dense distance matrix: the rules without the KD-tree."""
+    types, coords, charges, ligand_donor = interactions.parse_pose(text)
+    counts = dict.fromkeys(TYPES, 0)
+    bits = np.zeros((len(TYPES), site.n_residues), dtype=bool)
+    if len(coords) == 0:
+        return counts, [], np.packbits(bits).tobytes()
+
+    dist = np.linalg.norm(coords[:, None, :] - site.coords[None, :, :], axis=2)
+    nitrogen = np.char.startswith(types, 'N')[:, None]
+    oxygen = np.char.startswith(types, 'O')[:, None]
+    acceptor = np.isin(types, ('OA', 'NA', 'OS', 'NS'))[:, None]
+    hydrophobic = np.isin(types, ('C', 'A', 'CL', 'BR', 'I', 'F'))[:, None]
+    donor = ligand_donor[:, None]
+    charge = charges[:, None]
+    contacts = {
+        'hbond': (dist >= HBOND_MIN) & (dist <= HBOND_MAX) & (nitrogen | oxygen) & (
+            (donor & site.acceptor) | (acceptor & site.donor)),
+        'hydrophobic': (dist <= HYDROPHOBIC_MAX) & hydrophobic & site.hydrophobic,
+        'salt_bridge': (dist <= SALT_BRIDGE_MAX) & (
+            (nitrogen & (charge >= CATION_CHARGE) & site.anion) | (oxygen & (charge <= ANION_CHARGE) & site.cation)),
+        'clash': dist < CLASH_MAX,
+    }
+    for row, kind in enumerate(TYPES):
+        counts[kind] = int(contacts[kind].sum())
+        bits[row, site.residue[contacts[kind].any(axis=0)]] = True
+    residues = [site.labels[i] for i in np.flatnonzero(bits.any(axis=0))]
+    return counts, residues, np.packbits(bits).tobytes()
+
+
+@pytest.fixture(scope='module')
+def site(tmp_path_factory):
+    path = synthetic.write_receptor(str(tmp_path_factory.mktemp('receptor') / 'receptor.pdb'), RECEPTOR_ATOMS)
+    return interactions.ReceptorSite(receptor_cache.get(path))
+
+
+@pytest.fixture(scope='module')
+def poses():
+    rng = np.random.default_rng(17)
+    center = np.asarray(synthetic.receptor_center(RECEPTOR_ATOMS))
+    texts = []
+    for i in range(POSES):
+        heavy = int(rng.integers(8, 40))
+        texts.append(synthetic.ligand_text(f'pose{i}', heavy, heavy // 4, center + rng.normal(0.0, 6.0, 3), rng=rng))
+    # Poses without heavy atoms, at the start, middle and end of a batch
+    for at in (0, POSES // 2, POSES + 2):
+        texts.insert(at, '')
+    return texts
+
+
+def test_batched_analysis_matches_dense_reference(site, poses):
+    expected = [reference(site, text) for text in poses]
+    # The contact types all occur, so every rule is compared
+    for kind in TYPES:
+        assert sum(counts[kind] for counts, _, _ in expected) > 0
+
+    assert interactions.analyse(site, poses) == expected
+    batches = []
+    for start in range(0, len(poses), interactions.BATCH_SIZE):
+        batches.extend(interactions.analyse(site, poses[start:start + interactions.BATCH_SIZE]))
+    assert batches == expected
+
+
+def test_empty_batch(site):
+    assert interactions.analyse(site, []) == []
+    counts, residues, fingerprint = interactions.analyse(site, [''])[0]
+    assert counts == dict.fromkeys(TYPES, 0) and residues == []
+    assert len(fingerprint) == (len(TYPES) * site.n_residues + 7) // 8
@@ -0,0 +1,85 @@
+import json
+import os
+
+import synthetic
+import unidock_multi
+from manifest import RunManifest, DONE, FAILED, JOURNAL
+from results_index import RESULT_SUFFIX
+
+
+def write_config(tmp_path, receptor, center, engine, **extra):
+    config = {
+        'receptor': receptor,
+        'ligand_dir': str(tmp_path / 'ligand'),
+        'results_dir': str(tmp_path / 'results'),
+        'center_x': center[0], 'center_y': center[1], 'center_z': center[2],
+        'size_x': 20, 'size_y': 20, 'size_z': 20,
+        'search_mode': 'Fast', 'scoring_method': 'vina', 'num_modes': 3,
+        'engine': engine, 'batch_size': 4, 'max_retries': 0,
+        **extra,
+    }
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps(config))
+    return str(path)
+
+
+def test_journal_is_replayed_up_to_a_torn_line(tmp_path):
+    manifest = RunManifest(str(tmp_path), 'fp')
+    manifest.record([('a', [1, 1]), ('b', [2, 2])], DONE)
+    manifest.record([('c', [3, 3])], FAILED)
+    # A crash in the middle of the next append
+    with open(tmp_path / JOURNAL, 'a') as f:
+        f.write('{"ligand": "d", "sta')
+
+    resumed = RunManifest(str(tmp_path), 'fp')
+    assert resumed.resumed
+    assert resumed.is_done('a', [1, 1]) and resumed.is_done('b', [2, 2])
+    assert not resumed.is_done('c', [3, 3])
+    assert 'd' not in resumed.ligands
+    assert resumed.counts() == {'done': 2, 'failed': 1}
+    # New records start on a clean journal
+    resumed.record([('d', [4, 4])], DONE)
+    assert RunManifest(str(tmp_path), 'fp').is_done('d', [4, 4])
+
+
+def test_changed_source_or_fingerprint_is_not_resumed(tmp_path):
+    manifest = RunManifest(str(tmp_path), 'fp')
+    manifest.record([('a', [1, 1])], DONE)
+    assert not RunManifest(str(tmp_path), 'fp').is_done('a', [1, 2])
+    assert not RunManifest(str(tmp_path), 'other').resumed
+    # The changed fingerprint started a fresh manifest
+    assert not RunManifest(str(tmp_path), 'fp').resumed
+
+
+def test_resume_docks_only_what_the_partial_run_left(tmp_path, receptor, center, engine, monkeypatch, capfd):
+    paths = synthetic.write_library(str(tmp_path / 'ligand'), 10, center)
+    names = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+    config_path = write_config(tmp_path, receptor, center, engine)
+
+    # First run: the last four ligands give no output
+    monkeypatch.setenv('TEST_ENGINE_FAIL', ','.join(names[6:]))
+    assert unidock_multi.main(['unidock_multi.py', config_path]) == 0
+    assert sorted(engine.calls()) == sorted(os.path.basename(p) for p in paths)
+
+    engine.reset()
+    monkeypatch.delenv('TEST_ENGINE_FAIL')
+    capfd.readouterr()
+    assert unidock_multi.main(['unidock_multi.py', config_path]) == 0
+    out = capfd.readouterr().out
+
+    assert sorted(engine.calls()) == sorted(os.path.basename(p) for p in paths[6:])
+    assert 'Resuming run: 6 of 10 ligand(s) already docked.' in out
+    # Resumed ligands are reported as done too, so progress reaches the total
+    assert sum(line.startswith('[ligand] done ') for line in out.splitlines()) == 10
+    for name in names:
+        assert os.path.exists(tmp_path / 'results' / (name + RESULT_SUFFIX))
+
+
+def test_changed_settings_dock_everything_again(tmp_path, receptor, center, engine):
+    paths = synthetic.write_library(str(tmp_path / 'ligand'), 4, center)
+    assert unidock_multi.main(['unidock_multi.py', write_config(tmp_path, receptor, center, engine)]) == 0
+
+    engine.reset()
+    config_path = write_config(tmp_path, receptor, center, engine, num_modes=5)
+    assert unidock_multi.main(['unidock_multi.py', config_path]) == 0
+    assert len(engine.calls()) == len(paths)
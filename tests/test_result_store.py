@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+import result_store
+from result_store import ResultStore, SHARD_DIR
+from results_index import ResultsIndex, RESULT_SUFFIX
+
+
+def result_bytes(name, scores):
+    models = ''.join(f'MODEL {i}\nREMARK VINA RESULT: {score:9.3f}      0.000      0.000\n'
+                     f'REMARK  Name = {name}\nATOM      1  C   UNL     1       {i:.3f}   0.000   0.000\nENDMDL\n'
+                     for i, score in enumerate(scores, 1))
+    return models.encode()
+
+
+@pytest.fixture
+def results():
+    return {f'lig{i:04d}{RESULT_SUFFIX}': result_bytes(f'lig{i:04d}', [-5 - i * 0.01, -4.5 - i * 0.01])
+            for i in range(300)}
+
+
+def write_loose(results_dir, results):
+    os.makedirs(results_dir, exist_ok=True)
+    for name, data in results.items():
+        with open(os.path.join(results_dir, name), 'wb') as f:
+            f.write(data)
+
+
+def test_put_and_iterate_across_shards(tmp_path, results):
+    store = ResultStore(str(tmp_path), shard_bytes=4096)
+    items = list(results.items())
+    store.put(items[:100])
+    store.put(items[100:])
+    store.close()
+
+    assert store.files() == set(results)
+    assert len(os.listdir(tmp_path / SHARD_DIR)) > 2
+    # Pages smaller than a shard and not aligned with one
+    assert list(store.iter_members(batch_size=7)) == items
+    name = items[123][0]
+    assert store.read(name) == results[name]
+    with pytest.raises(FileNotFoundError):
+        store.read('missing' + RESULT_SUFFIX)
+
+    stats = store.stats()
+    assert stats['files'] == len(results)
+    assert stats['bytes'] == sum(len(data) for data in results.values())
+    assert stats['dead_bytes'] == 0
+
+
+def test_loose_file_wins_over_packed_copy(tmp_path, results):
+    name, data = next(iter(results.items()))
+    store = ResultStore(str(tmp_path))
+    store.put([(name, data)])
+    store.close()
+    newer = result_bytes('again', [-9.0])
+    (tmp_path / name).write_bytes(newer)
+    assert result_store.read_result(str(tmp_path), name) == newer
+
+
+def test_migrate_and_unpack_round_trip(tmp_path, results):
+    results_dir = str(tmp_path / 'results')
+    receptor_dir = os.path.join(results_dir, 'receptor_b')
+    write_loose(results_dir, results)
+    write_loose(receptor_dir, dict(list(results.items())[:10]))
+    ResultsIndex(results_dir).sync()
+    before = [(p['ligand'], p['rank'], p['score']) for p in ResultsIndex(results_dir).iter_poses(rank=None)]
+
+    reports = result_store.migrate(results_dir, shard_bytes=8192)
+    assert sorted(r['files'] for r in reports) == [10, len(results)]
+    assert not any(name.endswith(RESULT_SUFFIX) for name in os.listdir(results_dir))
+
+    # Packed poses stay in the index and read back from their shard
+    index = ResultsIndex(results_dir)
+    assert index.sync() == 0
+    assert [(p['ligand'], p['rank'], p['score']) for p in index.iter_poses(rank=None)] == before
+    pose = index.pose('lig0042', rank=2)
+    shard, offset, length = pose['packed']
+    data = result_store.read_member(results_dir, shard, offset, length)
+    assert data == results['lig0042' + RESULT_SUFFIX]
+    assert data[pose['offset']:pose['offset'] + pose['length']].startswith(b'MODEL 2\n')
+
+    assert result_store.unpack(results_dir) == len(results) + 10
+    for name, data in results.items():
+        with open(os.path.join(results_dir, name), 'rb') as f:
+            assert f.read() == data
+    assert not os.path.exists(os.path.join(results_dir, SHARD_DIR))
+    assert not os.path.exists(os.path.join(receptor_dir, SHARD_DIR))
+    assert ResultStore(results_dir).files() == set()
+    index = ResultsIndex(results_dir)
+    assert index.sync() == 0
+    assert index.counts() == {'ligands': len(results), 'poses': 2 * len(results)}
+    assert 'packed' not in index.pose('lig0042')
@@ -0,0 +1,74 @@
+import os
+
+import pose_clusters
+from results_index import ResultsIndex, RESULT_SUFFIX
+
+
+def result_text(scores, shifts=None):
+    """Result file with one pose per score; pose i is the same two atoms moved by shifts[i] along x."""
+    shifts = shifts or [float(i) * 5 for i in range(len(scores))]
+    models = []
+    for i, (score, shift) in enumerate(zip(scores, shifts), 1):
+        atoms = ''.join(f'ATOM  {n:5d}  C{n}  UNL     1    {x + shift:8.3f}{0.0:8.3f}{0.0:8.3f}  0.00  0.00    +0.000 C\n'
+                        for n, x in ((1, 0.0), (2, 1.5)))
+        models.append(f'MODEL {i}\nREMARK VINA RESULT: {score:9.3f}      0.000      0.000\n{atoms}ENDMDL\n')
+    return ''.join(models)
+
+
+def rewrite(path, text):
+    # The way result files are replaced in place (pose_clusters, the driver)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def best(index):
+    return [(pose['ligand'], pose['score']) for pose in index.top(limit=10)[1]]
+
+
+def test_sync_follows_rewrites_and_removals(tmp_path):
+    paths = {}
+    for i, name in enumerate(['a', 'b', 'c']):
+        paths[name] = str(tmp_path / (name + RESULT_SUFFIX))
+        with open(paths[name], 'w') as f:
+            f.write(result_text([-6.0 - i, -5.0 - i, -4.0 - i]))
+    index = ResultsIndex(str(tmp_path))
+    index.add(paths.values())
+    assert index.sync() == 0
+    assert best(index) == [('c', -8.0), ('b', -7.0), ('a', -6.0)]
+
+    rewrite(paths['a'], result_text([-9.5]))
+    assert index.sync() == 1
+    assert best(index) == [('a', -9.5), ('c', -8.0), ('b', -7.0)]
+    assert index.pose('a', rank=2) is None
+    assert index.counts() == {'ligands': 3, 'poses': 7}
+    # Nothing changed since
+    assert index.sync() == 0
+
+    os.remove(paths['b'])
+    assert index.sync() == 1
+    assert best(index) == [('a', -9.5), ('c', -8.0)]
+    assert index.counts() == {'ligands': 2, 'poses': 4}
+
+
+def test_sync_after_pose_dedupe(tmp_path):
+    path = str(tmp_path / ('lig' + RESULT_SUFFIX))
+    # Poses 1 and 2 are 0.5 A apart, pose 3 is far from both
+    with open(path, 'w') as f:
+        f.write(result_text([-7.0, -6.5, -6.0], shifts=[0.0, 0.5, 10.0]))
+    index = ResultsIndex(str(tmp_path))
+    index.add([path])
+    assert index.counts()['poses'] == 3
+
+    report = pose_clusters.dedupe_file(path, rewrite=True)
+    assert report['kept'] == 2
+    assert index.sync() == 1
+    poses = list(index.iter_poses(rank=None))
+    assert [(pose['rank'], pose['score']) for pose in poses] == [(1, -7.0), (2, -6.0)]
+    # Offsets point into the rewritten file
+    with open(path, 'rb') as f:
+        data = f.read()
+    second = poses[1]
+    assert data[second['offset']:second['offset'] + second['length']].startswith(b'MODEL 2\nREMARK VINA RESULT:    -6.000')
+    assert second['offset'] + second['length'] == len(data)
@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+
+import pytest
+
+import scheduler
+from scheduler import JobScheduler, QUEUED, RUNNING, DONE, FAILED, CANCELLED, ACTIVE_STATES
+
+
+@pytest.fixture
+def sched(tmp_path):
+    return JobScheduler(str(tmp_path / 'jobs.db'), slots=[{'slot': 0, 'cpus': [0], 'gpu': None}])
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+def run_until(sched, done, timeout=60):
+    deadline = time.time() + timeout
+    while not done():
+        assert time.time() < deadline, 'jobs did not finish in time'
+        sched.dispatch()
+        time.sleep(0.05)
+    sched.dispatch()
+
+
+def finished(sched, *job_ids):
+    return lambda: all(sched.get(job_id)['state'] not in ACTIVE_STATES for job_id in job_ids)
+
+
+def process_running(pid):
+    """True for a live process; a zombie waiting to be reaped has already exited."""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return scheduler._pid_alive(pid)
+    return stat[stat.rindex(b')') + 2:].split()[0] != b'Z'
+
+
+def test_jobs_run_by_priority_then_submission(sched, tmp_path):
+    log = str(tmp_path / 'job.log')
+    low = sched.submit('p', python('pass'), log, priority=0)
+    high = sched.submit('p', python('pass'), log, priority=5)
+    low_2 = sched.submit('p', python('pass'), log, priority=0)
+    top = sched.submit('p', python('pass'), log, priority=9)
+
+    positions = {job_id: sched.queue_position(sched.get(job_id)) for job_id in (low, high, low_2, top)}
+    assert positions == {top: 1, high: 2, low: 3, low_2: 4}
+
+    run_until(sched, finished(sched, low, high, low_2, top))
+    jobs = [sched.get(job_id) for job_id in (low, high, low_2, top)]
+    assert all(job['state'] == DONE for job in jobs)
+    order = [job['id'] for job in sorted(jobs, key=lambda job: job['started'])]
+    assert order == [top, high, low, low_2]
+
+
+def test_one_job_per_slot(sched, tmp_path):
+    log = str(tmp_path / 'job.log')
+    first = sched.submit('p', python('import time; time.sleep(0.5)'), log)
+    second = sched.submit('p', python('pass'), log)
+    sched.dispatch()
+    assert sched.get(first)['state'] == RUNNING
+    assert sched.get(second)['state'] == QUEUED
+    assert sched.queue_position(sched.get(second)) == 1
+
+    run_until(sched, finished(sched, first, second))
+    assert sched.get(second)['started'] >= sched.get(first)['finished']
+
+
+def test_cancelled_queued_job_never_runs(sched, tmp_path):
+    marker = tmp_path / 'ran'
+    blocker = sched.submit('p', python('import time; time.sleep(0.5)'), str(tmp_path / 'a.log'))
+    sched.dispatch()
+    job_id = sched.submit('p', python(f'open({str(marker)!r}, "w").close()'), str(tmp_path / 'b.log'))
+
+    assert sched.cancel(job_id)
+    assert sched.get(job_id)['state'] == CANCELLED
+    run_until(sched, finished(sched, blocker))
+    assert sched.get(job_id)['state'] == CANCELLED
+    assert not marker.exists()
+    # Finished jobs cannot be cancelled again
+    assert not sched.cancel(job_id)
+    assert not sched.cancel(blocker)
+
+
+def test_cancelled_running_job_stops_its_process_group(sched, tmp_path):
+    pid_file = tmp_path / 'pid'
+    code = (f'import os, subprocess, sys, time\n'
+            f'engine = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])\n'
+            f'open({str(pid_file)!r}, "w").write(f"{{os.getpid()}} {{engine.pid}}")\n'
+            f'time.sleep(60)\n')
+    job_id = sched.submit('p', python(code), str(tmp_path / 'job.log'))
+    run_until(sched, lambda: pid_file.exists() and pid_file.read_text(), timeout=30)
+    pids = [int(pid) for pid in pid_file.read_text().split()]
+
+    started = time.time()
+    assert sched.cancel(job_id)
+    run_until(sched, finished(sched, job_id), timeout=30)
+    job = sched.get(job_id)
+    assert job['state'] == CANCELLED
+    assert job['error'] == 'Cancelled by user.'
+    assert time.time() - started < scheduler.CANCEL_GRACE_SECONDS
+    deadline = time.time() + 5
+    while any(process_running(pid) for pid in pids) and time.time() < deadline:
+        time.sleep(0.05)
+    assert not any(process_running(pid) for pid in pids)
+
+
+def test_recover_does_not_trust_a_reused_pid(sched, tmp_path):
+    log = str(tmp_path / 'job.log')
+    own = sched.submit('p', python('pass'), log)
+    reused = sched.submit('p', python('pass'), log)
+    legacy = sched.submit('p', python('pass'), log)
+    gone = sched.submit('p', python('pass'), log)
+    pid = os.getpid()
+    token = scheduler._process_token(pid)
+    assert token is not None
+
+    with scheduler._connect(sched.db_path) as conn:
+        for job_id, job_pid, job_token in ((own, pid, token), (reused, pid, token.split(':')[0] + ':1'),
+                                           (legacy, pid, None), (gone, 2 ** 22 + 1, None)):
+            conn.execute('UPDATE jobs SET state = ?, pid = ?, pid_token = ?, started = ? WHERE id = ?',
+                         (RUNNING, job_pid, job_token, time.time(), job_id))
+    sched._recover()
+
+    assert sched.get(own)['state'] == RUNNING
+    # Rows written before tokens were recorded still go by the pid alone
+    assert sched.get(legacy)['state'] == RUNNING
+    for job_id in (reused, gone):
+        job = sched.get(job_id)
+        assert job['state'] == FAILED
+        assert job['error'] == 'Job was interrupted before it finished.'
+    # A live process under a reused pid is not signalled either
+    assert sched.cancel(reused) is False
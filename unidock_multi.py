@@ -0,0 +1,509 @@
+"""
+Batched Uni-Dock driver.
+
+    python unidock_multi.py <config.json>
+
+The config is the master configuration written by /run-docking: receptor,
+ligand_dir, results_dir, the grid box (center_*/size_*) and the docking
+parameters.  Ligands are sorted by torsion and heavy-atom count and packed into
+batches of similar work, each docked by one engine call through
+`--ligand_index`, so engine start-up is paid once per batch.  Ligands of a
+batch that produce no valid output are retried in smaller groups.
+
+Optional config keys:
+    engine          engine command (string or list), default $UNIDOCK_ENGINE
+                    or "unidock"; any executable accepting Uni-Dock's
+                    arguments can stand in for it
+    batch_size      most ligands per batch
+    batch_atoms     heavy-atom budget per batch
+    max_retries     retry rounds for failed ligands (default 2)
+    batch_timeout   seconds one engine call may take before it is killed and
+                    its batch counts as failed (default 300 plus 120 per
+                    ligand in the batch)
+    resume          skip ligands the run manifest records as docked with the
+                    same settings and that still have valid output (default true)
+    cache_dir       shared result cache (see result_cache.py); ligands whose
+                    receptor, ligand file, box and parameters match a cached
+                    result are copied from it instead of being docked
+    cache_max_bytes size limit of the result cache (default
+                    $UNIDOCK_CACHE_MAX_BYTES or 10 GiB)
+    ligand_list     file listing the ligands to dock, one path relative to
+                    ligand_dir per line (a selection from the library index);
+                    by default every ligand file under ligand_dir is docked
+    receptors       ensemble run: a list of {"name", "receptor", center_*,
+                    size_*} entries.  The library is docked against each
+                    receptor into results_dir/<name>, and the best and mean
+                    best-pose score per ligand over all receptors is written
+                    to the consensus table of results_dir/results.db
+    funnel          two-stage run: {"fraction" or "top", "search_mode",
+                    "num_modes"}.  The library is docked with the config's
+                    search settings into results_dir/stage1, then the best
+                    `top` ligands (or `fraction` of those scored) are docked
+                    again with the funnel's search settings (default detail,
+                    9 modes) into results_dir
+    dedupe_rmsd     as each batch finishes, cluster each ligand's poses at
+                    this heavy-atom RMSD (Angstrom) and rewrite the final
+                    result files with the cluster representatives only (see
+                    pose_clusters.py)
+    shard_results   pack each finished batch's result files into compressed
+                    shards under results_dir/shards instead of leaving one
+                    file per ligand (see result_store.py)
+    shard_bytes     shard size (default $UNIDOCK_SHARD_BYTES or 256 MiB)
+
+Uni-Dock names each result after its ligand file's name, so ligand files
+that share a name (in different folders) cannot be docked in one run: only
+the first one found is docked and the others are reported.
+
+Progress is reported on stdout as "[progress] total=N" and
+"[ligand] done|failed <name>" lines (see progress.py); the poses of every
+finished batch are added to the results index (results_index.py).
+"""
+import os
+import sys
+import math
+import json
+import time
+import shlex
+import subprocess
+
+import pdbqt
+import ligand_index
+from results_index import ResultsIndex, write_consensus, RESULT_SUFFIX
+from manifest import RunManifest, config_fingerprint, file_signature, DONE, FAILED
+from result_cache import ResultCache, hash_file, params_digest, result_key
+from pose_clusters import dedupe_file, new_totals, add_report, summarize
+from result_store import ResultStore
+
+# Batch sizes used when the config does not set them
+GPU_BATCH_SIZE = 256
+SINGLE_BATCH_SIZE = 32
+DEFAULT_MAX_RETRIES = 2
+# Engine time limit per batch when the config does not set one (seconds)
+BATCH_TIMEOUT_BASE = 300
+BATCH_TIMEOUT_PER_LIGAND = 120
+
+# Funnel runs keep their first (cheap) stage in results_dir/stage1
+STAGE1_DIR = 'stage1'
+DEFAULT_FUNNEL_FRACTION = 0.1
+
+SCORING_FUNCTIONS = {'vina': 'vina', 'vinardo': 'vinardo', 'adt': 'ad4', 'ad4': 'ad4'}
+# Search modes by their form name (Fast, Balanced, Detail) or Uni-Dock's own,
+# mapped to the engine's --search_mode
+SEARCH_MODES = {'fast': 'fast', 'balanced': 'balance', 'balance': 'balance', 'detail': 'detail'}
+
+
+def log(message):
+    print(message, flush=True)
+
+
+def engine_search_mode(search_mode):
+    """Uni-Dock's --search_mode for a form or config value; ValueError when it is unknown."""
+    mode = SEARCH_MODES.get(str(search_mode).lower())
+    if mode is None:
+        raise ValueError(f'Unknown search mode {search_mode!r}; expected Fast, Balanced or Detail.')
+    return mode
+
+
+def find_ligands(ligand_dir):
+    """Ligand files under `ligand_dir`, skipping hidden files and folders."""
+    ligands = []
+    for root, dirs, files in os.walk(ligand_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if not name.startswith('.') and name.lower().endswith(ligand_index.DOCKING_EXTENSIONS):
+                ligands.append(os.path.join(root, name))
+    return ligands
+
+
+def read_ligand_list(list_path, ligand_dir):
+    """Ligand files named in a selection list that still exist."""
+    ligands = []
+    with open(list_path, 'r') as f:
+        for line in f:
+            rel_path = line.strip()
+            path = os.path.join(ligand_dir, rel_path)
+            if rel_path and rel_path.lower().endswith(ligand_index.DOCKING_EXTENSIONS) and os.path.isfile(path):
+                ligands.append(path)
+    return ligands
+
+
+def read_ligand_stats(ligand_dir, ligands):
+    """(heavy atoms, torsions) per ligand, taken from the library index where possible."""
+    indexed = ligand_index.load(ligand_dir).stats_for(ligands)
+    return [indexed.get(p) or pdbqt.read_stats(p) for p in ligands]
+
+
+def ligand_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def drop_duplicate_names(ligands):
+    """`ligands` without the files whose name an earlier one already has; their results would collide."""
+    kept, first = [], {}
+    for p in ligands:
+        name = ligand_name(p)
+        if name in first:
+            log(f'Skipping {p}: its results would overwrite those of {first[name]} (same ligand name).')
+            continue
+        first[name] = p
+        kept.append(p)
+    return kept
+
+
+def result_path(results_dir, ligand):
+    return os.path.join(results_dir, ligand_name(ligand) + RESULT_SUFFIX)
+
+
+class RunResults:
+    """
+    Where finished result files go: deduplicated (dedupe_rmsd), added to the
+    results index and, with shard_results, packed into the result store.
+    """
+
+    def __init__(self, config):
+        self.results_dir = config['results_dir']
+        self.index = ResultsIndex(self.results_dir)
+        self.cutoff = float(config['dedupe_rmsd']) if config.get('dedupe_rmsd') else None
+        self.dedupe_totals = new_totals()
+        self.store = ResultStore(self.results_dir, config.get('shard_bytes')) if config.get('shard_results') else None
+
+    def finish(self, ligands, ok):
+        """`ligands` were just docked or fetched from the cache, `ok` of them with valid output."""
+        paths = [result_path(self.results_dir, p) for p in ok]
+        if self.cutoff:
+            # The result cache has the files in full already, only the run's copies shrink
+            for path in paths:
+                add_report(self.dedupe_totals, dedupe_file(path, self.cutoff, rewrite=True))
+        # Scores become queryable as soon as a batch is written
+        self.index.add([result_path(self.results_dir, p) for p in ligands])
+        if self.store is not None:
+            self.store.pack(paths)
+            # Packing removed the loose files the index was synced with
+            self.index.mark_synced()
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+        if self.cutoff and self.dedupe_totals['files']:
+            report = summarize(self.dedupe_totals, self.cutoff)
+            log(f"[dedupe] {os.path.basename(self.results_dir)}: kept {report['kept']} of {report['poses']} pose(s), "
+                f"{report['bytes_saved']} bytes saved ({report['space_saving']:.0%}).")
+
+
+def pack_batches(ligands, stats, batch_size, batch_atoms):
+    """
+    Sort ligands by (torsions, heavy atoms) and cut the sorted list into
+    batches holding at most `batch_size` ligands and `batch_atoms` heavy atoms,
+    so small ligands share larger batches and every batch carries similar work.
+    """
+    order = sorted(range(len(ligands)), key=lambda i: (stats[i][1], stats[i][0], ligands[i]))
+    batches, batch, atoms = [], [], 0
+    for i in order:
+        heavy = max(stats[i][0], 1)
+        if batch and (len(batch) >= batch_size or atoms + heavy > batch_atoms):
+            batches.append(batch)
+            batch, atoms = [], 0
+        batch.append(ligands[i])
+        atoms += heavy
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def engine_command(config):
+    engine = config.get('engine') or os.environ.get('UNIDOCK_ENGINE') or 'unidock'
+    command = shlex.split(engine) if isinstance(engine, str) else list(engine)
+
+    search_mode = engine_search_mode(config.get('search_mode', 'fast'))
+    scoring = SCORING_FUNCTIONS.get(str(config.get('scoring_method', 'vina')).lower(), 'vina')
+
+    command += [
+        '--receptor', config['receptor'],
+        '--scoring', scoring,
+        '--search_mode', search_mode,
+        '--num_modes', str(int(config.get('num_modes') or 9)),
+    ]
+    for axis in ('x', 'y', 'z'):
+        command += [f'--center_{axis}', str(config[f'center_{axis}']), f'--size_{axis}', str(config[f'size_{axis}'])]
+    return command
+
+
+def run_batch(command, batch, results_dir, index_path, timeout=None):
+    """Dock one batch; returns the ligands that produced a valid result (none if it timed out)."""
+    with open(index_path, 'w') as f:
+        f.write('\n'.join(os.path.abspath(p) for p in batch) + '\n')
+
+    # Outputs left over from an earlier run must not pass for new results
+    for p in batch:
+        try:
+            os.remove(result_path(results_dir, p))
+        except FileNotFoundError:
+            pass
+
+    try:
+        subprocess.run(command + ['--ligand_index', index_path, '--dir', results_dir],
+                       stderr=subprocess.STDOUT, check=False, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        # Output of a killed engine may be cut short; the batch is retried
+        log(f'Docking engine took longer than {timeout:.0f} s on {len(batch)} ligand(s) and was stopped.')
+        return []
+    except OSError as e:
+        log(f'Could not start docking engine: {e}')
+        return []
+    return [p for p in batch if pdbqt.is_valid_result(result_path(results_dir, p))]
+
+
+def fetch_cached(cache, config, ligands, run_manifest, sources, results, ligand_hashes=None, tag=''):
+    """
+    Copy cached results of `ligands` into the results directory.  Returns the
+    ligands that still have to be docked and their cache keys.  Ligand hashes
+    are kept in `ligand_hashes`, when given, for the next receptor.
+    """
+    receptor_hash = hash_file(config['receptor'])
+    params_hash = params_digest(config)
+    hits, misses, keys = [], [], {}
+    for p in ligands:
+        if ligand_hashes is None:
+            ligand_hash = hash_file(p)
+        else:
+            ligand_hash = ligand_hashes.get(p) or ligand_hashes.setdefault(p, hash_file(p))
+        key = result_key(receptor_hash, ligand_hash, params_hash)
+        if cache.fetch(key, result_path(config['results_dir'], p)):
+            hits.append(p)
+        else:
+            misses.append(p)
+            keys[p] = key
+
+    results.finish(hits, hits)
+    run_manifest.record([(ligand_name(p), sources[p]) for p in hits], DONE)
+    for p in hits:
+        log(f'[ligand] done {tag}{ligand_name(p)}')
+    log(f'[cache] {len(hits)} of {len(ligands)} ligand(s) taken from the result cache '
+        f'({len(hits) / len(ligands):.0%} hit rate).')
+    return misses, keys
+
+
+def plan_batches(config, ligands, stats):
+    """Pack `ligands` into batches using their (heavy atoms, torsions) from `stats`."""
+    batch_size = int(config.get('batch_size') or (GPU_BATCH_SIZE if config.get('gpu_check') else SINGLE_BATCH_SIZE))
+    ligand_stats = [stats[p] for p in ligands]
+    mean_atoms = sum(s[0] for s in ligand_stats) / len(ligand_stats) if ligand_stats else 1
+    batch_atoms = int(config.get('batch_atoms') or max(batch_size * mean_atoms, 1))
+    batches = pack_batches(ligands, ligand_stats, batch_size, batch_atoms)
+    log(f'Packed {len(ligands)} ligand(s) into {len(batches)} batch(es) '
+        f'(up to {batch_size} ligands / {batch_atoms} heavy atoms each).')
+    return batches
+
+
+def dock(config, batches, run_manifest, sources, results, cache=None, cache_keys=None, tag=''):
+    """Dock `batches` with retries; returns (done, failed) lists."""
+    results_dir = config['results_dir']
+    batch_dir = os.path.join(results_dir, '.batches')
+    os.makedirs(batch_dir, exist_ok=True)
+
+    command = engine_command(config)
+    max_retries = int(config.get('max_retries', DEFAULT_MAX_RETRIES))
+    done, failed = [], []
+    counter = 0
+
+    for number, batch in enumerate(batches, start=1):
+        started = time.time()
+        pending = [batch]
+        for attempt in range(max_retries + 1):
+            retry = []
+            for group in pending:
+                counter += 1
+                index_path = os.path.join(batch_dir, f'batch_{counter:06d}.txt')
+                timeout = float(config.get('batch_timeout') or
+                                BATCH_TIMEOUT_BASE + BATCH_TIMEOUT_PER_LIGAND * len(group))
+                ok = run_batch(command, group, results_dir, index_path, timeout)
+                if cache is not None:
+                    for p in ok:
+                        cache.store(cache_keys[p], result_path(results_dir, p))
+                results.finish(group, ok)
+                run_manifest.record([(ligand_name(p), sources[p]) for p in ok], DONE)
+                for p in ok:
+                    log(f'[ligand] done {tag}{ligand_name(p)}')
+                done.extend(ok)
+                ok = set(ok)
+                retry.extend(p for p in group if p not in ok)
+            if not retry:
+                break
+            if attempt < max_retries:
+                # Smaller groups isolate the ligands that make a batch fail;
+                # the last attempt docks every ligand on its own
+                log(f'Retrying {len(retry)} failed ligand(s) from batch {number} (attempt {attempt + 2}).')
+                size = 1 if attempt + 1 == max_retries else max(1, (len(retry) + 1) // 2)
+                pending = [retry[i:i + size] for i in range(0, len(retry), size)]
+            else:
+                run_manifest.record([(ligand_name(p), sources[p]) for p in retry], FAILED)
+                for p in retry:
+                    log(f'[ligand] failed {tag}{ligand_name(p)} no valid output after {max_retries + 1} attempt(s)')
+                failed.extend(retry)
+        log(f'Batch {number}/{len(batches)} finished in {time.time() - started:.1f} s.')
+
+    return done, failed
+
+
+def run_receptor(config, ligands, sources, stats, ligand_hashes=None, tag=''):
+    """
+    Dock `ligands` against the receptor and box of `config`, skipping ligands
+    the run manifest or the result cache already has.  Returns (done, failed).
+    """
+    results_dir = config['results_dir']
+    os.makedirs(results_dir, exist_ok=True)
+
+    # Ligands already docked with the same settings are not docked again
+    run_manifest = RunManifest(results_dir, config_fingerprint(config), resume=config.get('resume', True))
+    todo = ligands
+    if run_manifest.resumed:
+        packed = ResultStore(results_dir).files()
+        todo = [
+            p for p in ligands
+            if not (run_manifest.is_done(ligand_name(p), sources[p])
+                    and (ligand_name(p) + RESULT_SUFFIX in packed
+                         or pdbqt.is_valid_result(result_path(results_dir, p))))
+        ]
+        # Logged like the ligands docked now, so progress counts them
+        remaining = set(todo)
+        for p in ligands:
+            if p not in remaining:
+                log(f'[ligand] done {tag}{ligand_name(p)}')
+        log(f'Resuming run: {len(ligands) - len(todo)} of {len(ligands)} ligand(s) already docked.')
+
+    # Identical inputs docked before (by any project) are served from the cache
+    results = RunResults(config)
+    cache, cache_keys = None, None
+    if config.get('cache_dir') and todo:
+        cache = ResultCache(config['cache_dir'], config.get('cache_max_bytes'))
+        todo, cache_keys = fetch_cached(cache, config, todo, run_manifest, sources, results, ligand_hashes, tag)
+
+    done, failed = [], []
+    if todo:
+        batches = plan_batches(config, todo, stats)
+        done, failed = dock(config, batches, run_manifest, sources, results, cache, cache_keys, tag)
+    else:
+        log('Nothing left to dock.')
+    run_manifest.compact()
+    results.close()
+    if cache is not None:
+        cache.close()
+    return done, failed
+
+
+def receptor_configs(config):
+    """
+    (name, config) per receptor of an ensemble run; each receptor has its own
+    box and writes to results_dir/<name>.
+    """
+    configs = []
+    for entry in config['receptors']:
+        receptor_config = {key: value for key, value in config.items() if key != 'receptors'}
+        receptor_config.update(entry)
+        receptor_config['results_dir'] = os.path.join(config['results_dir'], entry['name'])
+        configs.append((entry['name'], receptor_config))
+    return configs
+
+
+def run_funnel(config, ligands, sources, stats):
+    """
+    Stage 1 docks every ligand with the cheap settings of `config`; stage 2
+    re-docks the best of them with the funnel's detailed settings.
+    Returns (done, failed) over both stages.
+    """
+    funnel = config['funnel']
+    # Only the final stage is deduplicated
+    stage1_config = dict(config, results_dir=os.path.join(config['results_dir'], STAGE1_DIR), dedupe_rmsd=None)
+    stage2_config = dict(config, search_mode=funnel.get('search_mode', 'detail'),
+                         num_modes=funnel.get('num_modes', 9))
+
+    log(f'[funnel] Stage 1: {len(ligands)} ligand(s), {config.get("search_mode")} search.')
+    started = time.time()
+    done1, failed1 = run_receptor(stage1_config, ligands, sources, stats, tag=f'{STAGE1_DIR}/')
+    stage1_time = time.time() - started
+
+    # Rank stage 1 by best-pose score and keep the top of the list
+    stage1_index = ResultsIndex(stage1_config['results_dir'])
+    scored = stage1_index.counts()['ligands']
+    if funnel.get('top'):
+        keep = int(funnel['top'])
+    else:
+        keep = math.ceil(scored * float(funnel.get('fraction', DEFAULT_FUNNEL_FRACTION)))
+    # Results of ligands no longer in the library are passed over, so the
+    # ranking is read until `keep` ligands of this run are found
+    by_name = {ligand_name(p): p for p in ligands}
+    selected = []
+    if keep > 0:
+        for pose in stage1_index.iter_poses(rank=1):
+            if pose['ligand'] in by_name:
+                selected.append(by_name[pose['ligand']])
+                if len(selected) >= keep:
+                    break
+
+    log(f'[progress] total={len(ligands) + len(selected)}')
+    log(f'[funnel] Stage 2: top {len(selected)} of {scored} scored ligand(s), '
+        f'{stage2_config["search_mode"]} search with {stage2_config["num_modes"]} mode(s).')
+    started = time.time()
+    done2, failed2 = run_receptor(stage2_config, selected, sources, stats)
+    stage2_time = time.time() - started
+    log(f'[funnel] Stage 1 took {stage1_time:.1f} s, stage 2 {stage2_time:.1f} s.')
+    return done1 + done2, failed1 + failed2
+
+
+def main(argv):
+    if len(argv) != 2:
+        print('usage: unidock_multi.py <config.json>', file=sys.stderr)
+        return 2
+
+    with open(argv[1], 'r') as f:
+        config = json.load(f)
+    try:
+        engine_search_mode(config.get('search_mode', 'fast'))
+        if config.get('funnel'):
+            engine_search_mode(config['funnel'].get('search_mode', 'detail'))
+    except ValueError as e:
+        log(str(e))
+        return 2
+    os.makedirs(config['results_dir'], exist_ok=True)
+
+    if config.get('ligand_list'):
+        ligands = read_ligand_list(config['ligand_list'], config['ligand_dir'])
+        log(f'Docking {len(ligands)} ligand(s) selected from the library.')
+    else:
+        ligands = find_ligands(config['ligand_dir'])
+    ligands = drop_duplicate_names(ligands)
+    ensemble = receptor_configs(config) if config.get('receptors') else None
+    log(f'[progress] total={len(ligands) * (len(ensemble) if ensemble else 1)}')
+    if not ligands:
+        log('No ligand files found.')
+        return 1
+
+    # Ligand files are read once, however many receptors they are docked against
+    sources = {p: file_signature(p) for p in ligands}
+    stats = dict(zip(ligands, read_ligand_stats(config['ligand_dir'], ligands)))
+
+    started = time.time()
+    if ensemble:
+        done, failed = [], []
+        ligand_hashes = {} if config.get('cache_dir') else None
+        for number, (name, receptor_config) in enumerate(ensemble, start=1):
+            log(f'Receptor {number}/{len(ensemble)}: {name}')
+            receptor_done, receptor_failed = run_receptor(
+                receptor_config, ligands, sources, stats, ligand_hashes, tag=f'{name}/')
+            done.extend(receptor_done)
+            failed.extend(receptor_failed)
+        scored = write_consensus(config['results_dir'], [name for name, _ in ensemble])
+        log(f'[consensus] {scored} ligand(s) scored over {len(ensemble)} receptor(s).')
+    elif config.get('funnel'):
+        done, failed = run_funnel(config, ligands, sources, stats)
+    else:
+        done, failed = run_receptor(config, ligands, sources, stats)
+
+    elapsed = time.time() - started
+    log(f'Docked {len(done)} ligand(s), {len(failed)} failed, in {elapsed:.1f} s '
+        f'({len(done) / elapsed if elapsed else 0:.2f} ligands/s).')
+    return 0 if done or not failed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))